@@ -0,0 +1,219 @@
+import threading
+import time
+
+import numpy as np
+
+from misc_functions import scale_raw_samples
+
+
+class ConsumerGate:
+    """
+    A slot that only takes chunks some of the time (eg. the recorder, the calibration measurements)
+
+    Producers count the receivers of their signal when they publish a chunk and emit it after, so connecting a
+    slot in between would hand it a chunk it wasn't counted for and disconnecting one would leave a chunk it
+    was counted for unreleased. The gate is connected once, before the producer runs, and stays connected:
+    chunks are released right away while it's closed and passed on to the slot while it's open. Chunks
+    produced before the gate was opened are released too, the slot only sees data from after open().
+    """
+
+    def __init__(self, signal, *args):
+        """
+        :param signal: bound chunk signal, eg. reader.incoming_data
+        :param args: passed on to connect(), eg. the connection type
+        """
+        # (slot, perf_counter time it was opened), replaced as a whole so the producer's thread sees one or the other
+        self.target = (None, 0.0)
+        signal.connect(self.on_chunk, *args)
+
+    def open(self, slot):
+        """
+        Pass the chunks produced from now on to slot, which releases them like any other consumer
+        """
+        self.target = (slot, time.perf_counter())
+
+    def close(self):
+        self.target = (None, 0.0)
+
+    @property
+    def is_open(self):
+        return self.target[0] is not None
+
+    def on_chunk(self, chunk):
+        slot, opened_at = self.target
+        if slot is None or chunk.timestamp < opened_at:
+            chunk.release()
+            return
+        slot(chunk)
+
+
+class Chunk:
+    """
+    A single preallocated block of samples handed out by a ChunkPool
+
+    The chunk is shared between the producer (eg. SignalReader) and every consumer connected to its signal.
+    Consumers must call release() once they are done with the data so that the buffer can go back to the
+    pool and be refilled by the producer. Consumers that need to hold on to the data past their slot
+    (eg. to hand it to another thread) call retain() first and release() when they are finished.
+
+    seq: sequence number assigned by the producer, increases by one for every chunk produced
+    data: (channels x samples) view into the preallocated buffer
+    scaling: None when data is in volts, otherwise the (channels x coefficients) polynomial that converts
+             the raw counts in data to volts (see to_volts)
+    frequency: instantaneous output frequency in Hz at the first sample when the writer plays a sweep,
+               otherwise None. Set by the debug writer for its own chunks, and by SignalReader from the
+               writer's frequency_log (see SignalWriterDAQ.frequency_at)
+    """
+
+    def __init__(self, pool, num_channels, max_samples, dtype):
+        self.pool = pool
+        self.seq = -1
+        self.timestamp = 0.0
+        self.refs = 0
+        self.scaling = None
+        self.frequency = None
+
+        # flat storage so that any number of samples up to max_samples is a contiguous (channels x n) view
+        self._storage = np.empty(num_channels * max_samples, dtype=dtype)
+        self.num_channels = num_channels
+        self.num_samples = 0
+        self.set_num_samples(max_samples)
+
+    def set_num_samples(self, num_samples):
+        """
+        Changes how many samples per channel the data view exposes
+        The view is only rebuilt when the size actually changes, so this is free for fixed size chunks
+
+        :param num_samples: number of samples per channel, must not exceed the preallocated size
+        """
+        if num_samples == self.num_samples:
+            return
+        self.num_samples = num_samples
+        self.data = self._storage[: self.num_channels * num_samples].reshape(
+            self.num_channels, num_samples
+        )
+
+    def to_volts(self, out):
+        """
+        Write the data in volts into out, scaling raw counts when the chunk holds any
+
+        :param out: float64 array with at least as many samples per channel as the chunk
+        :return: the (channels x samples) part of out that was written
+        """
+        out = out[:, : self.num_samples]
+        if self.scaling is None:
+            np.copyto(out, self.data)
+        else:
+            scale_raw_samples(self.data, self.scaling, out)
+        return out
+
+    def retain(self):
+        """
+        Adds a reference so the buffer is not recycled until the matching release()
+        """
+        self.pool.retain(self)
+
+    def release(self):
+        """
+        Drops one reference, the buffer returns to the pool when no references are left
+        """
+        self.pool.release(self)
+
+
+class ChunkPool:
+    """
+    Fixed set of preallocated chunk buffers that are recycled between a producer and its consumers
+
+    Nothing is allocated once the pool is created: the producer acquires a free chunk, fills it in place,
+    publishes it with the number of consumers that will release it, and the chunk goes back to the free list
+    once all of them have called release(). If every buffer is still in use acquire() returns None and the
+    producer is expected to drop that chunk rather than overwrite data a consumer is still reading.
+    Producers hand their chunks out with emit(), slots that are only connected some of the time go through a
+    ConsumerGate so the count stays right.
+    """
+
+    def __init__(self, size, num_channels, max_samples, dtype=np.float64):
+        """
+        :param size: number of buffers in the pool (3 = triple buffering)
+        :param num_channels: rows in each buffer
+        :param max_samples: samples per channel allocated for each buffer
+        :param dtype: numpy dtype of the sample data
+        """
+        self.lock = threading.Lock()
+        self.num_channels = num_channels
+        self.max_samples = max_samples
+        self.chunks = [
+            Chunk(self, num_channels, max_samples, dtype) for i in range(size)
+        ]
+        self.free = list(self.chunks)
+
+        # sequence number of the most recent chunk that every consumer has released
+        self.last_released_seq = -1
+        # seconds between emitting that chunk and its last release, ie. how long the consumers took
+        self.release_delay = 0.0
+        self.dropped = 0
+
+    def acquire(self):
+        """
+        Take a free chunk out of the pool
+
+        :return: Chunk, or None if every buffer is still held by a consumer
+        """
+        with self.lock:
+            if not self.free:
+                self.dropped += 1
+                return None
+            chunk = self.free.pop()
+            chunk.refs = 1
+            return chunk
+
+    def emit(self, chunk, producer, signal):
+        """
+        Publish the chunk to the slots connected to signal and emit it
+        No lock is held while the slots run, so a slow consumer only holds up its own thread, or the producer's
+        for a direct connection
+
+        :param producer: QObject the signal belongs to
+        :param signal: bound signal of producer the chunk is emitted with
+        """
+        with self.lock:
+            num_consumers = producer.receivers(signal)
+            self._publish(chunk, num_consumers)
+        if num_consumers:
+            signal.emit(chunk)
+
+    def publish(self, chunk, num_consumers):
+        """
+        Hand the producer's reference over to the consumers that are about to receive the chunk
+        Must be called before the chunk is emitted
+
+        :param chunk: chunk returned by acquire()
+        :param num_consumers: how many release() calls to expect before the buffer is recycled
+        """
+        with self.lock:
+            self._publish(chunk, num_consumers)
+
+    def _publish(self, chunk, num_consumers):
+        chunk.refs += num_consumers - 1
+        if chunk.refs == 0:
+            self._recycle(chunk)
+
+    def retain(self, chunk):
+        with self.lock:
+            chunk.refs += 1
+
+    def release(self, chunk):
+        with self.lock:
+            # a release the chunk wasn't published for would put the buffer on the free list twice
+            if chunk.refs <= 0:
+                raise RuntimeError("Chunk " + str(chunk.seq) + " released more often than it was published")
+            chunk.refs -= 1
+            if chunk.refs == 0:
+                self._recycle(chunk)
+
+    def _recycle(self, chunk):
+        chunk.refs = 0
+        if chunk.seq > self.last_released_seq:
+            self.last_released_seq = chunk.seq
+            self.release_delay = time.perf_counter() - chunk.timestamp
+        self.free.append(chunk)
@@ -1,6 +1,8 @@
 from numpy.core.arrayprint import format_float_positional
 from old.model import ChannelInterfaceData
 from re import S
+import time
+
 import numpy as np
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtWidgets import (
@@ -13,7 +15,26 @@ from PyQt5.QtWidgets import (
     QMainWindow
 )
 
-from config import CALIBRATION_VOLTAGE, CHANNEL_NAMES_IN, CHANNEL_NAMES_OUT, DEBUG_MODE
+from buffers import ChunkPool, ConsumerGate
+from config import (
+    CALIBRATION_MIN_SLOPE,
+    CALIBRATION_SWEEP_CHUNKS,
+    CALIBRATION_SWEEP_LEVELS,
+    CALIBRATION_VOLTAGE,
+    CHANNEL_NAMES_IN,
+    CHANNEL_NAMES_OUT,
+    DEBUG_MODE,
+    DELAY_CHIRP_END_RATIO,
+    DELAY_CHIRP_PERIOD,
+    DELAY_CHIRP_PERIODS,
+    DELAY_CHIRP_START,
+    DELAY_CHIRP_VOLTAGE,
+    MAX_VOLTAGE,
+    MIN_VOLTAGE,
+    READER_POOL_SIZE,
+)
+from delay import measure_delays
+from sweep import LINEAR_CHIRP, FrequencySweep
 
 """
 Make new window
@@ -37,18 +58,46 @@ Hook up back onto coils
 class CalibrationWindow(QMainWindow):
     """
     Calibrates the DAQ reader to ensure the correct offset for all channels
+
+    Also the calibration stage between the reader and everything that uses the data in volts: every chunk is
+    corrected to gains * volts + offsets per input channel into a pooled (inputs x samples) chunk. When the
+    source has fewer rows than there are inputs (the debug writer emits its outputs), every input gets the
+    row of the output it is assigned to, through an index array that is only rebuilt when the assignment
+    changes.
+
+    run_sweep() calibrates gains and offsets together: the outputs step through CALIBRATION_SWEEP_LEVELS DC
+    levels from MIN_VOLTAGE to MAX_VOLTAGE, the mean of every input is accumulated over
+    CALIBRATION_SWEEP_CHUNKS chunks at every level, and one least squares solve fits the line through the
+    levels for all inputs at once, see fit_sweep().
+
+    run_delay_measurement() measures the delay and phase lag from every output to its inputs: the outputs play a
+    repeating chirp, the inputs are averaged over DELAY_CHIRP_PERIODS chirps and cross-correlated with it,
+    see delay.measure_delays(). The resulting DelayCorrection is kept in delay_correction.
+
+    corrected_data: emitted with a pooled Chunk of the corrected data in volts, slots connected to it must
+                    call chunk.release() like they would for SignalReader
+    sweep_running: emitted with True when the calibration sweep or the delay measurement starts driving the
+                   outputs, False once done and the writer's parameters are back (the writer plays sine waves
+                   until its source is set again)
+    delays_received: emitted with the DelayCorrection once a delay measurement is done
     """
 
-    # data with offsets applied
+    # data with gains and offsets applied
     corrected_data = QtCore.pyqtSignal(object)
     offsets_received = QtCore.pyqtSignal(object)
+    gains_received = QtCore.pyqtSignal(object)
+    sweep_running = QtCore.pyqtSignal(bool)
+    delays_received = QtCore.pyqtSignal(object)
 
     def __init__(
-        self, parent, writer, reader, write_channels, read_channels, saved_offsets
+        self, parent, writer, reader, write_channels, read_channels, saved_offsets, saved_gains=None,
+        delay_correction=None
     ):
         super().__init__(parent)
         self.writer = writer
         self.reader = reader
+        # the offset calibration, the sweep and the delay measurement take the reader's chunks through here
+        self.input_gate = ConsumerGate(reader.incoming_data)
         self.write_channels = write_channels
         self.read_channels = read_channels
 
@@ -56,12 +105,47 @@ class CalibrationWindow(QMainWindow):
         self.calibration_voltage = CALIBRATION_VOLTAGE
 
         self.handler_counter = 0
-        self.offsets = saved_offsets
+        self.offsets = np.array(saved_offsets, dtype=np.float64)
+        self.gains = np.ones(len(CHANNEL_NAMES_IN)) if saved_gains is None else \
+            np.array(saved_gains, dtype=np.float64)
+        # reused buffer for scaling raw chunks to volts
+        self.volts = None
+        # corrected chunks, allocated for the largest chunk seen so far
+        self.pool = None
+        # source row of every input and the (rows, assignment) it was built for
+        self.index = None
+        self.index_key = None
         # value represents the index of the output channel to take voltage readings from
-        self.assigned_output = [int for x in CHANNEL_NAMES_IN]
+        # defaults to spreading the inputs over the outputs in order, eg. X1, X2 <- X; Y1, Y2 <- Y; Z <- Z
+        self.assigned_output = [
+            i * len(CHANNEL_NAMES_OUT) // len(CHANNEL_NAMES_IN) for i in range(len(CHANNEL_NAMES_IN))
+        ]
+
+        # calibration sweep state, see run_sweep()
+        self.sweep_levels = np.linspace(MIN_VOLTAGE, MAX_VOLTAGE, CALIBRATION_SWEEP_LEVELS)
+        self.level = 0
+        self.level_chunks = 0
+        # perf_counter time the current level is on the outputs, chunks measured before are skipped
+        self.settled_at = 0.0
+        # samples, mean and sum of squared deviations of every input at every level
+        self.level_counts = np.zeros(CALIBRATION_SWEEP_LEVELS)
+        self.level_means = np.zeros((CALIBRATION_SWEEP_LEVELS, len(CHANNEL_NAMES_IN)))
+        self.level_m2 = np.zeros((CALIBRATION_SWEEP_LEVELS, len(CHANNEL_NAMES_IN)))
+
+        # delay measurement state, see run_delay_measurement()
+        self.delay_correction = delay_correction
+        # one period of the chirp, the inputs summed over it and how many samples went into every column
+        self.excitation = None
+        self.chirp_band = None
+        self.chirp_sum = None
+        self.chirp_counts = None
+        self.chirp_position = 0
+        self.last_seq = None
 
         self.init_ui()
         self.calibration_btn.clicked.connect(self.on_calibration_btn_clicked)
+        self.sweep_btn.clicked.connect(self.run_sweep)
+        self.delay_btn.clicked.connect(self.run_delay_measurement)
 
     def init_ui(self):
         """
@@ -81,6 +165,10 @@ class CalibrationWindow(QMainWindow):
         grid_layout.addWidget(QLabel("Input Ch."), 0, 0)
         grid_layout.addWidget(QLabel("Output Ch."), 0, 1)
         grid_layout.addWidget(QLabel("Offsets"), 0, 2)
+        grid_layout.addWidget(QLabel("Sweep Fit"), 0, 3)
+        grid_layout.addWidget(QLabel("Delay"), 0, 4)
+        self.fit_label = [QLabel("") for ch in CHANNEL_NAMES_IN]
+        self.delay_label = [QLabel("") for ch in CHANNEL_NAMES_IN]
 
         for i, ch_in in enumerate(CHANNEL_NAMES_IN):
             for j, ch_out in enumerate(CHANNEL_NAMES_OUT):
@@ -93,7 +181,7 @@ class CalibrationWindow(QMainWindow):
             handler = lambda _, combo=self.sel_output_ch_combo[i]: self.on_output_channel_selected(
                 combo)
             self.sel_output_ch_combo[i].currentIndexChanged.connect(handler)
-            self.sel_output_ch_combo[i].setCurrentIndex(0)
+            self.sel_output_ch_combo[i].setCurrentIndex(self.assigned_output[i])
 
             self.offsets_label = [
                 QLabel(str(self.offsets[i]) + "V")
@@ -105,21 +193,33 @@ class CalibrationWindow(QMainWindow):
             )
             grid_layout.addWidget(self.sel_output_ch_combo[i], i + 1, 1)
             grid_layout.addWidget(self.offsets_label[i], i + 1, 2)
+            grid_layout.addWidget(self.fit_label[i], i + 1, 3)
+            grid_layout.addWidget(self.delay_label[i], i + 1, 4)
             # make associations between daq input channel and the daq out channel it is receiving voltage from
 
         self.calibration_voltage_label = QLabel(
             "Calibration Voltage: {}V\n".format(self.calibration_voltage)
         )
         self.calibration_btn = QPushButton("Start Calibration")
+        self.sweep_btn = QPushButton(
+            "Run Sweep ({} levels from {}V to {}V)".format(CALIBRATION_SWEEP_LEVELS, MIN_VOLTAGE, MAX_VOLTAGE)
+        )
 
         instructions = "\nEnsure the input DAQ channels are connected to the corresponding"
         instructions += "\noutput DAQ channels before starting calibration\n"
+        instructions += "\nThe sweep fits gains and offsets, Start Calibration only the offsets"
+        instructions += "\nMeasure Delay finds the delay and phase lag of every output relative to the first"
         instructions += "\n(Exit to skip calibration)\n"
 
         layout.addWidget(self.calibration_voltage_label)
         layout.addLayout(grid_layout)
         layout.addWidget(QLabel(instructions))
         layout.addWidget(self.calibration_btn)
+        layout.addWidget(self.sweep_btn)
+        self.delay_btn = QPushButton("Measure Delay")
+        layout.addWidget(self.delay_btn)
+        if self.delay_correction is not None:
+            self.show_delays(self.delay_correction, None)
 
     # combo = contains the info for the selected output DAQ we are reading from
     # combo.currentData() = input channel that we are assigning to
@@ -138,7 +238,7 @@ class CalibrationWindow(QMainWindow):
             print("Exited Calibration")
             self.close()
 
-    def on_data_collected(self, data):
+    def on_data_collected(self, chunk):
         """
         handler that is called when reader takes in a buffer
         When the DAQ reader is on, it will repeated call this function
@@ -149,25 +249,29 @@ class CalibrationWindow(QMainWindow):
         self.handler_counter += 1
         # allow the DAQ to clear its buffer before taking in voltage
         if self.handler_counter < 2:
+            chunk.release()
             return
 
         self.handler_counter = 0
         print("Calibration data received")
-        # collect mean of data in buffer, and apply offset to plotter
+        volts = self.to_volts(chunk)
+        self.update_index(chunk.num_channels)
+        # collect mean of data in buffer, the offset brings the corrected mean to the calibration voltage
+        means = volts[self.index, : chunk.num_samples].mean(axis=1)
+        self.offsets[:] = self.calibration_voltage - self.gains * means
+        chunk.release()
         for i, ch in enumerate(CHANNEL_NAMES_IN):
-            index = self.assigned_output[i]
-            self.offsets[i] = self.calibration_voltage - np.mean(data[index])
             self.offsets_label[i].setText(str(self.offsets[i]) + "V")
 
         print("Offset:", self.offsets)
-        self.offsets_received.emit(self.offsets)
+        self.offsets_received.emit(self.offsets.tolist())
 
         self.calibration_btn.setText("Finish Calibration")
         self.calibration_state = False
 
         # writer.pause will make one more call to this handler once paused
-        # disconnect before writer can make another call to this handler
-        self.reader.incoming_data.disconnect(self.on_data_collected)
+        # close the gate before writer can make another call to this handler
+        self.input_gate.close()
 
         self.writer.pause()  # will end up emitting on_data_collected again
         self.writer.output_states = self.saved_writer_states
@@ -180,8 +284,8 @@ class CalibrationWindow(QMainWindow):
         This will allow the program to process the true and measured voltage and calibrate accordingly
         """
         print("Calibration Started")
-        # connect to reader to get input
-        self.reader.incoming_data.connect(self.on_data_collected)
+        # take the reader's input
+        self.input_gate.open(self.on_data_collected)
 
         # save previous output states
         self.saved_writer_states = self.writer.output_states
@@ -196,13 +300,295 @@ class CalibrationWindow(QMainWindow):
 
         self.writer.resume()
 
+    def run_sweep(self):
+        """
+        Step the outputs through the calibration levels, on_sweep_data() collects the inputs at every level
+        and fit_sweep() sets the gains and offsets once the last level is done
+        """
+        print("Calibration Sweep Started:", self.sweep_levels, "V")
+        self.claim_outputs()
+
+        self.level_counts[:] = 0
+        self.level_means[:] = 0
+        self.level_m2[:] = 0
+        for i, ch in enumerate(CHANNEL_NAMES_OUT):
+            self.writer.output_states[i] = True
+            self.writer.frequencies[i] = 0
+        # the first level has to be set before resuming, the chunks from before it are skipped
+        self.set_level(0)
+        self.input_gate.open(self.on_sweep_data)
+        if not self.writer_was_running:
+            self.writer.resume()
+
+    def claim_outputs(self):
+        """
+        Save the writer's parameters and take over the outputs for the sweep or the delay measurement
+        Any source the writer plays is dropped, the calibration writes sine waves or plays its own
+        """
+        self.sweep_btn.setEnabled(False)
+        self.delay_btn.setEnabled(False)
+        self.calibration_btn.setEnabled(False)
+        self.sweep_running.emit(True)
+
+        # save copies of the output parameters, they are changed in place
+        self.saved_writer_states = list(self.writer.output_states)
+        self.saved_writer_frequencies = list(self.writer.frequencies)
+        self.saved_writer_voltages = list(self.writer.voltages)
+        self.writer_was_running = self.writer.is_running
+        self.writer.set_source(None)
+
+    def release_outputs(self):
+        """
+        Give the outputs back with the parameters they had before claim_outputs()
+        """
+        self.writer.set_source(None)
+        if self.writer_was_running:
+            self.writer.output_states[:] = self.saved_writer_states
+            self.writer.frequencies[:] = self.saved_writer_frequencies
+            self.writer.voltages[:] = self.saved_writer_voltages
+            self.writer.params_changed()
+        else:
+            self.writer.pause()
+            self.writer.output_states = self.saved_writer_states
+            self.writer.voltages = self.saved_writer_voltages
+            self.writer.frequencies = self.saved_writer_frequencies
+
+        self.sweep_btn.setEnabled(True)
+        self.delay_btn.setEnabled(True)
+        self.calibration_btn.setEnabled(True)
+        self.calibration_btn.setText("Finish Calibration")
+        self.calibration_state = False
+        self.sweep_running.emit(False)
+
+    def set_level(self, level):
+        """
+        Put every output on the given calibration level
+        """
+        self.level = level
+        self.level_chunks = 0
+        for i, ch in enumerate(CHANNEL_NAMES_OUT):
+            self.writer.voltages[i] = self.sweep_levels[level]
+        self.writer.params_changed()
+        self.settled_at = time.perf_counter() + self.writer.output_latency()
+
+    def on_sweep_data(self, chunk):
+        """
+        Accumulate the mean and variance of every input at the current level, chunk by chunk
+        """
+        if chunk.timestamp - chunk.num_samples / self.reader.sample_rate < self.settled_at:
+            chunk.release()
+            return
+        self.update_index(chunk.num_channels)
+        data = self.to_volts(chunk)[self.index, : chunk.num_samples]
+        chunk.release()
+
+        # merge the chunk's statistics into the level's (Chan et al.)
+        count = self.level_counts[self.level]
+        mean = self.level_means[self.level]
+        chunk_mean = data.mean(axis=1)
+        chunk_m2 = data.var(axis=1) * data.shape[1]
+        total = count + data.shape[1]
+        delta = chunk_mean - mean
+        mean += delta * data.shape[1] / total
+        self.level_m2[self.level] += chunk_m2 + delta ** 2 * count * data.shape[1] / total
+        self.level_counts[self.level] = total
+
+        self.level_chunks += 1
+        if self.level_chunks < CALIBRATION_SWEEP_CHUNKS:
+            return
+        if self.level + 1 < len(self.sweep_levels):
+            self.set_level(self.level + 1)
+            return
+
+        self.input_gate.close()
+        self.fit_sweep()
+        self.release_outputs()
+
+    def fit_sweep(self):
+        """
+        Least squares fit of measured = slope * level + intercept for every input in one solve
+        The corrected data gain * measured + offset is then the level, so gain = 1 / slope and
+        offset = -intercept / slope. The residuals of the corrected levels show the nonlinearity
+        and the standard deviation at the levels the noise.
+        """
+        levels = np.column_stack((self.sweep_levels, np.ones(len(self.sweep_levels))))
+        (slopes, intercepts), _, _, _ = np.linalg.lstsq(levels, self.level_means, rcond=None)
+        connected = np.abs(slopes) >= CALIBRATION_MIN_SLOPE
+        slopes = np.where(connected, slopes, 1)
+
+        gains = 1 / slopes
+        offsets = -intercepts / slopes
+        residuals = gains * self.level_means + offsets - self.sweep_levels[:, None]
+        max_residuals = np.abs(residuals).max(axis=0)
+        noise = np.abs(gains) * np.sqrt(self.level_m2.sum(axis=0) / (self.level_counts.sum() - 1))
+
+        np.copyto(self.gains, gains, where=connected)
+        np.copyto(self.offsets, offsets, where=connected)
+        for i, ch in enumerate(CHANNEL_NAMES_IN):
+            self.offsets_label[i].setText(str(self.offsets[i]) + "V")
+            if connected[i]:
+                self.fit_label[i].setText("gain {:.4f}, residual {:.1f} mV, noise {:.1f} mV".format(
+                    gains[i], max_residuals[i] * 1000, noise[i] * 1000))
+            else:
+                self.fit_label[i].setText("not connected, unchanged")
+        print("Calibration Sweep Done")
+        print("Gains:", self.gains)
+        print("Offsets:", self.offsets)
+        print("Largest residuals (V):", max_residuals)
+        self.gains_received.emit(self.gains.tolist())
+        self.offsets_received.emit(self.offsets.tolist())
+
+    def run_delay_measurement(self):
+        """
+        Play a repeating linear chirp on every output, on_delay_data() averages the inputs over the chirps and
+        measures the delays once DELAY_CHIRP_PERIODS of them are in
+
+        The chirp lasts a whole number of input samples and turns a whole number of times, so it repeats
+        exactly and every input sample adds to the column of the period it falls on.
+        """
+        rate = self.reader.sample_rate
+        period = int(round(DELAY_CHIRP_PERIOD * rate))
+        duration = period / rate
+        end = DELAY_CHIRP_END_RATIO * min(rate, self.writer.sample_rate)
+        # the phase of a linear chirp moves on by duration * (start + end) / 2 turns
+        turns = np.floor(duration * (DELAY_CHIRP_START + end) / 2)
+        end = 2 * turns / duration - DELAY_CHIRP_START
+        if end <= DELAY_CHIRP_START:
+            print("Sample rate too low for the delay measurement")
+            return
+        print("Delay Measurement Started: chirp from", DELAY_CHIRP_START, "to", round(end, 3), "Hz in", duration, "s")
+        self.claim_outputs()
+
+        num_outputs = len(CHANNEL_NAMES_OUT)
+        voltages = [DELAY_CHIRP_VOLTAGE] * num_outputs
+        shifts = [0] * num_outputs
+        self.chirp_band = (DELAY_CHIRP_START, end)
+        # what the outputs play, sampled at the input rate from the start of a chirp
+        self.excitation = FrequencySweep(voltages, shifts, DELAY_CHIRP_START, end, duration, LINEAR_CHIRP).fill(
+            np.empty((num_outputs, period)), rate
+        )
+        self.chirp_sum = np.zeros((len(CHANNEL_NAMES_IN), period))
+        self.chirp_counts = np.zeros(period)
+        self.chirp_position = 0
+        self.last_seq = None
+
+        for i, ch in enumerate(CHANNEL_NAMES_OUT):
+            self.writer.output_states[i] = True
+        self.writer.set_source(
+            FrequencySweep(voltages, shifts, DELAY_CHIRP_START, end, duration, LINEAR_CHIRP, repeat=True)
+        )
+        self.settled_at = time.perf_counter() + self.writer.output_latency()
+        self.input_gate.open(self.on_delay_data)
+        if not self.writer_was_running:
+            self.writer.resume()
+
+    def on_delay_data(self, chunk):
+        """
+        Add a chunk into the columns of the chirp period its samples fall on
+        The period position only follows the samples when no chunk is missing, so a dropped chunk starts
+        the average over
+        """
+        if chunk.timestamp - chunk.num_samples / self.reader.sample_rate < self.settled_at:
+            chunk.release()
+            return
+        if self.last_seq is not None and chunk.seq != self.last_seq + 1:
+            print("Input chunk dropped, starting the delay measurement over")
+            self.chirp_sum[:] = 0
+            self.chirp_counts[:] = 0
+        self.last_seq = chunk.seq
+        self.update_index(chunk.num_channels)
+        data = self.to_volts(chunk)[self.index, : chunk.num_samples]
+        chunk.release()
+
+        period = len(self.chirp_counts)
+        columns = (self.chirp_position + np.arange(data.shape[1])) % period
+        np.add.at(self.chirp_sum, (slice(None), columns), data)
+        np.add.at(self.chirp_counts, columns, 1)
+        self.chirp_position = (self.chirp_position + data.shape[1]) % period
+        if self.chirp_counts.min() < DELAY_CHIRP_PERIODS:
+            return
+
+        self.input_gate.close()
+        self.release_outputs()
+        responses = self.chirp_sum / self.chirp_counts
+        try:
+            correction, connected = measure_delays(
+                self.excitation, responses, self.assigned_output, self.reader.sample_rate, self.chirp_band
+            )
+        except ValueError as e:
+            print("Delay measurement failed:", e)
+            return
+        self.delay_correction = correction
+        self.show_delays(correction, connected)
+        print("Delay Measurement Done")
+        print("Delays (ms):", correction.delays * 1000)
+        print("Output lags (deg) from", correction.frequencies[0], "to", correction.frequencies[-1], "Hz:")
+        print(correction.lags[:, [0, -1]])
+        self.delays_received.emit(correction)
+
+    def show_delays(self, correction, connected):
+        """
+        Show the delay of every input and the lag of its output at the top of the measured band
+        """
+        top = correction.frequencies[-1]
+        for i, ch in enumerate(CHANNEL_NAMES_IN):
+            if connected is not None and not connected[i]:
+                self.delay_label[i].setText("not connected")
+                continue
+            self.delay_label[i].setText("{:.3f} ms, {:.1f} deg at {:.0f} Hz".format(
+                correction.delays[i] * 1000, correction.lags[self.assigned_output[i], -1], top))
+
+    def to_volts(self, chunk):
+        """
+        The chunk's data in volts, raw int16 chunks are scaled into a reused buffer
+        """
+        if chunk.scaling is None:
+            return chunk.data
+        if self.volts is None or self.volts.shape[0] != chunk.num_channels or \
+                self.volts.shape[1] < chunk.num_samples:
+            self.volts = np.empty((chunk.num_channels, chunk.pool.max_samples))
+        return chunk.to_volts(self.volts)
+
+    def update_index(self, num_rows):
+        """
+        Rebuild the source row of every input when the number of rows or the assignment changed
+        The rows are the inputs themselves when there are enough of them, else the assigned outputs
+        """
+        key = (num_rows, tuple(self.assigned_output))
+        if key == self.index_key:
+            return
+        if num_rows >= len(CHANNEL_NAMES_IN):
+            self.index = np.arange(len(CHANNEL_NAMES_IN))
+        else:
+            self.index = np.minimum(self.assigned_output, num_rows - 1)
+        self.index_key = key
+
     # handler takes input from reader and then emits the calibrated data
-    # maybe put in another object
-    def apply_calibration(self, data):
+    def apply_calibration(self, chunk):
         """
         This function is called as a bridge between the received signal and the used signal
-        Applies calibration offset all incoming data
+        Applies the calibration gains and offsets to all incoming data in one pass, into a pooled chunk
+        The reader's chunk is released as soon as the corrected copy is made
         """
-        corrected = [chan_data + self.offsets[i]
-                     for i, chan_data in enumerate(data)]
-        self.corrected_data.emit(corrected)
+        consumers = self.receivers(self.corrected_data)
+        if not consumers:
+            chunk.release()
+            return
+        if self.pool is None or self.pool.max_samples < chunk.num_samples:
+            self.pool = ChunkPool(READER_POOL_SIZE, len(CHANNEL_NAMES_IN), chunk.num_samples)
+        corrected = self.pool.acquire()
+        if corrected is None:
+            chunk.release()
+            return
+
+        self.update_index(chunk.num_channels)
+        corrected.set_num_samples(chunk.num_samples)
+        np.take(self.to_volts(chunk)[:, : chunk.num_samples], self.index, axis=0, out=corrected.data)
+        corrected.seq = chunk.seq
+        corrected.timestamp = chunk.timestamp
+        corrected.frequency = chunk.frequency
+        chunk.release()
+
+        corrected.data *= self.gains[:, None]
+        corrected.data += self.offsets[:, None]
+        self.pool.emit(corrected, self, self.corrected_data)
@@ -3,6 +3,16 @@
 # True if no NI-DAQ Hardware is attached. Data will be simulated
 DEBUG_MODE = True
 
+# True to run the real reader/writer code against the simulated DAQ in sim_daq.py instead of nidaqmx
+# Set DEBUG_MODE to False when using this so the SignalReader and SignalWriterDAQ are created
+SIMULATED_DAQ = False
+# Every simulated input reads SIM_GAIN * output(t - SIM_DELAY) + SIM_OFFSET + noise
+# SIM_NOISE is the standard deviation of the noise in volts, SIM_DELAY is in seconds
+SIM_GAIN = 1.0
+SIM_OFFSET = 0.0
+SIM_NOISE = 0.001
+SIM_DELAY = 0.0
+
 # Sets the number of concurrent output/input channels as well as their names
 # Make sure CHANNEL_NAMES_OUT has at least 3 names assigned
 # also keep the same order to have the correct real life axis representation
@@ -19,8 +29,117 @@ CALIBRATION_VOLTAGE = 0
 MAX_VOLTAGE = 10
 MIN_VOLTAGE = -10
 
+# Calibration sweep (Calibration window "Run Sweep"): DC levels spread evenly from MIN_VOLTAGE to MAX_VOLTAGE
+CALIBRATION_SWEEP_LEVELS = 9
+# input chunks averaged at every level, once the level has reached the inputs
+CALIBRATION_SWEEP_CHUNKS = 3
+# inputs that change by less than this many volts per output volt are taken as not connected and keep
+# their previous gain and offset
+CALIBRATION_MIN_SLOPE = 0.1
+
+# Delay measurement (Calibration window "Measure Delay"): every output plays a repeating linear chirp from
+# DELAY_CHIRP_START Hz up to DELAY_CHIRP_END_RATIO of the lower of the reader and writer sample rates
+# at DELAY_CHIRP_VOLTAGE RMS, one chirp lasts DELAY_CHIRP_PERIOD seconds
+DELAY_CHIRP_START = 1
+DELAY_CHIRP_END_RATIO = 0.4
+DELAY_CHIRP_VOLTAGE = 1
+DELAY_CHIRP_PERIOD = 1.0
+# chirps averaged on the inputs before the cross-correlation, more average out more noise
+DELAY_CHIRP_PERIODS = 8
+# frequencies in the phase lag table, spread over the band of the chirp
+DELAY_TABLE_POINTS = 32
+# where the measured delay correction is kept between sessions
+DELAY_CORRECTION_FILE = "delay_correction.npz"
+# where the delay correction is applied (Settings "Delay Correction")
+# Outputs: the lags are in the drive, the writer shifts every output back by its lag
+# Measurements: the lags are in the sensing, the analysis takes them off the measured phases
+DELAY_CORRECTION_MODES = ["Off", "Outputs", "Measurements"]
+
 # Reset to default param values (used when changes are made to param_tree code)
 # True: Params will always be set to defaults in code
 # False: Params will be what it was last set
 # Suggested to set True when modifying parameter.py
 RESET_DEFAULT_PARAMS = True
+
+# Acquisition modes of the reader, selected in the Reader Config
+# Polling: the reader thread loops on blocking reads of Sample Size samples
+# Hardware Callback: the DAQmx every N samples acquired event reads whatever is available,
+#                    the reader thread sleeps in between
+ACQUISITION_MODES = ["Polling", "Hardware Callback"]
+
+# Number of preallocated chunk buffers the reader cycles through (3 = triple buffering)
+# Chunks are dropped instead of overwritten when consumers hold on to all of them
+READER_POOL_SIZE = 3
+
+# Adaptive chunk sizing (Reader Config "Adaptive Chunk Size", polling mode only)
+# Sample Size is the largest chunk, the reader never goes below ADAPTIVE_MIN_SAMPLES
+ADAPTIVE_MIN_SAMPLES = 20
+# chunk sizes are rounded to multiples of this many samples
+ADAPTIVE_STEP_SAMPLES = 10
+# weight of the newest measurement in the running averages of CPU time and consumer delay
+ADAPTIVE_SMOOTHING = 0.2
+# the chunk size only changes once the wanted size differs from it by more than this fraction
+ADAPTIVE_HYSTERESIS = 0.2
+
+# Writer wavetable cache: steady outputs are copied out of tables holding a whole number of periods
+# Total size of the cached tables in bytes, the least recently used ones are dropped beyond it
+WAVETABLE_CACHE_BYTES = 32 * 1024 * 1024
+# Longest period-aligned table in samples, outputs that need a longer one are synthesized every time
+WAVETABLE_MAX_PERIOD = 200000
+
+# Writer Config "Static Output": chunks in a row with unchanged parameters before the device is left to
+# loop a period-aligned buffer on its own
+STATIC_SETTLE_CHUNKS = 3
+
+# Output queue of the writer thread (Writer Config "Target Latency"), see FillLevelController
+# Size of the device output buffer in chunks, the controller decides how much of it is kept queued
+WRITER_BUFFER_CHUNKS = 8
+# the worst wake up delay plus write time is taken over this many of the latest writes
+WRITER_JITTER_WINDOW = 100
+# the queue never drops below this multiple of that worst case
+WRITER_SAFETY_FACTOR = 2.0
+# every underflow adds a chunk of margin, this fraction of it is given back on every write
+WRITER_MARGIN_DECAY = 0.001
+# bins of the queued samples histogram, spread over the whole output buffer
+WRITER_FILL_BINS = 32
+
+# Waveform file playback (Writer Config "Waveform File"): chunks the read-ahead thread prepares ahead of the writer
+PLAYBACK_READ_AHEAD_CHUNKS = 4
+
+# Frequency sweep sources of the writer (Settings "Frequency Sweep"), see FrequencySweep
+SWEEP_TYPES = ["Linear Chirp", "Log Chirp", "Stepped"]
+
+# Field direction paths of the trajectory engine (Magnetic Controls "Field Trajectory"), see trajectory.py
+TRAJECTORY_PATHS = ["Grid Scan", "Spiral", "Precession"]
+
+# Closed loop output control (Settings "Feedback"), see FeedbackController
+# outputs whose set voltage is below this many volts are left alone, there is nothing to regulate against
+FEEDBACK_MIN_SETPOINT = 0.01
+# chunks with fewer samples per channel are skipped, too short to demodulate (a single sample has no window)
+FEEDBACK_MIN_SAMPLES = 16
+# the writer is only told about new trims (params_changed) once a voltage trim moved by more than this fraction
+# or a phase trim by more than this many degrees, eg. a static output isn't rebuilt for every tiny correction
+FEEDBACK_TRIM_THRESHOLD = 1e-3
+FEEDBACK_PHASE_THRESHOLD = 0.05
+
+# Trigger conditions of the TriggerEngine, evaluated on the trigger channel of the corrected data
+# Edge modes fire when the condition becomes true, level/window modes whenever it is true while armed
+TRIGGER_MODES = [
+    "Rising Edge",
+    "Falling Edge",
+    "Above Level",
+    "Below Level",
+    "Enter Window",
+    "Leave Window",
+    "Inside Window",
+    "Outside Window",
+]
+
+# Recorder: the recording file grows by this many bytes at a time
+RECORDER_EXTENT_SIZE = 64 * 1024 * 1024
+# Buffers per stream the recorder copies chunks into until they are written, new chunks get dropped when
+# every one of them is still waiting for the disk
+RECORDER_QUEUE_SIZE = 32
+
+# Number of rows kept by each metrics log (one row per chunk), oldest rows are overwritten
+METRICS_CAPACITY = 36000
@@ -0,0 +1,170 @@
+import numpy as np
+
+from config import CALIBRATION_MIN_SLOPE, DELAY_CORRECTION_MODES, DELAY_TABLE_POINTS
+
+CORRECTION_OFF, CORRECT_OUTPUTS, CORRECT_MEASUREMENTS = DELAY_CORRECTION_MODES
+
+
+class DelayCorrection:
+    """
+    Delay and frequency dependent phase lag of every output on its way to the inputs that measure it
+
+    The reader and writer tasks don't share a start trigger, so the time between an output sample leaving and
+    the input sampling it is only known up to an offset common to all of them. Everything is therefore
+    relative to the reference output (the output of the first connected input), which has no delay and no lag.
+    That is what the phases between outputs depend on, the shifts set in the channel parameters are relative
+    to each other as well.
+
+    lags are in degrees and follow the writer's shift convention: an output that lags by L degrees measures
+    like one shifted by its shift + L. The writer plays shift - L to make up for it (lags in the drive), or the
+    analysis takes L off the measured shift (lags in the sensing), a loopback can't tell which side it is on.
+
+    frequencies: (points,) Hz the table was measured at, in the band of the excitation
+    lags: (outputs x points) lag in degrees of every output at every frequency
+    delays: (inputs,) delay in seconds of every input from the correlation peak, relative to the reference
+    output_delays: (outputs,) mean delay of the connected inputs of every output, used outside the table
+    reference: index of the reference output
+    """
+
+    def __init__(self, frequencies, lags, delays, output_delays, reference=0):
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.lags = np.asarray(lags, dtype=np.float64)
+        self.delays = np.asarray(delays, dtype=np.float64)
+        self.output_delays = np.asarray(output_delays, dtype=np.float64)
+        self.reference = int(reference)
+
+    def lags_at(self, frequencies):
+        """
+        Lag of every output at its own frequency, interpolated in the table inside the measured band and
+        from the output's delay outside of it (0 at DC)
+
+        :param frequencies: frequency in Hz of every output
+        :return: (outputs,) lags in degrees
+        """
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        lags = 360 * frequencies * self.output_delays
+        inside = (frequencies >= self.frequencies[0]) & (frequencies <= self.frequencies[-1])
+        for ch in np.flatnonzero(inside):
+            lags[ch] = np.interp(frequencies[ch], self.frequencies, self.lags[ch])
+        return lags
+
+    def to_dict(self):
+        """
+        JSON serializable form, eg. for the metadata of a recording
+        """
+        return {
+            "frequencies": self.frequencies.tolist(),
+            "lags": self.lags.tolist(),
+            "delays": self.delays.tolist(),
+            "output_delays": self.output_delays.tolist(),
+            "reference": self.reference,
+        }
+
+    def save(self, path):
+        np.savez(path, **self.to_dict())
+        print("Saved delay correction to", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as table:
+            return cls(table["frequencies"], table["lags"], table["delays"], table["output_delays"],
+                       table["reference"])
+
+
+def measure_delays(excitation, responses, assigned_output, sample_rate, band, num_points=DELAY_TABLE_POINTS):
+    """
+    Delay and phase lag of every output from one period of a periodic broadband excitation and the same
+    period as measured on the inputs (averaged over many periods for the noise)
+
+    The circular cross-correlation of every input with its output is computed through the FFT, its peak
+    (refined to a fraction of a sample by a parabola through the neighbouring lags) gives the delay. The cross
+    spectrum over the excitation's spectrum is the transfer function of every pair; those of the connected
+    inputs of an output are averaged, taken relative to the reference output and averaged into num_points
+    bands of the excitation's band. The delay is divided out before averaging so the phase doesn't wrap.
+
+    :param excitation: (outputs x samples) one period of what the outputs played
+    :param responses: (inputs x samples) the same period on the inputs
+    :param assigned_output: index of the output every input measures
+    :param sample_rate: samples per second of both
+    :param band: (low, high) frequencies in Hz the excitation covers
+    :param num_points: number of frequencies in the table
+    :return: (DelayCorrection, (inputs,) bool array of the connected inputs)
+    """
+    num_inputs, num_samples = responses.shape
+    num_outputs = excitation.shape[0]
+    outputs = np.asarray(assigned_output[:num_inputs])
+
+    spectra = np.fft.rfft(excitation, axis=1)
+    cross = np.fft.rfft(responses, axis=1) * np.conj(spectra[outputs])
+    frequencies = np.fft.rfftfreq(num_samples, 1 / sample_rate)
+    in_band = (frequencies >= band[0]) & (frequencies <= band[1])
+    power = np.abs(spectra[:, in_band]) ** 2
+    np.maximum(power, power.max() * 1e-12, out=power)
+    # transfer function of every pair, inputs that barely follow their output are not connected
+    transfer = cross[:, in_band] / power[outputs]
+    connected = np.abs(transfer).mean(axis=1) >= CALIBRATION_MIN_SLOPE
+    if not connected.any():
+        raise ValueError("No input follows its output, check the loopback wiring")
+
+    correlation = np.abs(np.fft.irfft(cross, num_samples, axis=1))
+    rows = np.arange(num_inputs)
+    peaks = correlation.argmax(axis=1)
+    before = correlation[rows, peaks - 1]
+    peak = correlation[rows, peaks]
+    after = correlation[rows, (peaks + 1) % num_samples]
+    curvature = before - 2 * peak + after
+    fractions = np.zeros(num_inputs)
+    np.divide(0.5 * (before - after), curvature, out=fractions, where=curvature != 0)
+    # lags past half the period are negative delays
+    lags = (peaks + fractions + num_samples / 2) % num_samples - num_samples / 2
+    delays = lags / sample_rate
+
+    average = np.zeros((num_outputs, num_inputs))
+    average[outputs[connected], rows[connected]] = 1
+    counts = average.sum(axis=1, keepdims=True)
+    np.divide(average, counts, out=average, where=counts > 0)
+    measured = counts[:, 0] > 0
+    reference = outputs[np.argmax(connected)]
+
+    output_delays = average @ delays
+    delays -= output_delays[reference]
+    output_delays = np.where(measured, output_delays - output_delays[reference], 0)
+
+    band_frequencies = frequencies[in_band]
+    transfers = average @ transfer
+    relative = transfers * np.conj(transfers[reference])
+    # take the delay out so that what is left only turns slowly with frequency
+    relative *= np.exp(2j * np.pi * np.multiply.outer(output_delays, band_frequencies))
+    points = np.array_split(np.arange(len(band_frequencies)), num_points)
+    table_frequencies = np.array([band_frequencies[p].mean() for p in points])
+    residuals = np.column_stack([relative[:, p].mean(axis=1) for p in points])
+    table_lags = 360 * np.multiply.outer(output_delays, table_frequencies) - np.degrees(np.angle(residuals))
+    table_lags[~measured] = 0
+
+    return DelayCorrection(table_frequencies, table_lags, delays, output_delays, reference), connected
+
+
+if __name__ == "__main__":
+    print("\nRunning demo for measure_delays\n")
+    import time
+
+    from sweep import FrequencySweep
+
+    rate, period = 10000, 10000
+    sweep = FrequencySweep([1, 1, 1], [0, 0, 0], 10, 2000, period / rate, repeat=True)
+    excitation = sweep.fill(np.empty((3, period)), rate)
+    # Y arrives 1.25 samples after X, Z 3 samples after and through a 1 ms low pass
+    spectra = np.fft.rfft(excitation, axis=1)
+    frequencies = np.fft.rfftfreq(period, 1 / rate)
+    delays = np.array([0, 1.25, 3]) / rate
+    spectra *= np.exp(-2j * np.pi * np.multiply.outer(delays, frequencies))
+    spectra[2] /= 1 + 2j * np.pi * frequencies * 0.001
+    outputs = np.fft.irfft(spectra, period, axis=1)
+    responses = outputs[[0, 0, 1, 1, 2]] + np.random.normal(0, 0.01, (5, period))
+
+    start = time.perf_counter()
+    correction, connected = measure_delays(excitation, responses, [0, 0, 1, 1, 2], rate, (10, 2000))
+    print("Took", round((time.perf_counter() - start) * 1000, 1), "ms")
+    print("Delays (samples):", (correction.delays * rate).round(3))
+    print("Lags at 100 Hz:", correction.lags_at([100, 100, 100]).round(2),
+          "expected", (360 * 100 * delays + np.degrees(np.arctan(2 * np.pi * 100 * 0.001)) * np.array([0, 0, 1])).round(2))
@@ -0,0 +1,297 @@
+import time
+
+import numpy as np
+from PyQt5 import QtCore
+
+from config import FEEDBACK_MIN_SAMPLES, FEEDBACK_MIN_SETPOINT, FEEDBACK_PHASE_THRESHOLD, FEEDBACK_TRIM_THRESHOLD
+from metrics import MetricsLog
+
+
+def pi_update(error, integral, output, center, kp, ki, limit, max_step, active):
+    """
+    One step of a PI loop for every channel at once, in place
+
+    The output goes to center + kp * error + integral, clipped to center +- limit and moved by at most
+    max_step per step. Anti-windup: whenever the clip or the rate limit holds the output back, the integral
+    is set to what the output actually reached instead of growing further.
+
+    :param error: error of every channel
+    :param integral: integral term of every channel, updated in place
+    :param output: output of every channel, updated in place
+    :param center: output with no error and nothing integrated
+    :param kp: proportional gain
+    :param ki: integral gain, fraction of the error added to the integral every step
+    :param limit: largest distance of the output from center
+    :param max_step: largest change of the output in one step
+    :param active: channels to update, the others hold their integral and output
+    """
+    advanced = integral + ki * error
+    wanted = center + kp * error + advanced
+    step = np.clip(wanted, center - limit, center + limit) - output
+    np.clip(step, -max_step, max_step, out=step)
+    np.add(output, step, out=output, where=active)
+
+    held = output != wanted
+    np.copyto(integral, np.where(held, output - center - kp * error, advanced), where=active)
+
+
+class FeedbackController(QtCore.QObject):
+    """
+    Regulates the output amplitudes, and optionally the phases, on what the inputs measure
+
+    Every corrected chunk from the CalibrationWindow is demodulated at the frequency of the output each input is assigned to
+    (assigned_output, as set up in the calibration window): one pass multiplies all channels with a
+    preallocated Hann windowed reference table and sums them, giving the amplitude and phase of every
+    input, and the inputs of the same output are averaged. The measured RMS (the level at 0 Hz) is compared
+    with sense_gain times the set voltage and a PI loop moves the writer's voltage_trims to close the gap.
+    With control_phase set the phases of the outputs relative to the first regulated one are brought to
+    the set relative shifts through shift_trims the same way. Both loops are clipped to max_trim/
+    max_phase_trim with anti-windup and move by at most max_step/max_phase_step per update.
+    Chunks that started before the last correction was fully on the outputs are skipped, so the loops
+    only ever act on the effect of their previous correction and the dead time can't make them overshoot.
+    So are chunks shorter than FEEDBACK_MIN_SAMPLES. The writer's params_changed() is only called once the
+    trims moved by more than FEEDBACK_TRIM_THRESHOLD/FEEDBACK_PHASE_THRESHOLD since it was last called.
+
+    With a phase_correction (DelayCorrection) the lags of the sensing are taken off the measured phases
+    before they are compared, leave it None when the writer corrects its outputs for them instead.
+
+    Only the sine/DC outputs are regulated, the trims are held while the writer plays a source.
+
+    The latency of every update is logged to metrics:
+    chunk_age_ms: time from the chunk being emitted to it reaching the controller
+    compute_ms: time spent demodulating and updating the loops
+    interval_ms: time since the previous update
+    loop_delay_ms: dead time around the loop, from the middle of the measured chunk through the chunk age,
+                   the computation and the writer's output latency until the correction is on the outputs
+    bandwidth_hz: what the loop can follow, every update removes kp + ki of the error so its time constant
+                  is tau = interval / -ln(1 - (kp + ki)), giving 1 / (2 pi tau), at most half the update rate.
+                  As chunks are skipped until the last correction came through, interval is at least the
+                  loop delay plus a chunk
+    max_error: largest relative amplitude error of the regulated outputs
+    """
+
+    def __init__(self, writer, sample_rate, assigned_output, kp=0.3, ki=0.4, sense_gain=1.0, max_trim=0.5,
+                 max_step=0.05, control_phase=False, max_phase_trim=45.0, max_phase_step=5.0):
+        """
+        :param writer: SignalGeneratorBase whose trims are regulated
+        :param sample_rate: samples per second of the input chunks
+        :param assigned_output: index of the output every input measures, shared with the CalibrationWindow
+        :param kp: proportional gain on the relative amplitude and the phase errors
+        :param ki: integral gain, fraction of the error integrated on every update
+        :param sense_gain: input volts measured per output volt when the output is right
+        :param max_trim: largest fraction the voltages are trimmed by
+        :param max_step: largest change of the voltage trims per chunk
+        :param control_phase: also regulate the relative phases
+        :param max_phase_trim: largest phase trim in degrees
+        :param max_phase_step: largest change of the phase trims per chunk in degrees
+        """
+        super().__init__()
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.assigned_output = assigned_output
+        self.kp = kp
+        self.ki = ki
+        self.sense_gain = sense_gain
+        self.max_trim = max_trim
+        self.max_step = max_step
+        self.control_phase = control_phase
+        self.max_phase_trim = max_phase_trim
+        self.max_phase_step = max_phase_step
+
+        self.enabled = False
+        self.phase_correction = None
+
+        num_outputs = writer.num_channels
+        self.voltage_integral = np.zeros(num_outputs)
+        self.shift_integral = np.zeros(num_outputs)
+        # trims at the last params_changed() call
+        self.signalled_voltage_trims = np.ones(num_outputs)
+        self.signalled_shift_trims = np.zeros(num_outputs)
+        # reference table and averaging matrix with what they were built for
+        self.table = None
+        self.table_key = None
+        self.average = None
+        self.average_key = None
+
+        self.metrics = MetricsLog(
+            ["updates", "chunk_age_ms", "compute_ms", "interval_ms", "loop_delay_ms", "bandwidth_hz", "max_error"]
+        )
+        self.updates = 0
+        self.last_update = None
+        # perf_counter time the last correction is fully on the outputs, chunks measured before are skipped
+        self.settled_at = 0.0
+
+    def enable(self, enabled):
+        """
+        Start or stop regulating, stopping drops the trims so the outputs are open loop again
+        """
+        self.enabled = enabled
+        if not enabled:
+            self.reset()
+
+    def reset(self):
+        """
+        Drop the trims and wait for the outputs to settle before regulating again, eg. when the output starts
+        """
+        self.writer.voltage_trims[:] = 1
+        self.writer.shift_trims[:] = 0
+        self.voltage_integral[:] = 0
+        self.shift_integral[:] = 0
+        self.last_update = None
+        self.settled_at = time.perf_counter() + self.writer.output_latency()
+        self.signal_trims(force=True)
+
+    def signal_trims(self, force=False):
+        """
+        Call the writer's params_changed() if a trim moved by more than the thresholds since the last call
+
+        :param force: call it anyway
+        :return: True if it was called
+        """
+        writer = self.writer
+        if not force and \
+                np.abs(writer.voltage_trims - self.signalled_voltage_trims).max() <= FEEDBACK_TRIM_THRESHOLD and \
+                np.abs(writer.shift_trims - self.signalled_shift_trims).max() <= FEEDBACK_PHASE_THRESHOLD:
+            return False
+        np.copyto(self.signalled_voltage_trims, writer.voltage_trims)
+        np.copyto(self.signalled_shift_trims, writer.shift_trims)
+        writer.params_changed()
+        return True
+
+    def prepare(self, num_inputs, num_samples, frequencies):
+        """
+        Rebuild the reference table and the averaging matrix when what they depend on changed
+
+        :param frequencies: frequency in Hz of every input's output
+        """
+        outputs = tuple(self.assigned_output[:num_inputs])
+        if self.average_key != outputs:
+            self.average = np.zeros((self.writer.num_channels, num_inputs))
+            self.average[list(outputs), np.arange(num_inputs)] = 1
+            counts = self.average.sum(axis=1, keepdims=True)
+            np.divide(self.average, counts, out=self.average, where=counts > 0)
+            self.average_key = outputs
+
+        key = (tuple(frequencies), num_samples, self.sample_rate)
+        if self.table_key != key:
+            # periodic Hann window, leaks less than np.hanning when the chunk holds whole periods
+            window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(num_samples) / num_samples)
+            turns = np.multiply.outer(frequencies, np.arange(num_samples) / self.sample_rate)
+            # sum(window) normalizes a DC level to itself, twice that a sine to its amplitude
+            scale = np.where(np.equal(frequencies, 0), 1, 2) / window.sum()
+            self.table = np.exp(-2j * np.pi * turns) * window * scale[:, None]
+            self.table_key = key
+
+    def on_new_data(self, chunk):
+        """
+        Demodulate one chunk of input data and update the trims
+        """
+        start = time.perf_counter()
+        num_samples = chunk.num_samples
+        # the chunk has to be measured after the last correction took effect, otherwise the loop would
+        # correct the same error again for every chunk that is still on its way
+        measured_from = chunk.timestamp - num_samples / self.sample_rate
+        if not self.enabled or not self.writer.is_running or self.writer.source is not None or \
+                num_samples < FEEDBACK_MIN_SAMPLES or measured_from < self.settled_at:
+            chunk.release()
+            return
+        volts = chunk.data
+        num_inputs = min(chunk.num_channels, len(self.assigned_output))
+        chunk_age = start - chunk.timestamp
+
+        writer = self.writer
+        frequencies = np.asarray(writer.frequencies, dtype=np.float64)
+        input_frequencies = frequencies[list(self.assigned_output[:num_inputs])]
+        self.prepare(num_inputs, num_samples, input_frequencies)
+        # complex amplitude of every input, then of every output
+        inputs = np.einsum("ij,ij->i", volts[:num_inputs], self.table)
+        chunk.release()
+        outputs = self.average @ inputs
+
+        voltages = np.asarray(writer.voltages, dtype=np.float64)
+        output_dc = np.equal(frequencies, 0)
+        setpoints = self.sense_gain * np.where(output_dc, voltages, np.abs(voltages))
+        measured = np.where(output_dc, outputs.real, np.abs(outputs) / np.sqrt(2))
+        active = (
+            np.asarray(writer.output_states, dtype=bool)
+            & (np.abs(voltages) > FEEDBACK_MIN_SETPOINT)
+            & (self.average.sum(axis=1) > 0)
+        )
+        errors = np.zeros(len(voltages))
+        np.divide(setpoints - measured, setpoints, out=errors, where=active)
+
+        pi_update(errors, self.voltage_integral, writer.voltage_trims, 1.0, self.kp, self.ki,
+                  self.max_trim, self.max_step, active)
+
+        if self.control_phase:
+            # the phase of an output that is barely measured is noise
+            measured_active = active & ~output_dc & (measured > self.sense_gain * FEEDBACK_MIN_SETPOINT)
+            self.update_phases(outputs, voltages, frequencies, measured_active)
+        self.signal_trims()
+
+        now = time.perf_counter()
+        self.settled_at = now + writer.output_latency()
+        compute_time = now - start
+        duration = num_samples / self.sample_rate
+        interval = duration if self.last_update is None else now - self.last_update
+        self.last_update = now
+        loop_delay = duration / 2 + chunk_age + compute_time + writer.output_latency()
+        bandwidth = 1 / (2 * interval)
+        if 0 < self.kp + self.ki < 1:
+            bandwidth = min(bandwidth, -np.log(1 - self.kp - self.ki) / (2 * np.pi * interval))
+        self.updates += 1
+        self.metrics.append(
+            self.updates, chunk_age * 1000, compute_time * 1000, interval * 1000, loop_delay * 1000,
+            bandwidth, np.abs(errors).max(),
+        )
+
+    def update_phases(self, outputs, voltages, frequencies, active):
+        """
+        Bring the phases of the outputs relative to the first active one to the set relative shifts
+        The outputs on another frequency than that one are left alone
+        """
+        if not active.any():
+            return
+        reference = np.argmax(active)
+        active = active & (frequencies == frequencies[reference])
+        active[reference] = False
+        # a negative voltage is half a turn of phase
+        set_shifts = np.asarray(self.writer.shifts, dtype=np.float64) + np.where(voltages < 0, 180, 0)
+        # shifts delay the output, so they are the negative of the measured phase
+        measured_shifts = -np.degrees(np.angle(outputs))
+        if self.phase_correction is not None:
+            measured_shifts -= self.phase_correction.lags_at(frequencies)
+        errors = (set_shifts - set_shifts[reference]) - (measured_shifts - measured_shifts[reference])
+        errors = (errors + 180) % 360 - 180
+        pi_update(errors, self.shift_integral, self.writer.shift_trims, 0.0, self.kp, self.ki,
+                  self.max_phase_trim, self.max_phase_step, active)
+
+
+if __name__ == "__main__":
+    print("\nRunning demo for FeedbackController\n")
+    from buffers import ChunkPool
+    from writer import SignalGeneratorBase
+
+    sample_rate, sample_size, frequency = 10000, 200, 250
+    writer = SignalGeneratorBase(
+        [1, 1, 1], [frequency] * 3, [0, 0, 0], [True, True, True], sample_rate, sample_size
+    )
+    writer.is_running = True
+    # the coils only pass on 80% of the drive and the Z coil lags by 20 degrees
+    gains, lags = np.array([0.8, 1.0, 1.0]), np.array([0.0, 0.0, 20.0])
+    controller = FeedbackController(writer, sample_rate, [0, 1, 2], control_phase=True)
+    controller.enable(True)
+    pool = ChunkPool(1, 3, sample_size)
+    t = np.arange(sample_size) / sample_rate
+    # stream in real time for 3 seconds, the controller waits for every correction to come through
+    for i in range(150):
+        time.sleep(sample_size / sample_rate)
+        writer.callback()
+        chunk = pool.acquire()
+        volts = writer.trimmed_voltages * gains * np.sqrt(2)
+        phases = 2 * np.pi * frequency * t[None, :] - np.radians(writer.trimmed_shifts + lags)[:, None]
+        chunk.data[:] = volts[:, None] * np.sin(phases)
+        chunk.timestamp = time.perf_counter()
+        controller.on_new_data(chunk)
+    print("Voltage trims", writer.voltage_trims.round(3), "Shift trims", writer.shift_trims.round(2))
+    print(controller.metrics.latest())
@@ -1,5 +1,8 @@
+import os
 import sys
+import time
 
+import numpy as np
 from PyQt5 import QtGui
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
@@ -9,6 +12,14 @@ from writer import *
 from parameters import *
 from plotter import *
 from calibration import *
+from recorder import *
+from trigger import *
+from playback import *
+from sweep import *
+from trajectory import *
+from buffers import ConsumerGate
+from feedback import *
+from delay import *
 
 
 class MainWindow(QMainWindow):
@@ -35,6 +46,20 @@ class MainWindow(QMainWindow):
             )
             for ch in CHANNEL_NAMES_IN
         ]
+        saved_gains = [
+            self.setting_param_tree.get_param_value(
+                "Reader Config", "Calibration Gains", ch
+            )
+            for ch in CHANNEL_NAMES_IN
+        ]
+        delay_correction = None
+        if os.path.exists(DELAY_CORRECTION_FILE):
+            try:
+                delay_correction = DelayCorrection.load(DELAY_CORRECTION_FILE)
+                print("Loaded delay correction from", DELAY_CORRECTION_FILE)
+            except (OSError, KeyError, ValueError) as e:
+                print("Could not load the delay correction")
+                print(e)
         if DEBUG_MODE:
             self.calibration_dialog = CalibrationWindow(
                 parent=self,
@@ -43,6 +68,8 @@ class MainWindow(QMainWindow):
                 write_channels=self.setting_param_tree.get_write_channels(),
                 read_channels=self.setting_param_tree.get_read_channels(),
                 saved_offsets=saved_offsets,
+                saved_gains=saved_gains,
+                delay_correction=delay_correction,
             )
             self.writer.incoming_data.connect(
                 self.calibration_dialog.apply_calibration)
@@ -55,21 +82,62 @@ class MainWindow(QMainWindow):
                 write_channels=self.setting_param_tree.get_write_channels(),
                 read_channels=self.setting_param_tree.get_read_channels(),
                 saved_offsets=saved_offsets,
+                saved_gains=saved_gains,
+                delay_correction=delay_correction,
             )
             self.read_thread.incoming_data.connect(
                 self.calibration_dialog.apply_calibration
             )
 
+        # the plot only gets a display resolution envelope, the legend still gets every sample
         self.calibration_dialog.corrected_data.connect(
-            self.plotter.update_plot)
+            self.decimator.on_new_data)
+        self.decimator.decimated_data.connect(self.plotter.update_plot)
+        self.plotter.width_changed.connect(self.decimator.set_num_bins)
         self.calibration_dialog.corrected_data.connect(self.legend.on_new_data)
         self.calibration_dialog.offsets_received.connect(
             self.setting_param_tree.save_offsets
         )
+        self.calibration_dialog.gains_received.connect(
+            self.setting_param_tree.save_gains
+        )
+        self.calibration_dialog.sweep_running.connect(self.on_calibration_sweep)
         self.calibration_dialog.show()
 
+        # captures the window around trigger events out of the corrected stream
+        self.trigger = TriggerEngine()
+        self.capture_message = ""
+        self.update_trigger_settings()
+        self.calibration_dialog.corrected_data.connect(self.trigger.on_new_data)
+        self.trigger.captured.connect(self.on_capture)
+
+        # regulates the outputs on the inputs assigned to them in the calibration window
+        raw_source = self.writer if DEBUG_MODE else self.read_thread
+        self.feedback = FeedbackController(
+            self.writer, raw_source.sample_rate, self.calibration_dialog.assigned_output
+        )
+        self.update_feedback_settings()
+        self.calibration_dialog.corrected_data.connect(self.feedback.on_new_data)
+        self.update_delay_correction()
+        self.calibration_dialog.delays_received.connect(self.on_delays_received)
+
+        self.recorder = None
+        # direct connection so the reader thread queues the chunk itself without waiting on the GUI
+        self.raw_recording = ConsumerGate(raw_source.incoming_data, Qt.DirectConnection)
+        self.corrected_recording = ConsumerGate(self.calibration_dialog.corrected_data)
+
+        # refresh the acquisition health in the status bar a few times a second
+        self.status_timer = QTimer()
+        self.status_timer.timeout.connect(self.update_status_bar)
+        self.status_timer.start(500)
+        if not DEBUG_MODE:
+            self.read_thread.read_error.connect(self.on_read_error)
+
         # Connect the output signal from changes in the param tree to change
         self.start_signal_btn.clicked.connect(self.start_signal_btn_click)
+        self.record_btn.clicked.connect(self.record_btn_click)
+        self.export_metrics_btn.clicked.connect(self.export_metrics_btn_click)
+        self.arm_trigger_btn.clicked.connect(self.arm_trigger_btn_click)
         self.save_settings_btn.clicked.connect(self.commit_settings_btn_click)
         self.tabs.currentChanged.connect(self.on_tab_change)
 
@@ -99,23 +167,37 @@ class MainWindow(QMainWindow):
         # TODO: update legend frequency on startup with param tree values
         #   use signals instead of passing in legend might be better
         self.plotter = SignalPlot(self.legend)
+        self.decimator = EnvelopeDecimator()
         # self.plotter.setMaximumSize(800, 360)
 
         self.start_signal_btn = QPushButton("Press to start signal out")
+        self.record_btn = QPushButton("Press to start recording")
 
         # self.channel_param_tree.setMinimumSize(100, 200)
 
         self.settings_tab = QWidget(self)
         self.settings_tab.layout = QVBoxLayout(self)
         self.save_settings_btn = QPushButton("Commit Settings")
+        self.export_metrics_btn = QPushButton("Export Acquisition Metrics")
         self.settings_tab.layout.addWidget(self.setting_param_tree)
         self.settings_tab.layout.addWidget(self.save_settings_btn)
+        self.settings_tab.layout.addWidget(self.export_metrics_btn)
         self.settings_tab.setLayout(self.settings_tab.layout)
 
+        # last triggered capture, x axis in samples relative to the trigger
+        self.capture_tab = QWidget(self)
+        self.capture_tab.layout = QVBoxLayout(self)
+        self.capture_plot = SignalPlot(self.legend)
+        self.arm_trigger_btn = QPushButton("Arm Trigger")
+        self.capture_tab.layout.addWidget(self.capture_plot)
+        self.capture_tab.layout.addWidget(self.arm_trigger_btn)
+        self.capture_tab.setLayout(self.capture_tab.layout)
+
         self.tabs = QTabWidget(self)
         self.tabs.addTab(self.magnetic_param_tree, "Magnetic Controls")
         self.tabs.addTab(self.channel_param_tree, "Channels Controls")
         self.tabs.addTab(self.settings_tab, "DAQ Settings")
+        self.tabs.addTab(self.capture_tab, "Trigger Capture")
         self.current_tab = 0
         self.tabs.setCurrentIndex(self.current_tab)
 
@@ -124,6 +206,7 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.plotter)
         layout.addWidget(self.legend)
         layout.addWidget(self.start_signal_btn)
+        layout.addWidget(self.record_btn)
         # layout.addWidget(self.setting_param_tree, 3, 1, 1, 1)
         layout.addWidget(self.tabs)
 
@@ -175,14 +258,27 @@ class MainWindow(QMainWindow):
                     "Reader Config", "Sample Size"
                 ),
                 channels=self.setting_param_tree.get_read_channels(),
-                dev_name=self.setting_param_tree.get_param_value(
-                    "Reader Config", "Device Name"
+                dev_name=self.setting_param_tree.get_read_devices(),
+                mode=self.setting_param_tree.get_param_value(
+                    "Reader Config", "Acquisition Mode"
+                ),
+                raw=self.setting_param_tree.get_param_value(
+                    "Reader Config", "Raw Samples"
                 ),
             )
+            self.read_thread.adaptive = self.setting_param_tree.get_param_value(
+                "Reader Config", "Adaptive Chunk Size"
+            )
+            self.read_thread.chunk_size.target_latency = (
+                self.setting_param_tree.get_param_value("Reader Config", "Target Latency") / 1000
+            )
+            self.read_thread.chunk_size.cpu_budget = (
+                self.setting_param_tree.get_param_value("Reader Config", "CPU Budget") / 100
+            )
             self.read_thread.start()
 
             # initiate writer for analog output
-            # not handled on separate thread b/c not blocking
+            # writes from a thread of its own once create_task() is called
 
             self.writer = SignalWriterDAQ(
                 voltages=voltages,
@@ -200,7 +296,15 @@ class MainWindow(QMainWindow):
                     "Writer Config", "Device Name"
                 ),
             )
+            self.writer.static_output = self.setting_param_tree.get_param_value(
+                "Writer Config", "Static Output"
+            )
+            self.writer.fill_level.target_latency = (
+                self.setting_param_tree.get_param_value("Writer Config", "Target Latency") / 1000
+            )
             self.writer.create_task()
+            # tag the input chunks with the sweep frequency they were measured at
+            self.read_thread.frequency_source = self.writer.frequency_at
 
         # Debugging on computer without NI instrument
         else:
@@ -220,6 +324,11 @@ class MainWindow(QMainWindow):
                 ),
             )
 
+        self.update_waveform_source()
+        self.writer.oscillators.ramp_time = (
+            self.setting_param_tree.get_param_value("Writer Config", "Ramp Time") / 1000
+        )
+
         # pass initialized writer so the magnetic manipulators can use it when it needs to
         self.mag_alignment = MagneticAlignment(
             writer=self.writer,
@@ -271,6 +380,9 @@ class MainWindow(QMainWindow):
                 "3D Rotation", "Coefficients", "kz"
             ),
         )
+        # cross coupling and phase lags of the coils
+        self.update_coupling(self.mag_alignment, "3D Alignment")
+        self.update_coupling(self.mag_rotation, "3D Rotation")
 
     @pyqtSlot()
     def start_signal_btn_click(self):
@@ -292,9 +404,232 @@ class MainWindow(QMainWindow):
                 self.writer.resume()
             if self.current_tab == 1:
                 self.writer.resume()
+            # open loop again until the new outputs have reached the inputs
+            self.feedback.reset()
 
+            if self.setting_param_tree.get_param_value("Trigger Config", "Trigger On Signal Start"):
+                self.trigger.arm()
+                self.trigger.force()
+                self.arm_trigger_btn.setText("Disarm Trigger")
             self.start_signal_btn.setText("Press to pause signal")
 
+    @pyqtSlot()
+    def record_btn_click(self):
+        """
+        Start or stop recording the raw and corrected data to disk
+        A new file with the current time appended to the configured file name is created on every start
+        """
+        if self.recorder is not None:
+            self.stop_recording()
+            self.record_btn.setText("Press to start recording")
+            return
+
+        name, ext = os.path.splitext(
+            self.setting_param_tree.get_param_value("Recorder Config", "File Name")
+        )
+        path = name + time.strftime("_%Y%m%d_%H%M%S") + ext
+        metadata = self.setting_param_tree.get_recording_metadata()
+        if not DEBUG_MODE and self.read_thread.scaling is not None:
+            # raw records are int16 counts, volts = sum(c[k] * counts^k) per channel
+            metadata["scaling_coefficients"] = self.read_thread.scaling.tolist()
+        if self.calibration_dialog.delay_correction is not None:
+            metadata["delay_correction"] = self.calibration_dialog.delay_correction.to_dict()
+            metadata["delay_correction_mode"] = self.setting_param_tree.get_param_value(
+                "Delay Correction", "Apply To"
+            )
+        self.recorder = SignalRecorder(path, metadata)
+        self.recorder.start()
+
+        if self.setting_param_tree.get_param_value("Recorder Config", "Record Raw"):
+            self.raw_recording.open(self.recorder.on_raw_data)
+        if self.setting_param_tree.get_param_value("Recorder Config", "Record Corrected"):
+            self.corrected_recording.open(self.recorder.on_corrected_data)
+        print("Recording to", path)
+        self.record_btn.setText("Press to stop recording")
+
+    def stop_recording(self):
+        """
+        Close the recorder's gates on the data sources and wait for it to finish writing
+        """
+        self.raw_recording.close()
+        self.corrected_recording.close()
+        self.recorder.stop()
+        self.recorder = None
+
+    def update_status_bar(self):
+        """
+        Show the latest reader health metrics in the status bar
+        """
+        if DEBUG_MODE:
+            self.statusBar().showMessage(
+                " | ".join(filter(None, ["Debug mode: plotting the simulated output", self.capture_message]))
+            )
+            return
+
+        latest = self.read_thread.metrics.latest()
+        if latest is None or not self.read_thread.is_running:
+            return
+        output = self.writer.metrics.latest()
+        if output is not None:
+            output = "Output queue {:.0f} samples | Underflows {:.0f}".format(
+                output["queued_samples"], output["underflows"]
+            )
+        feedback = self.feedback.metrics.latest()
+        if feedback is not None and self.feedback.enabled:
+            output = (output + " | " if output else "") + \
+                "Feedback error {:.1%} | Loop delay {:.0f} ms | Bandwidth {:.2f} Hz".format(
+                    feedback["max_error"], feedback["loop_delay_ms"], feedback["bandwidth_hz"]
+                )
+        self.statusBar().showMessage(
+            "Chunk {:.0f} | Backlog {:.0f} samples | Read {:.1f} ms | Interval {:.1f} ms | "
+            "Lag {:.0f} chunks | Dropped {:.0f} | Chunk {:.0f} samples".format(
+                latest["seq"],
+                latest["backlog_samples"],
+                latest["read_ms"],
+                latest["emit_interval_ms"],
+                latest["consumer_lag_chunks"],
+                latest["dropped_chunks"],
+                latest["chunk_samples"],
+            )
+            + (" | " + output if output else "")
+            + (" | " + self.capture_message if self.capture_message else "")
+        )
+
+    def update_trigger_settings(self):
+        """
+        Apply the Trigger Config to the trigger engine, takes effect on the next chunk
+        """
+        settings = self.setting_param_tree
+        self.trigger.channel = CHANNEL_NAMES_IN.index(
+            settings.get_param_value("Trigger Config", "Channel")
+        )
+        self.trigger.mode = settings.get_param_value("Trigger Config", "Mode")
+        self.trigger.level = settings.get_param_value("Trigger Config", "Level")
+        self.trigger.window = (
+            settings.get_param_value("Trigger Config", "Window Low"),
+            settings.get_param_value("Trigger Config", "Window High"),
+        )
+        self.trigger.rearm = settings.get_param_value("Trigger Config", "Re-Arm")
+        pre_samples = settings.get_param_value("Trigger Config", "Pre-Trigger Samples")
+        post_samples = settings.get_param_value("Trigger Config", "Post-Trigger Samples")
+        if (pre_samples, post_samples) != (self.trigger.pre_samples, self.trigger.post_samples):
+            self.trigger.set_spans(pre_samples, post_samples)
+
+    def update_feedback_settings(self):
+        """
+        Apply the Feedback settings to the feedback controller, takes effect on the next chunk
+        """
+        def setting(name):
+            return self.setting_param_tree.get_param_value("Feedback", name)
+
+        self.feedback.control_phase = setting("Control Phase")
+        self.feedback.sense_gain = setting("Sense Gain")
+        self.feedback.kp = setting("Proportional Gain")
+        self.feedback.ki = setting("Integral Gain")
+        self.feedback.max_trim = setting("Max Trim") / 100
+        self.feedback.max_step = setting("Max Trim Step") / 100
+        self.feedback.max_phase_trim = setting("Max Phase Trim")
+        self.feedback.max_phase_step = setting("Max Phase Step")
+        if not self.feedback.control_phase:
+            self.writer.shift_trims[:] = 0
+            self.feedback.shift_integral[:] = 0
+        if setting("Enable") != self.feedback.enabled:
+            self.feedback.enable(setting("Enable"))
+
+    @pyqtSlot(bool)
+    def on_calibration_sweep(self, running):
+        """
+        The feedback would fight the calibration levels, it is off while the sweep runs
+        """
+        if running:
+            self.feedback.enable(False)
+        else:
+            self.update_waveform_source()
+            self.update_feedback_settings()
+
+    def update_delay_correction(self):
+        """
+        Apply the measured delay correction to the outputs or to the measured phases, as set in the settings
+        """
+        mode = self.setting_param_tree.get_param_value("Delay Correction", "Apply To")
+        correction = self.calibration_dialog.delay_correction
+        if correction is None and mode != CORRECTION_OFF:
+            print("No delay correction measured yet, run Measure Delay in the calibration window")
+        self.writer.phase_correction = correction if mode == CORRECT_OUTPUTS else None
+        self.feedback.phase_correction = correction if mode == CORRECT_MEASUREMENTS else None
+        self.writer.params_changed()
+
+    @pyqtSlot(object)
+    def on_delays_received(self, correction):
+        correction.save(DELAY_CORRECTION_FILE)
+        self.update_delay_correction()
+
+    @pyqtSlot()
+    def arm_trigger_btn_click(self):
+        """
+        Arm the trigger for the next event or disarm it
+        """
+        if self.trigger.is_armed:
+            self.trigger.disarm()
+            self.arm_trigger_btn.setText("Arm Trigger")
+        else:
+            self.trigger.arm()
+            self.arm_trigger_btn.setText("Disarm Trigger")
+
+    def on_capture(self, capture, pre_samples):
+        """
+        Show the completed capture and save it when enabled
+        """
+        x = np.arange(capture.shape[1]) - pre_samples
+        self.capture_plot.update_plot(x, capture)
+        if not self.trigger.is_armed:
+            self.arm_trigger_btn.setText("Arm Trigger")
+
+        message = "Triggered on " + CHANNEL_NAMES_IN[self.trigger.channel] + time.strftime(" at %H:%M:%S")
+        if self.setting_param_tree.get_param_value("Trigger Config", "Save Captures"):
+            name, ext = os.path.splitext(
+                self.setting_param_tree.get_param_value("Trigger Config", "File Name")
+            )
+            path = name + time.strftime("_%Y%m%d_%H%M%S") + ext
+            if DEBUG_MODE:
+                sample_rate = self.writer.sample_rate
+            else:
+                sample_rate = self.read_thread.sample_rate
+            self.trigger.save_capture(path, sample_rate)
+            message += ", saved to " + path
+        # kept next to the reader health in the status bar
+        self.capture_message = message
+        self.update_status_bar()
+
+    def on_read_error(self, message):
+        """
+        Keep the reason the reader stopped visible in the status bar
+        """
+        self.status_timer.stop()
+        self.statusBar().showMessage("Reader stopped: " + message.splitlines()[0])
+
+    @pyqtSlot()
+    def export_metrics_btn_click(self):
+        """
+        Save the logged reader metrics to a CSV file, and the writer metrics, output queue histogram,
+        sweep frequencies and feedback latencies next to it
+        """
+        if DEBUG_MODE:
+            print("No reader metrics in debug mode")
+            return
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Export Acquisition Metrics", "reader_metrics.csv", "CSV (*.csv)"
+        )
+        if path:
+            self.read_thread.metrics.to_csv(path)
+            name, ext = os.path.splitext(path)
+            self.writer.metrics.to_csv(name + "_writer" + ext)
+            self.writer.fill_histogram.to_csv(name + "_writer_fill" + ext)
+            if self.writer.frequency_log.count:
+                self.writer.frequency_log.to_csv(name + "_sweep" + ext)
+            if self.feedback.metrics.count:
+                self.feedback.metrics.to_csv(name + "_feedback" + ext)
+
     @pyqtSlot()
     def commit_settings_btn_click(self):
         """
@@ -324,25 +659,75 @@ class MainWindow(QMainWindow):
             self.read_thread.input_channels = (
                 self.setting_param_tree.get_read_channels()
             )
+            self.read_thread.daq_in_name = self.setting_param_tree.get_read_devices()
             self.read_thread.sample_rate = reader_sample_rate
             self.read_thread.sample_size = reader_sample_size
+            self.read_thread.mode = self.setting_param_tree.get_param_value(
+                "Reader Config", "Acquisition Mode"
+            )
+            self.read_thread.raw = self.setting_param_tree.get_param_value(
+                "Reader Config", "Raw Samples"
+            )
 
             self.writer.sample_rate = writer_sample_rate
             self.writer.sample_size = writer_sample_size
+            self.feedback.sample_rate = reader_sample_rate
+            self.writer.static_output = self.setting_param_tree.get_param_value(
+                "Writer Config", "Static Output"
+            )
 
             # restart writer to update refresh times
             self.read_thread.restart()
             self.writer.pause()
+            self.update_waveform_source()
             self.writer.resume()
 
         else:
             self.writer.sample_rate = writer_sample_rate
             self.writer.sample_size = writer_sample_size
+            self.feedback.sample_rate = writer_sample_rate
+            self.update_waveform_source()
             # update refresh times in debug writer
             self.writer.pause()
             self.writer.resume()
             print("Restarted signal reader")
 
+    def update_waveform_source(self):
+        """
+        Play the frequency sweep when enabled, else the Writer Config waveform file, or the sine waves when
+        neither is set
+        """
+        settings = self.setting_param_tree
+        path = settings.get_param_value("Writer Config", "Waveform File")
+        try:
+            if settings.get_param_value("Frequency Sweep", "Enable"):
+                source = FrequencySweep(
+                    self.writer.voltages,
+                    self.writer.shifts,
+                    settings.get_param_value("Frequency Sweep", "Start Frequency"),
+                    settings.get_param_value("Frequency Sweep", "End Frequency"),
+                    settings.get_param_value("Frequency Sweep", "Duration"),
+                    sweep_type=settings.get_param_value("Frequency Sweep", "Type"),
+                    num_steps=settings.get_param_value("Frequency Sweep", "Steps"),
+                    repeat=settings.get_param_value("Frequency Sweep", "Repeat"),
+                )
+                self.writer.set_source(source)
+                print("Sweeping", source.sweep_type, source.start_frequency, "to", source.end_frequency, "Hz")
+                return
+            if path:
+                source = WaveformPlayback(
+                    path,
+                    settings.get_param_value("Writer Config", "Waveform Sample Rate"),
+                    loop=settings.get_param_value("Writer Config", "Loop Waveform"),
+                )
+                self.writer.set_source(source)
+                print("Playing", path, source.data.shape)
+                return
+        except (OSError, ValueError) as e:
+            print("Could not set up the output source, writing sine waves")
+            print(e)
+        self.writer.set_source(None)
+
     @pyqtSlot(int)
     def on_tab_change(self, t):
         """
@@ -377,6 +762,7 @@ class MainWindow(QMainWindow):
                 self.writer.shifts[i] = parent.child("Phase Shift").value()
         elif t == 2:
             pass
+        self.writer.params_changed()
 
     # TODO: 3D alignment will be changed to 3D Rotation when
     #       3D rotation param is changed, and vice versa
@@ -411,13 +797,7 @@ class MainWindow(QMainWindow):
                     self.mag_alignment.theta = data
                     self.mag_alignment.update_params()
                 elif path[1] == "Coefficients":
-                    print(path[2])
-                    if path[2] == "k" + CHANNEL_NAMES_OUT[0].lower():
-                        self.mag_alignment.kx = data
-                    if path[2] == "k" + CHANNEL_NAMES_OUT[1].lower():
-                        self.mag_alignment.ky = data
-                    if path[2] == "k" + CHANNEL_NAMES_OUT[2].lower():
-                        self.mag_alignment.kz = data
+                    self.update_coupling(self.mag_alignment, path[0])
                     self.mag_alignment.update_params()
 
             elif path[0] == "3D Rotation":
@@ -440,15 +820,70 @@ class MainWindow(QMainWindow):
                     self.mag_rotation.theta = data
                     self.mag_rotation.update_params()
                 elif path[1] == "Coefficients":
-                    print(path[2])
-                    if path[2] == "k" + CHANNEL_NAMES_OUT[0].lower():
-                        self.mag_rotation.kx = data
-                    if path[2] == "k" + CHANNEL_NAMES_OUT[1].lower():
-                        self.mag_rotation.ky = data
-                    if path[2] == "k" + CHANNEL_NAMES_OUT[2].lower():
-                        self.mag_rotation.kz = data
+                    self.update_coupling(self.mag_rotation, path[0])
                     self.mag_rotation.update_params()
 
+            elif path[0] == "Field Trajectory":
+                if path[1] == "Toggle Output" and not data:
+                    # back to the sweep, waveform file or sine waves
+                    self.update_waveform_source()
+                elif self.magnetic_param_tree.get_param_value("Field Trajectory", "Toggle Output"):
+                    self.start_trajectory()
+        self.writer.params_changed()
+
+    def update_coupling(self, control, name):
+        """
+        Load the coil coupling settings of a magnetic control into its CoilCoupling, which recomputes the
+        cached inverse
+
+        :param control: MagneticAlignment or MagneticRotation
+        :param name: its group in the magnetic param tree
+        """
+        coupling = self.magnetic_param_tree.get_coupling(name)
+        control.coupling.gains[:] = coupling["gains"]
+        control.coupling.cross[:] = coupling["cross"]
+        control.coupling.lags[:] = coupling["lags"]
+        control.coupling.update()
+
+    def start_trajectory(self):
+        """
+        Move the field of the chosen magnetic control along the Field Trajectory path, from its start
+        """
+        def setting(name):
+            return self.magnetic_param_tree.get_param_value("Field Trajectory", name)
+
+        if setting("Control") == "3D Alignment":
+            control = self.mag_alignment
+        else:
+            control = self.mag_rotation
+        name = setting("Path")
+        if name == GRID_SCAN:
+            settings = dict(
+                elevations=np.linspace(setting("Elevation Start"), setting("Elevation End"), setting("Grid Points")),
+                azimuths=np.linspace(setting("Azimuth Start"), setting("Azimuth End"), setting("Grid Points")),
+                dwell=setting("Dwell"),
+                transition=setting("Transition"),
+            )
+        elif name == SPIRAL:
+            settings = dict(
+                elevation_start=setting("Elevation Start"),
+                elevation_end=setting("Elevation End"),
+                turns=setting("Turns"),
+                duration=setting("Duration"),
+            )
+        else:
+            settings = dict(
+                axis_elevation=control.phi,
+                axis_azimuth=control.theta,
+                cone_angle=setting("Cone Angle"),
+                rate=setting("Precession Rate"),
+            )
+
+        control.update_params()
+        control.output_state = True
+        self.writer.set_source(FieldTrajectory(control, make_path(name, control.amplitude, **settings)))
+        print("Field trajectory:", name, "on", setting("Control"))
+
     def channels_param_change(self, parameter, changes):
         """
         Handles the actions whenever some param in the Individual Controls Tab has changed or is updated
@@ -471,22 +906,63 @@ class MainWindow(QMainWindow):
                 self.legend.legend_items[ch].frequency = data
             if path[1] == "Phase Shift":
                 self.writer.shifts[ch] = data
+        self.writer.params_changed()
 
     def settings_param_change(self, parameter, changes):
         """
         Handles the actions whenever some param in the Settings Tab has changed or is updated
-        Currently there is no need because the settings should only be applied when the "Commit Settings" button is pressed
-        
+        Most settings are only applied when the "Commit Settings" button is pressed,
+        the adaptive chunk size, writer latency, ramp time, calibration, feedback and trigger settings don't
+        need a restart and are applied right away
+
         :param parameter: the GroupParameter object that holds the Channel Params
         :param changes: list that contains [ParameterObject, 'value', data]
         """
-        pass
+        for param, change, data in changes:
+            path = self.setting_param_tree.params.childPath(param)
+            if path is None:
+                continue
+            if path[0] == "Trigger Config":
+                self.update_trigger_settings()
+                continue
+            if path[0] == "Feedback":
+                self.update_feedback_settings()
+                continue
+            if path[0] == "Delay Correction":
+                self.update_delay_correction()
+                continue
+            if path[:2] == ["Reader Config", "Calibration Gains"]:
+                self.calibration_dialog.gains[CHANNEL_NAMES_IN.index(path[2])] = data
+                continue
+            if path[:2] == ["Reader Config", "Calibration Offsets"]:
+                self.calibration_dialog.offsets[CHANNEL_NAMES_IN.index(path[2])] = data
+                continue
+            if path[:2] == ["Writer Config", "Ramp Time"]:
+                self.writer.oscillators.ramp_time = data / 1000
+                continue
+            if DEBUG_MODE:
+                continue
+            if path[0] == "Writer Config":
+                if path[1] == "Target Latency":
+                    self.writer.fill_level.target_latency = data / 1000
+                continue
+            if path[0] != "Reader Config":
+                continue
+            if path[1] == "Adaptive Chunk Size":
+                self.read_thread.adaptive = data
+            elif path[1] == "Target Latency":
+                self.read_thread.chunk_size.target_latency = data / 1000
+            elif path[1] == "CPU Budget":
+                self.read_thread.chunk_size.cpu_budget = data / 100
 
     def closeEvent(self, event):
         """
         When the application is closed
         """
         print("Closing...")
+        if self.recorder is not None:
+            self.stop_recording()
+
         if not DEBUG_MODE:
             self.read_thread.is_running = False
             self.read_thread.wait()
@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+
+from config import METRICS_CAPACITY
+
+
+class MetricsLog:
+    """
+    Fixed size log of numeric metric rows, one row per chunk/cycle
+    Rows are written into a preallocated ring so logging from the acquisition thread costs no allocation,
+    once full the oldest rows are overwritten. The first column is always the time in seconds since
+    the log was created.
+    """
+
+    def __init__(self, columns, capacity=METRICS_CAPACITY):
+        """
+        :param columns: names of the logged values, not including the time column
+        :param capacity: number of rows kept
+        """
+        self.columns = ["time_s"] + list(columns)
+        self.rows = np.zeros((capacity, len(self.columns)))
+        self.count = 0
+        self.start_time = time.perf_counter()
+
+    def append(self, *values):
+        """
+        Log one row, values are given in the order of the columns
+        """
+        row = self.rows[self.count % len(self.rows)]
+        row[0] = time.perf_counter() - self.start_time
+        row[1:] = values
+        self.count += 1
+
+    def latest(self):
+        """
+        :return: dict of the newest row by column name, None if nothing was logged yet
+        """
+        if self.count == 0:
+            return None
+        row = self.rows[(self.count - 1) % len(self.rows)]
+        return dict(zip(self.columns, row))
+
+    def history(self):
+        """
+        :return: copy of the logged rows in chronological order
+        """
+        if self.count <= len(self.rows):
+            return self.rows[: self.count].copy()
+        start = self.count % len(self.rows)
+        return np.concatenate((self.rows[start:], self.rows[:start]))
+
+    def to_csv(self, path):
+        """
+        Write the logged rows to a CSV file with a header row
+        """
+        np.savetxt(path, self.history(), delimiter=",", header=",".join(self.columns),
+                   comments="", fmt="%.6g")
+        print("Saved", min(self.count, len(self.rows)), "rows to", path)
+
+
+class Histogram:
+    """
+    Counts of a metric in equal width bins, updated once per chunk/cycle without allocating
+    Values below the first bin or beyond the last one are counted in those bins
+    """
+
+    def __init__(self, low, high, num_bins):
+        """
+        :param low: lower edge of the first bin
+        :param high: upper edge of the last bin
+        :param num_bins: number of bins
+        """
+        self.edges = np.linspace(low, high, num_bins + 1)
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+
+    def add(self, value):
+        num_bins = len(self.counts)
+        i = int((value - self.edges[0]) * num_bins / (self.edges[-1] - self.edges[0]))
+        self.counts[min(max(i, 0), num_bins - 1)] += 1
+
+    def to_csv(self, path):
+        """
+        Write the bins to a CSV file, one row per bin with its edges and count
+        """
+        rows = np.column_stack((self.edges[:-1], self.edges[1:], self.counts))
+        np.savetxt(path, rows, delimiter=",", header="low,high,count", comments="", fmt="%.6g")
+        print("Saved", len(self.counts), "bins to", path)
@@ -1,5 +1,10 @@
+from collections import OrderedDict
+from fractions import Fraction
+
 import numpy as np
 
+from config import WAVETABLE_CACHE_BYTES, WAVETABLE_MAX_PERIOD
+
 
 def calculate_rms_value(data, sample_rate, frequency):
     """
@@ -28,98 +33,429 @@ def calculate_rms_value(data, sample_rate, frequency):
     return rms
 
 
-# creates the sine wave to output
-class WaveGenerator:
+def scale_raw_samples(raw, coefficients, out):
+    """
+    Convert unscaled ADC counts into volts with the DAQ's per channel scaling polynomial
+    volts = c0 + c1 * raw + c2 * raw^2 + ... evaluated with Horner's method on whole arrays
+
+    :param raw: (channels x samples) integer counts
+    :param coefficients: (channels x num_coefficients) array, c0 first like ai_dev_scaling_coeff
+    :param out: float (channels x samples) array to write the volts into
+    :return: out
+    """
+    np.multiply(raw, coefficients[:, -1:], out=out)
+    for k in range(coefficients.shape[1] - 2, 0, -1):
+        out += coefficients[:, k:k + 1]
+        out *= raw
+    out += coefficients[:, :1]
+    return out
+
+
+def minmax_envelope(data, num_bins, out):
+    """
+    Peak preserving decimation of data down to num_bins (min, max) pairs
+    The samples are split into equal bins along the last axis with a reshaped view and the min and max of
+    every bin are taken in one call each, so spikes stay visible no matter how many samples are dropped
+
+    :param data: array of samples, the last axis is decimated (eg. channels x samples)
+    :param num_bins: number of bins, must be at most the number of samples
+    :param out: array shaped like data but with 2 * num_bins samples, gets the bin minimums in the even
+                columns and the bin maximums in the odd columns
+    :return: out
+    """
+    num_samples = data.shape[-1]
+    samples_per_bin = num_samples // num_bins
+    used = samples_per_bin * num_bins
+    bins = data[..., :used].reshape(data.shape[:-1] + (num_bins, samples_per_bin))
+    np.min(bins, axis=-1, out=out[..., 0::2])
+    np.max(bins, axis=-1, out=out[..., 1::2])
+
+    # fold the samples that don't fill up a whole bin into the last one
+    if used < num_samples:
+        tail = data[..., used:]
+        np.minimum(out[..., -2], tail.min(axis=-1), out=out[..., -2])
+        np.maximum(out[..., -1], tail.max(axis=-1), out=out[..., -1])
+    return out
+
+
+class WavetableCache:
+    """
+    Least recently used cache of period-aligned sine tables
+    A table holds a whole number of periods (period_length samples, the smallest length after which the
+    sampled sine repeats exactly) plus one extra chunk, so any chunk of a steady output is a single
+    contiguous slice starting anywhere in the first period_length samples.
+    """
+
+    def __init__(self, max_bytes=WAVETABLE_CACHE_BYTES, max_period=WAVETABLE_MAX_PERIOD):
+        """
+        :param max_bytes: total size of the tables kept
+        :param max_period: longest period_length a table may have
+        """
+        self.max_bytes = max_bytes
+        self.max_period = max_period
+        self.tables = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def period_length(self, step):
+        """
+        :param step: turns per sample (frequency / sample_rate)
+        :return: (samples, periods) after which the wave repeats, None if that takes more than max_period samples
+        """
+        ratio = Fraction(step).limit_denominator(self.max_period)
+        if abs(ratio.numerator / ratio.denominator - step) > 1e-15 * max(1.0, step):
+            return None
+        return ratio.denominator, ratio.numerator
+
+    def get(self, key, amplitude, step, offset, period, samples_per_chunk):
+        """
+        Table for key, synthesized on a miss and evicting the least recently used tables when over budget
+
+        :param key: hashable description of the wave (amplitude, step, offset, chunk size)
+        :param amplitude: peak amplitude
+        :param step: turns per sample
+        :param offset: phase in turns of the first sample of the table
+        :param period: period_length in samples
+        """
+        table = self.tables.get(key)
+        if table is not None:
+            self.tables.move_to_end(key)
+            self.hits += 1
+            return table
+
+        self.misses += 1
+        table = np.arange(period + samples_per_chunk, dtype=np.float64)
+        table *= step
+        table += offset
+        table *= 2 * np.pi
+        np.sin(table, out=table)
+        table *= amplitude
+
+        self.tables[key] = table
+        self.num_bytes += table.nbytes
+        while self.num_bytes > self.max_bytes and len(self.tables) > 1:
+            old_key, old_table = self.tables.popitem(last=False)
+            self.num_bytes -= old_table.nbytes
+        return table
+
+    def clear(self):
+        self.tables.clear()
+        self.num_bytes = 0
+
+
+# creates the sine waves of all output channels at once
+class OscillatorBank:
     """
-    Wave Generator Object
-    Creates the sine wave with given parameters
-    Holds the state so that every call to generate_wave will create a continuous sine wave from the last call.
-    Changes to frequency will create discontinuities
+    Multi-channel phase accumulator oscillator
+    Every channel carries its phase in turns (float64, wrapped to [0, 1) after every chunk) from one chunk to
+    the next, so the waves are continuous across chunk boundaries and across frequency changes, and the
+    phase never grows large enough to lose precision, even after hours of output.
+
+    The (channels x samples) block of a chunk is one vectorized phase ramp written straight into the output
+    array: phase + k * frequency / sample_rate for k = 0 .. samples - 1, the next chunk starts at k = samples.
+    Channels that are off get an amplitude of 0 but keep advancing so they stay in step with the others,
+    DC channels are a sine with no frequency at a quarter turn.
+
+    Once the parameters stay the same from one chunk to the next, the output is steady and every channel
+    is copied out of a period-aligned table from the WavetableCache instead of being synthesized again.
+
+    With ramp_time set, a parameter change doesn't step at the next chunk but ramps linearly from the
+    current amplitude, frequency and phase shift to the new ones over ramp_time, see start_ramp(). The ramp
+    is a per-sample envelope over the whole (channels x samples) block and the phase under a frequency
+    ramp is its closed form quadratic, so ramping costs a few more array operations per chunk and nothing
+    per sample in Python. Turning channels on or off ramps their amplitude too.
     """
 
-    def __init__(self):
-        self.reset = False
-        self.counter = 0
-        self.last_freq = 0
-        self.output_times = []
+    def __init__(self, num_channels, cache=None):
+        """
+        :param num_channels: number of output channels (rows of the output array)
+        :param cache: WavetableCache for steady outputs, None to always synthesize
+        """
+        # phase in turns of the first sample of the next chunk
+        self.phases = np.zeros(num_channels)
+        self.cache = cache
+        # parameters of the previous chunk, a steady output repeats them
+        self.last_params = None
+        # number of chunks in a row with the same parameters
+        self.steady_chunks = 0
+        # where every channel of the steady output is copied from, see plan_channel()
+        self.plan = None
+
+        # per channel values of the current chunk
+        self.voltages = np.zeros(num_channels)
+        self.frequencies = np.zeros(num_channels)
+        self.shifts = np.zeros(num_channels)
+        self.states = np.zeros(num_channels, dtype=bool)
+        self.amplitudes = np.zeros(num_channels)
+        self.steps = np.zeros(num_channels)
+        self.advance = np.zeros(num_channels)
+        self.offsets = np.zeros(num_channels)
+        self.is_dc = np.zeros(num_channels, dtype=bool)
+
+        # sample index within a chunk, only rebuilt when the size changes
+        self.ramp = np.empty(0)
 
-    def reset_counter(self):
+        # seconds a parameter change is spread over, 0 to apply it at the next chunk
+        self.ramp_time = 0.0
+        self.ramping = False
+        # amplitude, turns per sample and phase shift in turns (added to the phase) at the next sample
+        self.current_amplitudes = np.zeros(num_channels)
+        self.current_steps = np.zeros(num_channels)
+        self.current_shifts = np.zeros(num_channels)
+        # values at the start of the ramp and how far they move by its end
+        self.ramp_from = None
+        self.ramp_by = None
+        self.ramp_length = 0
+        self.ramp_elapsed = 0
+
+    def reset_phases(self):
+        """
+        Start every wave again from phase 0 on the next call so the phase shifts line up
         """
-        On next call to generate_wave the counter will be reset so the wave will start again from time index 0
+        self.set_phases(0)
+
+    def set_phases(self, phases):
+        """
+        Continue every channel from the given phases in turns on the next call
+        The copy plan of the steady output points into the tables at the old phases, so it is dropped too
+
+        :param phases: phase of every channel, or one for all of them
         """
-        self.reset = True
+        self.phases[:] = phases
+        self.plan = None
 
-    def generate_wave(self, voltage, frequency, shift, sample_rate, samples_per_chunk):
+    def generate_waves(self, voltages, frequencies, shifts, output_states, sample_rate, samples_per_chunk, out):
         """
-        :param voltage: RMS voltage, which will be converted to amplitude (Peak-to-Peak) in signal
-        :param frequency: Determines if AC or DC. Frequency of signal in Hz if not 0, creates DC signal if frequency is 0
-        :param shift: The phase shift in degrees
+        :param voltages: RMS voltage of each channel, the DC level for channels with a frequency of 0
+        :param frequencies: frequency in Hz of each channel, 0 for DC
+        :param shifts: phase shift in degrees of each channel
+        :param output_states: True for the channels that are on, the others are set to 0
         :param sample_rate: # of data points per second
         :param samples_per_chunk: # of data points that will be written in this output buffer
-        :return: np.array with waveform of input params
-
+        :param out: (channels x samples_per_chunk) array the waves are written into
+        :return: out
         """
-        # return DC voltage if frequency is 0
-        if frequency == 0:
-            return np.full(shape=samples_per_chunk, fill_value=voltage)
+        self.voltages[:] = voltages
+        self.frequencies[:] = frequencies
+        self.shifts[:] = shifts
+        self.states[:] = output_states
 
-        # determine if it needs to shift frequency based on which part of the waveform it's on
-        if self.last_freq != frequency or self.reset:
-            self.reset = False
-            self.counter = 0
-            self.last_freq = frequency
-        else:
-            self.counter += 1
-
-        # get peak-peak voltage from RMS voltage
-        amplitude = np.sqrt(2) * voltage
-        # waves_per_sec = frequency
-        rad_per_sec = 2 * np.pi * frequency
-        chunks_per_sec = sample_rate / samples_per_chunk
-        sec_per_chunk = 1 / chunks_per_sec
-        waves_per_chunk = frequency / chunks_per_sec
-
-        # phase shift based on parameter
-        phase_shift = 2 * np.pi * shift / 360
-
-        # shift the frequency if starting in the middle of a wave
-        start_fraction = waves_per_chunk % 1
-        freq_shifter = self.counter * 2 * np.pi * start_fraction
-
-        # create array of time values
-        self.output_times = np.linspace(
-            start=0, stop=sec_per_chunk, num=samples_per_chunk
-        )
-        output_waveform = amplitude * np.sin(
-            self.output_times * rad_per_sec + freq_shifter - phase_shift
+        if len(self.ramp) != samples_per_chunk:
+            self.ramp = np.arange(samples_per_chunk, dtype=np.float64)
+
+        # turns per sample, and the phase of the first sample including the shift
+        np.divide(self.frequencies, sample_rate, out=self.steps)
+        np.divide(self.shifts, 360, out=self.offsets)
+        np.subtract(self.phases, self.offsets, out=self.offsets)
+
+        # RMS voltage to amplitude, DC channels output their voltage as is
+        np.equal(self.frequencies, 0, out=self.is_dc)
+        np.multiply(self.voltages, np.sqrt(2), out=self.amplitudes)
+        np.copyto(self.amplitudes, self.voltages, where=self.is_dc)
+        np.copyto(self.offsets, 0.25, where=self.is_dc)
+        np.copyto(self.amplitudes, 0, where=~self.states)
+
+        params = (
+            tuple(self.voltages), tuple(self.frequencies), tuple(self.shifts), tuple(self.states),
+            sample_rate, samples_per_chunk,
         )
+        if self.ramp_time > 0 and (self.last_params is None or params[:5] != self.last_params[:5]):
+            if self.last_params is None:
+                # the very first output fades in
+                self.current_amplitudes[:] = 0
+                np.copyto(self.current_steps, self.steps)
+                self.current_shifts[:] = self.target_shifts(self.phases)
+            self.start_ramp(sample_rate)
+
+        if params == self.last_params and not self.ramping:
+            self.steady_chunks += 1
+        else:
+            self.steady_chunks = 0
+        self.last_params = params
+
+        if self.ramping:
+            self.plan = None
+            return self.ramp_chunk(samples_per_chunk, out)
+
+        if self.cache is not None and self.steady_chunks:
+            if self.plan is None:
+                self.plan = [self.plan_channel(i, samples_per_chunk) for i in range(len(out))]
+            self.copy_from_plan(samples_per_chunk, out)
+        else:
+            self.plan = None
+            np.multiply.outer(self.steps, self.ramp, out=out)
+            out += self.offsets[:, None]
+            out *= 2 * np.pi
+            np.sin(out, out=out)
+            out *= self.amplitudes[:, None]
 
-        return output_waveform
+        # a ramp started later starts from here
+        np.copyto(self.current_amplitudes, self.amplitudes)
+        np.copyto(self.current_steps, self.steps)
+        self.current_shifts[:] = self.target_shifts(self.phases)
 
-    # less used
-    # deprecated
-    def generate_n_periods(self, voltage, frequency, shift, sample_rate, num=1):
+        # move on by a whole chunk, only the fractional turn is kept
+        np.multiply(self.steps, samples_per_chunk, out=self.advance)
+        np.mod(self.advance, 1, out=self.advance)
+        self.phases += self.advance
+        np.mod(self.phases, 1, out=self.phases)
+        return out
+
+    def target_shifts(self, phases):
         """
-        :param voltage: RMS voltage, which will be converted to amplitude (Peak-to-Peak) in signal
-        :param frequency: Determines if AC or DC. Frequency of signal in Hz if not 0, creates DC signal if frequency is 0
-        :param shift: The phase shift in degrees
-        :param sample_rate: # of data points per second
-        :param num: number of periods to generate 
-        :return: np.array with waveform of input params
+        Phase shift in turns that is added to the phase of every channel for the current parameters
+        DC channels sit at a quarter turn whatever their phase is, so their shift makes up the difference
 
+        :param phases: phase in turns the DC channels are at
         """
-        amplitude = np.sqrt(2) * voltage  # get peak voltage from RMS voltage
+        shifts = self.shifts / -360
+        shifts[self.is_dc] = 0.25 - phases[self.is_dc]
+        return shifts
 
-        rad_per_sec = 2 * np.pi * frequency
-        samples_per_period = int(sample_rate / rad_per_sec)
+    def start_ramp(self, sample_rate):
+        """
+        Ramp from the current values to the parameters of this chunk over ramp_time
+        The frequency ramps linearly, so over the ramp the phase moves by
+            phi(u) = s0 * u + ds * u^2 / (2 * length)
+        turns after u samples (s0 the starting step, ds the change), and by ds * (u - length / 2) more than
+        the starting step would once the ramp is over. The phase shift takes the shorter way round.
+        """
+        length = max(1, int(round(self.ramp_time * sample_rate)))
+        ramp_steps = self.steps - self.current_steps
+        # DC channels end up at a quarter turn from wherever the frequency ramp leaves their phase
+        end_phases = self.phases + length * (self.current_steps + self.steps) / 2
+        ramp_shifts = self.target_shifts(end_phases) - self.current_shifts
+        ramp_shifts += 0.5
+        np.mod(ramp_shifts, 1, out=ramp_shifts)
+        ramp_shifts -= 0.5
 
-        phase_shift = 2 * np.pi * shift / 360
+        self.ramp_from = (self.current_amplitudes.copy(), self.current_steps.copy(), self.current_shifts.copy())
+        self.ramp_by = (self.amplitudes - self.current_amplitudes, ramp_steps, ramp_shifts)
+        self.ramp_length = length
+        self.ramp_elapsed = 0
+        self.ramping = True
 
-        # create array of time values
-        self.output_times = np.linspace(
-            start=0, stop=num / frequency, num=samples_per_period * num
-        )
-        output_waveform = amplitude * np.sin(
-            self.output_times * rad_per_sec - phase_shift
-        )
-        return output_waveform
\ No newline at end of file
+    def ramp_progress(self, u):
+        """
+        :param u: samples since the start of the ramp
+        :return: fraction of the ramp done and the extra phase of the frequency ramp per unit of ds at u
+        """
+        length = self.ramp_length
+        done = np.minimum(u, length)
+        return done / length, done * done / (2 * length) + (u - done)
+
+    def ramp_chunk(self, samples_per_chunk, out):
+        """
+        Next chunk of the ramp, moves the oscillators on and ends the ramp once it is over
+        """
+        amplitudes, steps, shifts = self.ramp_from
+        ramp_amplitudes, ramp_steps, ramp_shifts = self.ramp_by
+        start = self.ramp_elapsed
+        progress, extra = self.ramp_progress(start + self.ramp)
+        start_progress, start_extra = self.ramp_progress(start)
+        extra -= start_extra
+
+        # phase: starting step over the chunk plus the frequency ramp, then the ramping phase shift
+        np.multiply.outer(steps, self.ramp, out=out)
+        out += np.multiply.outer(ramp_steps, extra)
+        out += np.multiply.outer(ramp_shifts, progress)
+        out += (self.phases + shifts)[:, None]
+        out *= 2 * np.pi
+        np.sin(out, out=out)
+        out *= amplitudes[:, None] + np.multiply.outer(ramp_amplitudes, progress)
+
+        end = start + samples_per_chunk
+        end_progress, end_extra = self.ramp_progress(end)
+        self.phases += steps * samples_per_chunk + ramp_steps * (end_extra - start_extra)
+        np.mod(self.phases, 1, out=self.phases)
+        np.add(amplitudes, ramp_amplitudes * end_progress, out=self.current_amplitudes)
+        np.add(steps, ramp_steps * end_progress, out=self.current_steps)
+        np.add(shifts, ramp_shifts * end_progress, out=self.current_shifts)
+        self.ramp_elapsed = end
+        if end >= self.ramp_length:
+            self.ramping = False
+        return out
+
+    def common_period(self):
+        """
+        Length of a buffer that holds a whole number of periods of every channel of the last chunk,
+        so the device can loop it without a seam
+
+        :return: number of samples, None without a cache or if longer than the cache's max_period
+        """
+        if self.cache is None:
+            return None
+        period = 1
+        for amplitude, step in zip(self.amplitudes, self.steps):
+            if amplitude == 0 or step == 0:
+                continue
+            aligned = self.cache.period_length(step)
+            if aligned is None:
+                return None
+            period = int(np.lcm(period, aligned[0]))
+            if period > self.cache.max_period:
+                return None
+        return period
+
+    def render(self, phases, out):
+        """
+        Samples of the waves of the last chunk starting from the given phases, the oscillators don't move
+
+        :param phases: phase in turns of the first sample of every channel
+        :param out: (channels x samples) array the waves are written into
+        """
+        offsets = phases - self.shifts / 360
+        offsets[self.is_dc] = 0.25
+        np.multiply.outer(self.steps, np.arange(out.shape[1], dtype=np.float64), out=out)
+        out += offsets[:, None]
+        out *= 2 * np.pi
+        np.sin(out, out=out)
+        out *= self.amplitudes[:, None]
+        return out
+
+    def plan_channel(self, i, samples_per_chunk):
+        """
+        Work out where the steady output of channel i comes from
+
+        :return: [table, start, period] to copy chunks out of table from start on, the table is None for
+                 off and DC channels which are a constant start, and for waves that repeat too slowly to cache
+        """
+        amplitude, step = self.amplitudes[i], self.steps[i]
+        if amplitude == 0 or step == 0:
+            return [None, amplitude * np.sin(2 * np.pi * self.offsets[i]), 0]
+
+        aligned = self.cache.period_length(step)
+        if aligned is None:
+            return [None, None, 0]
+
+        # the table starts at the phase the shift gives sample 0, find the sample this chunk starts at:
+        # start * periods / period = phase (mod 1), up to a fraction of a sample that becomes part of the key
+        period, periods = aligned
+        position = self.phases[i] * period
+        nearest = round(position)
+        fraction = round(position - nearest, 6)
+        start = nearest * pow(periods, -1, period) % period
+        offset = fraction / period - self.shifts[i] / 360
+
+        key = (amplitude, step, self.shifts[i], fraction, samples_per_chunk)
+        table = self.cache.get(key, amplitude, step, offset, period, samples_per_chunk)
+        return [table, start, period]
+
+    def copy_from_plan(self, samples_per_chunk, out):
+        """
+        Fill out with the next chunk of the steady output
+        """
+        for i, channel in enumerate(self.plan):
+            table, start, period = channel
+            if table is not None:
+                np.copyto(out[i], table[start:start + samples_per_chunk])
+                channel[1] = (start + samples_per_chunk) % period
+            elif start is not None:
+                out[i].fill(start)
+            else:
+                np.multiply(self.ramp, self.steps[i], out=out[i])
+                out[i] += self.offsets[i]
+                out[i] *= 2 * np.pi
+                np.sin(out[i], out=out[i])
+                out[i] *= self.amplitudes[i]
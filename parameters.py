@@ -127,6 +127,48 @@ class ConfigParamTree(ParamTreeBase):
                         "type": "int",
                         "value": 1000,
                     },
+                    {
+                        "name": "Static Output",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Let the device loop unchanged outputs on its own instead of streaming them",
+                    },
+                    {
+                        "name": "Target Latency",
+                        "type": "float",
+                        "value": 100,
+                        "step": 10,
+                        "limits": (1, 10000),
+                        "suffix": "ms",
+                        "tip": "Time from a parameter change to the outputs, more is queued when needed to avoid underflows",
+                    },
+                    {
+                        "name": "Ramp Time",
+                        "type": "float",
+                        "value": 50,
+                        "step": 10,
+                        "limits": (0, 60000),
+                        "suffix": "ms",
+                        "tip": "Amplitude, frequency and phase changes ramp over this time instead of stepping, 0 to step",
+                    },
+                    {
+                        "name": "Waveform File",
+                        "type": "str",
+                        "value": "",
+                        "tip": "(channels x samples) .npy file in volts to play instead of the sine waves, empty for sines",
+                    },
+                    {
+                        "name": "Waveform Sample Rate",
+                        "type": "int",
+                        "value": 1000,
+                        "limits": (1, 10000000),
+                        "tip": "Sample rate the waveform file was made for, resampled to the writer Sample Rate",
+                    },
+                    {
+                        "name": "Loop Waveform",
+                        "type": "bool",
+                        "value": True,
+                    },
                 ],
             },
             {
@@ -137,6 +179,7 @@ class ConfigParamTree(ParamTreeBase):
                         "name": "Device Name",
                         "type": "str",
                         "value": "Dev1",
+                        "tip": "Comma separated list for several devices, the first one provides the shared sample clock",
                     },
                     {
                         "name": "Sample Rate",
@@ -150,6 +193,272 @@ class ConfigParamTree(ParamTreeBase):
                         "value": 1000,
                         "limits": (1, 10000),
                     },
+                    {
+                        "name": "Acquisition Mode",
+                        "type": "list",
+                        "values": ACQUISITION_MODES,
+                        "value": ACQUISITION_MODES[0],
+                        "tip": "Hardware Callback reads on the DAQmx every N samples event instead of polling",
+                    },
+                    {
+                        "name": "Raw Samples",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Read unscaled int16 counts and convert to volts only where needed",
+                    },
+                    {
+                        "name": "Adaptive Chunk Size",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Polling only: pick the chunk size at runtime, Sample Size is the largest chunk",
+                    },
+                    {
+                        "name": "Target Latency",
+                        "type": "float",
+                        "value": 50,
+                        "step": 10,
+                        "limits": (1, 10000),
+                        "suffix": "ms",
+                        "tip": "Time from acquiring a sample to the plots being done with it",
+                    },
+                    {
+                        "name": "CPU Budget",
+                        "type": "float",
+                        "value": 10,
+                        "step": 1,
+                        "limits": (0.1, 100),
+                        "suffix": "%",
+                        "tip": "Share of the reader thread's time that may be spent on per chunk overhead",
+                    },
+                ],
+            },
+            {
+                "name": "Recorder Config",
+                "type": "group",
+                "children": [
+                    {
+                        "name": "File Name",
+                        "type": "str",
+                        "value": "recording.daq",
+                        "tip": "A timestamp is added to the name of every new recording",
+                    },
+                    {
+                        "name": "Record Raw",
+                        "type": "bool",
+                        "value": True,
+                    },
+                    {
+                        "name": "Record Corrected",
+                        "type": "bool",
+                        "value": True,
+                    },
+                ],
+            },
+            {
+                "name": "Frequency Sweep",
+                "type": "group",
+                "children": [
+                    {
+                        "name": "Enable",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Sweep the frequency of every output instead of the set frequencies, applied on Commit Settings",
+                    },
+                    {
+                        "name": "Type",
+                        "type": "list",
+                        "values": SWEEP_TYPES,
+                        "value": SWEEP_TYPES[0],
+                    },
+                    {
+                        "name": "Start Frequency",
+                        "type": "float",
+                        "value": 1,
+                        "suffix": "Hz",
+                    },
+                    {
+                        "name": "End Frequency",
+                        "type": "float",
+                        "value": 100,
+                        "suffix": "Hz",
+                    },
+                    {
+                        "name": "Duration",
+                        "type": "float",
+                        "value": 10,
+                        "limits": (0.001, 1e6),
+                        "suffix": "s",
+                    },
+                    {
+                        "name": "Steps",
+                        "type": "int",
+                        "value": 10,
+                        "limits": (1, 100000),
+                        "tip": "Number of frequencies of the stepped sweep",
+                    },
+                    {
+                        "name": "Repeat",
+                        "type": "bool",
+                        "value": False,
+                    },
+                ],
+            },
+            {
+                "name": "Feedback",
+                "type": "group",
+                "children": [
+                    {
+                        "name": "Enable",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Regulate the output voltages on what the assigned inputs of the calibration window measure",
+                    },
+                    {
+                        "name": "Control Phase",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Also regulate the phases of the outputs relative to each other",
+                    },
+                    {
+                        "name": "Sense Gain",
+                        "type": "float",
+                        "value": 1,
+                        "step": 0.1,
+                        "tip": "Input volts measured per output volt when the output is right",
+                    },
+                    {
+                        "name": "Proportional Gain",
+                        "type": "float",
+                        "value": 0.3,
+                        "step": 0.05,
+                        "limits": (0, 2),
+                    },
+                    {
+                        "name": "Integral Gain",
+                        "type": "float",
+                        "value": 0.4,
+                        "step": 0.05,
+                        "limits": (0, 2),
+                        "tip": "Fraction of the error integrated on every update",
+                    },
+                    {
+                        "name": "Max Trim",
+                        "type": "float",
+                        "value": 50,
+                        "limits": (0, 100),
+                        "suffix": "%",
+                        "tip": "Largest correction of the output voltages",
+                    },
+                    {
+                        "name": "Max Trim Step",
+                        "type": "float",
+                        "value": 5,
+                        "limits": (0, 100),
+                        "suffix": "%",
+                        "tip": "Largest change of the voltage correction per input chunk",
+                    },
+                    {
+                        "name": "Max Phase Trim",
+                        "type": "float",
+                        "value": 45,
+                        "limits": (0, 180),
+                        "suffix": "\N{DEGREE SIGN}",
+                    },
+                    {
+                        "name": "Max Phase Step",
+                        "type": "float",
+                        "value": 5,
+                        "limits": (0, 180),
+                        "suffix": "\N{DEGREE SIGN}",
+                        "tip": "Largest change of the phase correction per input chunk",
+                    },
+                ],
+            },
+            {
+                "name": "Delay Correction",
+                "type": "group",
+                "children": [
+                    {
+                        "name": "Apply To",
+                        "type": "list",
+                        "values": DELAY_CORRECTION_MODES,
+                        "value": DELAY_CORRECTION_MODES[0],
+                        "tip": "Outputs when the measured lags are in the drive, Measurements when they are in the sensing",
+                    },
+                ],
+            },
+            {
+                "name": "Trigger Config",
+                "type": "group",
+                "children": [
+                    {
+                        "name": "Channel",
+                        "type": "list",
+                        "values": CHANNEL_NAMES_IN,
+                        "value": CHANNEL_NAMES_IN[0],
+                    },
+                    {
+                        "name": "Mode",
+                        "type": "list",
+                        "values": TRIGGER_MODES,
+                        "value": TRIGGER_MODES[0],
+                    },
+                    {
+                        "name": "Level",
+                        "type": "float",
+                        "value": 0,
+                        "step": 0.1,
+                        "suffix": "V",
+                    },
+                    {
+                        "name": "Window Low",
+                        "type": "float",
+                        "value": -1,
+                        "step": 0.1,
+                        "suffix": "V",
+                    },
+                    {
+                        "name": "Window High",
+                        "type": "float",
+                        "value": 1,
+                        "step": 0.1,
+                        "suffix": "V",
+                    },
+                    {
+                        "name": "Pre-Trigger Samples",
+                        "type": "int",
+                        "value": 1000,
+                        "limits": (0, 1000000),
+                    },
+                    {
+                        "name": "Post-Trigger Samples",
+                        "type": "int",
+                        "value": 1000,
+                        "limits": (1, 1000000),
+                    },
+                    {
+                        "name": "Re-Arm",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Keep capturing every trigger instead of only the first one",
+                    },
+                    {
+                        "name": "Trigger On Signal Start",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Arm and trigger when the signal output is started",
+                    },
+                    {
+                        "name": "Save Captures",
+                        "type": "bool",
+                        "value": False,
+                    },
+                    {
+                        "name": "File Name",
+                        "type": "str",
+                        "value": "capture.npz",
+                        "tip": "A timestamp is added to the name of every saved capture",
+                    },
                 ],
             },
         ]
@@ -173,6 +482,16 @@ class ConfigParamTree(ParamTreeBase):
                     "value": i,
                 }
             )
+        for ch in CHANNEL_NAMES_IN:
+            self.setting_params[1]["children"].append(
+                {
+                    "name": ch + " Input Device",
+                    "type": "int",
+                    "value": 0,
+                    "limits": (0, 16),
+                    "tip": "Index into the reader's Device Name list",
+                }
+            )
         # Reader calibration offsets
         self.setting_params[1]["children"].append(
             {
@@ -188,6 +507,22 @@ class ConfigParamTree(ParamTreeBase):
                 ]
             }
         )
+        # Reader calibration gains, the corrected data is gain * volts + offset
+        self.setting_params[1]["children"].append(
+            {
+                "name": "Calibration Gains",
+                "type": "group",
+                "children": [
+                    {
+                        "name": ch,
+                        "type": "float",
+                        "value": 1,
+                        "step": 0.01,
+                    }
+                    for ch in CHANNEL_NAMES_IN
+                ]
+            }
+        )
 
         super().__init__(name="Config Param", params=self.setting_params)
 
@@ -198,6 +533,23 @@ class ConfigParamTree(ParamTreeBase):
         ]
         return channels
 
+    def get_read_devices(self):
+        """
+        :return: device name of every input channel, from its index into the Device Name list
+        """
+        names = [
+            name.strip()
+            for name in self.get_param_value("Reader Config", "Device Name").split(",")
+        ]
+        devices = []
+        for ch in CHANNEL_NAMES_IN:
+            index = self.get_param_value("Reader Config", ch + " Input Device")
+            if index >= len(names):
+                print(ch, "Input Device", index, "is not in the device list, using", names[0])
+                index = 0
+            devices.append(names[index])
+        return devices
+
     def get_write_channels(self):
         channels = [
             self.get_param_value("Writer Config", ch + " Output Channel")
@@ -205,11 +557,40 @@ class ConfigParamTree(ParamTreeBase):
         ]
         return channels
 
+    def get_recording_metadata(self):
+        """
+        Settings stored in the header of a recording so that it can be interpreted on its own
+        """
+        metadata = {
+            # in debug mode the raw stream is the simulated writer output
+            "debug_mode": DEBUG_MODE,
+            "sample_rate": self.get_param_value("Reader Config", "Sample Rate"),
+            "sample_size": self.get_param_value("Reader Config", "Sample Size"),
+            "device_name": self.get_param_value("Reader Config", "Device Name"),
+            "input_devices": self.get_read_devices(),
+            "channel_names": CHANNEL_NAMES_IN,
+            "input_channels": self.get_read_channels(),
+            "calibration_offsets": [
+                self.get_param_value("Reader Config", "Calibration Offsets", ch)
+                for ch in CHANNEL_NAMES_IN
+            ],
+            "calibration_gains": [
+                self.get_param_value("Reader Config", "Calibration Gains", ch)
+                for ch in CHANNEL_NAMES_IN
+            ],
+        }
+        return metadata
+
     def save_offsets(self, offsets):
         for i, ch in enumerate(CHANNEL_NAMES_IN):
             self.set_param_value(offsets[i], "Reader Config", "Calibration Offsets", ch)
         print("Saving offsets")
 
+    def save_gains(self, gains):
+        for i, ch in enumerate(CHANNEL_NAMES_IN):
+            self.set_param_value(gains[i], "Reader Config", "Calibration Gains", ch)
+        print("Saving gains")
+
 
 class MagneticControlsParamTree(ParamTreeBase):
     def __init__(self):
@@ -342,10 +723,178 @@ class MagneticControlsParamTree(ParamTreeBase):
                     },
                 ],
             },
+            {
+                "name": "Field Trajectory",
+                "type": "group",
+                "children": [
+                    {
+                        "name": "Toggle Output",
+                        "type": "bool",
+                        "value": False,
+                        "tip": "Move the field of the chosen control along the path, uses its amplitude and frequency",
+                    },
+                    {
+                        "name": "Control",
+                        "type": "list",
+                        "values": ["3D Alignment", "3D Rotation"],
+                        "value": "3D Alignment",
+                    },
+                    {
+                        "name": "Path",
+                        "type": "list",
+                        "values": TRAJECTORY_PATHS,
+                        "value": TRAJECTORY_PATHS[0],
+                    },
+                    {
+                        "name": "Elevation Start",
+                        "type": "float",
+                        "value": -45,
+                        "suffix": "\N{DEGREE SIGN}",
+                        "tip": "Grid Scan and Spiral",
+                    },
+                    {
+                        "name": "Elevation End",
+                        "type": "float",
+                        "value": 45,
+                        "suffix": "\N{DEGREE SIGN}",
+                        "tip": "Grid Scan and Spiral",
+                    },
+                    {
+                        "name": "Azimuth Start",
+                        "type": "float",
+                        "value": 0,
+                        "suffix": "\N{DEGREE SIGN}",
+                        "tip": "Grid Scan",
+                    },
+                    {
+                        "name": "Azimuth End",
+                        "type": "float",
+                        "value": 315,
+                        "suffix": "\N{DEGREE SIGN}",
+                        "tip": "Grid Scan",
+                    },
+                    {
+                        "name": "Grid Points",
+                        "type": "int",
+                        "value": 5,
+                        "limits": (1, 1000),
+                        "tip": "Grid Scan: directions along the elevation and along the azimuth",
+                    },
+                    {
+                        "name": "Dwell",
+                        "type": "float",
+                        "value": 1,
+                        "limits": (0.001, 1e6),
+                        "suffix": "s",
+                        "tip": "Grid Scan: time spent at every direction",
+                    },
+                    {
+                        "name": "Transition",
+                        "type": "float",
+                        "value": 0.1,
+                        "limits": (0, 1e6),
+                        "suffix": "s",
+                        "tip": "Grid Scan: time the move to the next direction takes",
+                    },
+                    {
+                        "name": "Turns",
+                        "type": "float",
+                        "value": 5,
+                        "tip": "Spiral: azimuth turns from the start to the end elevation",
+                    },
+                    {
+                        "name": "Duration",
+                        "type": "float",
+                        "value": 10,
+                        "limits": (0.001, 1e6),
+                        "suffix": "s",
+                        "tip": "Spiral: time from the start to the end elevation",
+                    },
+                    {
+                        "name": "Cone Angle",
+                        "type": "float",
+                        "value": 30,
+                        "suffix": "\N{DEGREE SIGN}",
+                        "tip": "Precession: angle to the axis, the axis is the control's elevation and azimuth",
+                    },
+                    {
+                        "name": "Precession Rate",
+                        "type": "float",
+                        "value": 1,
+                        "suffix": "Hz",
+                        "tip": "Precession: turns around the axis per second",
+                    },
+                ],
+            },
         ]
+        # add the coil coupling of every control dynamically
+        # Coefficients
+        for control in self.control_params[:2]:
+            coefficients = control["children"][5]["children"]
+            coefficients.append(
+                {
+                    "name": "Cross Coupling",
+                    "type": "group",
+                    "expanded": False,
+                    "children": [
+                        {
+                            "name": axis + " from " + coil,
+                            "type": "float",
+                            "value": 0,
+                            "step": 0.01,
+                            "tip": "Fraction of coil " + coil + "'s own field that also shows up along " + axis,
+                        }
+                        for axis in CHANNEL_NAMES_OUT[:3]
+                        for coil in CHANNEL_NAMES_OUT[:3]
+                        if axis != coil
+                    ],
+                }
+            )
+            coefficients.append(
+                {
+                    "name": "Phase Lag",
+                    "type": "group",
+                    "expanded": False,
+                    "children": [
+                        {
+                            "name": coil,
+                            "type": "float",
+                            "value": 0,
+                            "step": 1,
+                            "suffix": "\N{DEGREE SIGN}",
+                            "tip": "How far coil " + coil + "'s field lags behind its drive",
+                        }
+                        for coil in CHANNEL_NAMES_OUT[:3]
+                    ],
+                }
+            )
 
         super().__init__(name="Controls Param", params=self.control_params)
 
+    def get_coupling(self, control):
+        """
+        Coil coupling settings of one of the magnetic controls
+
+        :param control: "3D Alignment" or "3D Rotation"
+        :return: dict of the CoilCoupling arguments gains, cross and lags
+        """
+        coils = CHANNEL_NAMES_OUT[:3]
+        cross = [
+            [
+                0 if axis == coil
+                else self.get_param_value(control, "Coefficients", "Cross Coupling", axis + " from " + coil)
+                for coil in coils
+            ]
+            for axis in coils
+        ]
+        return {
+            "gains": [
+                self.get_param_value(control, "Coefficients", "k" + coil.lower()) for coil in coils
+            ],
+            "cross": cross,
+            "lags": [self.get_param_value(control, "Coefficients", "Phase Lag", coil) for coil in coils],
+        }
+
 
 if __name__ == "__main__":
     print("\nRunning demo for ParameterTree\n")
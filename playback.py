@@ -0,0 +1,214 @@
+import queue
+import threading
+
+import numpy as np
+
+from config import PLAYBACK_READ_AHEAD_CHUNKS
+
+
+class WaveformPlayback:
+    """
+    Arbitrary waveform source for SignalGeneratorBase/SignalWriterDAQ, played from a (channels x samples) .npy file
+
+    The file is memory mapped so it can be much larger than RAM. A read-ahead thread copies it one chunk at a
+    time into a few preallocated blocks, resampled from the file's sample rate to the writer's by linear
+    interpolation, and the writer callback takes the next ready block with fill(). Only those blocks and the
+    pages of the file being read are ever held in memory.
+    """
+
+    def __init__(self, path, file_rate, loop=True, read_ahead=PLAYBACK_READ_AHEAD_CHUNKS):
+        """
+        :param path: .npy file of samples in volts, one row per output channel
+        :param file_rate: sample rate the file was made for in samples per second
+        :param loop: start over at the end of the file, otherwise the outputs go to 0 once it has been played
+        :param read_ahead: number of chunks prepared ahead of the writer
+        """
+        self.data = np.load(path, mmap_mode="r")
+        if self.data.ndim != 2:
+            raise ValueError(
+                "Waveform file must hold a (channels x samples) array, " + path + " has shape " + str(self.data.shape)
+            )
+        self.path = path
+        self.file_rate = file_rate
+        self.loop = loop
+        self.read_ahead = read_ahead
+
+        # file position (in file samples, fractional when resampling) of the next sample to prepare
+        self.position = 0.0
+        # file position of the next sample to be played, prepared chunks past it are dropped on a restart
+        self.played = 0.0
+        self.finished = False
+        # fill() calls that found no chunk ready and repeated the last output value instead
+        self.starved = 0
+        # files have no frequency to tag the chunks with
+        self.frequency = None
+
+        self.sample_rate = None
+        self.sample_size = None
+        self.running = False
+        self.thread = None
+
+    @property
+    def num_channels(self):
+        return self.data.shape[0]
+
+    @property
+    def num_samples(self):
+        return self.data.shape[1]
+
+    def start(self, sample_rate, sample_size):
+        """
+        Start preparing chunks of sample_size samples at sample_rate, from the first sample not played yet
+
+        :param sample_rate: writer sample rate in samples per second
+        :param sample_size: samples per channel of every chunk
+        """
+        self.stop()
+        self.sample_rate = sample_rate
+        self.sample_size = sample_size
+        # file samples per output sample
+        self.step = self.file_rate / sample_rate
+        self.ramp = np.arange(sample_size, dtype=np.float64) * self.step
+
+        shape = (self.num_channels, sample_size)
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for i in range(self.read_ahead):
+            self.free.put(np.zeros(shape))
+        self.last = np.zeros((self.num_channels, 1))
+
+        # scratch of the read-ahead thread
+        self.positions = np.empty(sample_size)
+        self.fractions = np.empty(sample_size)
+        self.index = np.empty(sample_size, dtype=np.int64)
+        self.next_index = np.empty(sample_size, dtype=np.int64)
+        self.left = np.empty(shape)
+        self.right = np.empty(shape)
+
+        self.position = self.played
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="Playback Thread", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the read-ahead thread, the chunks it prepared are dropped
+        """
+        if self.thread is None:
+            return
+        self.running = False
+        # wakes up the thread if it is waiting for a free block
+        self.free.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        """
+        Read-ahead thread loop, prepares a chunk whenever fill() has handed a block back
+        """
+        while self.running:
+            block = self.free.get()
+            if block is None:
+                return
+            start = self.position
+            self.read_block(block)
+            self.ready.put((block, start))
+
+    def read_block(self, out):
+        """
+        Resample the next out.shape[1] output samples out of the file into out
+        """
+        n = out.shape[1]
+        length = self.num_samples
+        if self.finished:
+            out[:] = 0
+            return
+
+        positions = self.positions
+        np.add(self.ramp, self.position, out=positions)
+        self.position += n * self.step
+        if self.loop:
+            np.mod(positions, length, out=positions)
+            self.position %= length
+
+        # sample before and after every position and how far in between it is
+        np.floor(positions, out=self.fractions)
+        self.index[:] = self.fractions
+        np.subtract(positions, self.fractions, out=self.fractions)
+        np.add(self.index, 1, out=self.next_index)
+        if self.loop:
+            # the sample after the last one is the first one again
+            np.mod(self.next_index, length, out=self.next_index)
+        else:
+            np.minimum(self.index, length - 1, out=self.index)
+            np.minimum(self.next_index, length - 1, out=self.next_index)
+
+        np.take(self.data, self.index, axis=1, out=self.left)
+        np.take(self.data, self.next_index, axis=1, out=self.right)
+        np.subtract(self.right, self.left, out=out)
+        out *= self.fractions
+        out += self.left
+
+        if not self.loop:
+            end = np.searchsorted(positions, length - 1, side="right")
+            if end < n:
+                out[:, end:] = 0
+                self.finished = True
+
+    def fill(self, out, sample_rate):
+        """
+        Copy the next chunk into out, called from the writer callback
+        Restarts the read-ahead whenever the writer's sample rate or chunk size changes
+
+        :param out: (channels x samples) array the chunk is written into
+        :param sample_rate: writer sample rate in samples per second
+        :return: out
+        """
+        n = out.shape[1]
+        if (sample_rate, n) != (self.sample_rate, self.sample_size):
+            self.start(sample_rate, n)
+        try:
+            # a chunk is due within its own duration, after that the writer falls behind
+            block, start = self.ready.get(timeout=n / sample_rate)
+        except queue.Empty:
+            self.starved += 1
+            out[:] = self.last
+            return out
+
+        np.copyto(out, block)
+        self.last[:, 0] = block[:, -1]
+        self.played = start + n * self.step
+        if self.loop:
+            self.played %= self.num_samples
+        self.free.put(block)
+        return out
+
+    def close(self):
+        """
+        Stop and release the memory map
+        """
+        self.stop()
+        self.data = None
+
+
+if __name__ == "__main__":
+    print("\nRunning demo for WaveformPlayback\n")
+    import os
+    import tempfile
+    import time
+
+    # 3 channels of a 1 s chirp at 10 kS/s, played at 25 kS/s
+    t = np.arange(10000) / 10000
+    waveform = np.array([np.sin(2 * np.pi * (10 + 40 * t) * t), np.cos(2 * np.pi * 5 * t), t])
+    path = os.path.join(tempfile.mkdtemp(), "waveform.npy")
+    np.save(path, waveform)
+
+    playback = WaveformPlayback(path, file_rate=10000, loop=True)
+    out = np.empty((3, 1000))
+    start = time.perf_counter()
+    for i in range(100):
+        playback.fill(out, 25000)
+    elapsed = time.perf_counter() - start
+    print("Played", 100 * out.shape[1], "samples in", round(elapsed * 1000, 1), "ms,", playback.starved, "starved")
+    print("File position", round(playback.played, 1), "of", playback.num_samples)
+    playback.close()
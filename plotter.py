@@ -1,3 +1,4 @@
+import numpy as np
 from PyQt5 import QtGui
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
@@ -5,16 +6,82 @@ from PyQt5.QtCore import *
 import pyqtgraph as pg
 
 # --- From DAQ Control --- #
-from config import CHANNEL_NAMES_IN, CHANNEL_NAMES_OUT
-from misc_functions import calculate_rms_value
+from config import CHANNEL_NAMES_IN
+from misc_functions import calculate_rms_value, minmax_envelope
+
+
+class EnvelopeDecimator(QObject):
+    """
+    Sits between the calibrated data and the SignalPlot
+    Reduces every chunk to a (min, max) envelope with one pair per pixel of plot width so drawing costs
+    the same no matter the sample rate or sample size. The legend/RMS consumers keep the full data.
+
+    decimated_data: emitted with (x, envelope), x holds the sample index of every envelope point
+    """
+
+    decimated_data = pyqtSignal(object, object)
+
+    def __init__(self, num_bins=500):
+        super().__init__()
+        self.num_bins = num_bins
+        self.envelope = None
+        self.passthrough = None
+        # sample index of every point of the passthrough chunks
+        self.passthrough_x = None
+        self.x = None
+
+    def set_num_bins(self, num_bins):
+        """
+        Called when the plot is resized, the envelope buffers are reallocated on the next chunk
+        """
+        self.num_bins = max(1, num_bins)
+
+    def allocate(self, num_channels, num_samples):
+        """
+        Preallocate the envelope and the x positions of its points for the given chunk shape
+        """
+        samples_per_bin = num_samples // self.num_bins
+        self.envelope = np.empty((num_channels, 2 * self.num_bins))
+        # both points of a bin sit in the middle of it so each bin is drawn as a vertical stroke
+        centers = np.arange(self.num_bins) * samples_per_bin + samples_per_bin // 2
+        self.x = np.repeat(centers, 2)
+        self.chunk_shape = (num_channels, num_samples)
+
+    def on_new_data(self, chunk):
+        """
+        Decimate the incoming chunk, chunks already smaller than the envelope are passed through as they are
+        (copied out of the pooled chunk so the plot keeps them once the chunk is recycled)
+        """
+        data = chunk.data
+        num_channels, num_samples = data.shape
+        if num_samples <= 2 * self.num_bins:
+            if self.passthrough is None or self.passthrough.shape != data.shape:
+                self.passthrough = np.empty(data.shape)
+                self.passthrough_x = np.arange(num_samples)
+            np.copyto(self.passthrough, data)
+            chunk.release()
+            self.decimated_data.emit(self.passthrough_x, self.passthrough)
+            return
+
+        if self.envelope is None or self.envelope.shape[1] != 2 * self.num_bins or \
+                self.chunk_shape != (num_channels, num_samples):
+            self.allocate(num_channels, num_samples)
+
+        minmax_envelope(data, self.num_bins, self.envelope)
+        chunk.release()
+        self.decimated_data.emit(self.x, self.envelope)
 
 
 # Graph Widget
 class SignalPlot(pg.PlotWidget):
     """
     Inherits plot widget in order to plot voltage values
+
+    width_changed: emitted with the width of the plot area in pixels whenever the widget is resized
     """
 
+    width_changed = pyqtSignal(int)
+
     def __init__(self, legend=None):
         super().__init__()
         # PlotWidget super functions
@@ -32,24 +99,33 @@ class SignalPlot(pg.PlotWidget):
 
         self.setLabel("left", "Voltage", units="V")
         self.setLabel("bottom", "Samples")
-    
+
+        # curves are created once and only have their data replaced on every update
+        self.curves = [self.plot(pen=self.pens[i]) for i in range(len(CHANNEL_NAMES_IN))]
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.width_changed.emit(self.width())
+
     def on_offsets_received(self, data):
         """
         Holds calibration offset state values here
         """
         self.offsets = data
 
-    def update_plot(self, incoming_data):
+    def update_plot(self, x, incoming_data):
         """
         Refresh plot widget to display incoming_data array values
-        """
-        self.clear()
 
-        # adds each channel's offset to incoming channel
+        :param x: sample index of each point
+        :param incoming_data: (channels x points) values, usually the envelope from EnvelopeDecimator
+        """
         for i, data in enumerate(incoming_data):
             # this is kinda ugly but it works so let's roll with it
-            if self.legend.legend_items[i].toggle_box.isChecked():
-                self.plot(data, clear=False, pen=self.pens[i])
+            visible = self.legend.legend_items[i].toggle_box.isChecked()
+            self.curves[i].setVisible(visible)
+            if visible:
+                self.curves[i].setData(x, data)
 
 #***
 
@@ -145,9 +221,7 @@ class Legend(QWidget):
             if frequencies is not None:
                 item.frequency = frequencies[i]
 
-    def on_new_data(self, data):
+    def on_new_data(self, chunk):
         for i, item in enumerate(self.legend_items):
-            # prevent index error when more input channels than output channels in DEBUG_MODE
-            if i >= len(CHANNEL_NAMES_OUT):
-                return
-            item.set_current_rms(data[i])
+            item.set_current_rms(chunk.data[i])
+        chunk.release()
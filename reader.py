@@ -1,95 +1,489 @@
+import threading
 import time
-import nidaqmx
 import numpy as np
-from nidaqmx.constants import AcquisitionType
-from nidaqmx.stream_readers import AnalogMultiChannelReader
 from pyqtgraph.Qt import QtCore
 
+from buffers import Chunk, ChunkPool
 from config import *
+from metrics import MetricsLog
+
+if SIMULATED_DAQ:
+    import sim_daq as nidaqmx
+    from sim_daq import AcquisitionType, AnalogMultiChannelReader, AnalogUnscaledReader
+else:
+    import nidaqmx
+    from nidaqmx.constants import AcquisitionType
+    from nidaqmx.stream_readers import AnalogMultiChannelReader, AnalogUnscaledReader
+
+POLLING_MODE, CALLBACK_MODE = ACQUISITION_MODES
+
+
+class ChunkSizeController:
+    """
+    Picks the number of samples per chunk at runtime for the adaptive mode of the SignalReader
+
+    A chunk's oldest sample reaches the display about one chunk duration plus the consumer delay
+    (emit to last release) after it was acquired, so the largest chunk within the target latency is
+        n_latency = (target_latency - consumer_delay) * sample_rate
+    The reader's CPU time per chunk is mostly fixed overhead, so the smallest chunk within the CPU budget is
+        n_cpu = cpu_time * sample_rate / cpu_budget
+    and the consumers only keep up when a chunk lasts longer than they take to process it
+        n_consumer = consumer_delay * sample_rate
+    When these can't all be met, keeping up wins over latency: the size is max(n_latency, n_cpu, n_consumer)
+    clipped to [ADAPTIVE_MIN_SAMPLES, max_samples]
+    """
+
+    def __init__(self, target_latency=0.05, cpu_budget=0.1):
+        """
+        :param target_latency: seconds from acquisition to the consumers being done with the chunk
+        :param cpu_budget: fraction of the reader thread's time that may be spent on CPU work
+        """
+        self.target_latency = target_latency
+        self.cpu_budget = cpu_budget
+        self.reset(1000, 1000)
+
+    def reset(self, sample_rate, max_samples):
+        """
+        Start over for a new task, from the largest chunk size
+        """
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+        self.num_samples = max_samples
+        self.cpu_time = 0.0
+        self.consumer_delay = 0.0
+
+    def update(self, num_samples, cpu_time, consumer_delay, consumer_lag):
+        """
+        :param num_samples: size of the chunk that was just read
+        :param cpu_time: reader thread CPU seconds spent reading and emitting it
+        :param consumer_delay: seconds from emit to last release of the newest released chunk
+        :param consumer_lag: chunks emitted that the consumers have not released yet
+        :return: samples per channel of the next chunk
+        """
+        a = ADAPTIVE_SMOOTHING
+        self.cpu_time += a * (cpu_time - self.cpu_time)
+        self.consumer_delay += a * (consumer_delay - self.consumer_delay)
+
+        n_latency = (self.target_latency - self.consumer_delay) * self.sample_rate
+        n_cpu = self.cpu_time * self.sample_rate / self.cpu_budget
+        n_consumer = self.consumer_delay * self.sample_rate
+        wanted = max(n_latency, n_cpu, n_consumer)
+        # consumers holding on to most of the pool can't keep up with the chunk rate
+        if consumer_lag >= READER_POOL_SIZE - 1:
+            wanted = max(wanted, 2 * num_samples)
+
+        wanted = round(wanted / ADAPTIVE_STEP_SAMPLES) * ADAPTIVE_STEP_SAMPLES
+        wanted = int(min(max(wanted, ADAPTIVE_MIN_SAMPLES), self.max_samples))
+        # only switch on real changes, every new size makes the consumers reallocate their buffers
+        if abs(wanted - self.num_samples) > ADAPTIVE_HYSTERESIS * self.num_samples:
+            self.num_samples = wanted
+        return self.num_samples
+
+
+class DeviceTask:
+    """
+    The read task of one input device and the rows of the SignalReader's chunks that it fills
+
+    Rows that are next to each other in CHANNEL_NAMES_IN order are read straight into the chunk,
+    otherwise the device reads into its own buffer which is then copied into its rows
+    """
+
+    def __init__(self, dev_name, channels, rows, task_name, raw, max_samples):
+        """
+        :param dev_name: name of the device, eg. Dev2
+        :param channels: ai channel numbers on this device
+        :param rows: chunk row of each of the channels
+        :param task_name: unique DAQmx task name
+        :param raw: True to read unscaled int16 counts
+        :param max_samples: largest read in samples per channel
+        """
+        self.name = dev_name
+        self.rows = np.array(rows)
+        self.raw = raw
+        self.task = nidaqmx.Task(task_name)
+        for ch in channels:
+            channel_name = dev_name + "/ai" + str(ch)
+            self.task.ai_channels.add_ai_voltage_chan(channel_name)
+            print(channel_name)
+
+        if np.array_equal(self.rows, np.arange(rows[0], rows[0] + len(rows))):
+            self.row_slice = slice(rows[0], rows[0] + len(rows))
+        else:
+            self.row_slice = None
+            self.scratch = Chunk(None, len(rows), max_samples, np.int16 if raw else np.float64)
+
+        if raw:
+            self.reader = AnalogUnscaledReader(self.task.in_stream)
+            self.read_samples = self.reader.read_int16
+        else:
+            self.reader = AnalogMultiChannelReader(self.task.in_stream)
+            self.read_samples = self.reader.read_many_sample
+
+    def configure_timing(self, sample_rate, master=None):
+        """
+        Continuous sample clock timing
+        Devices other than the master take their sample clock and start trigger from the master's
+        so every device acquires the exact same sample instants
+
+        :param master: name of the device whose clock and trigger are shared, None for the master itself
+        """
+        if master is None:
+            self.task.timing.cfg_samp_clk_timing(
+                rate=sample_rate, sample_mode=AcquisitionType.CONTINUOUS
+            )
+            return
+        self.task.timing.cfg_samp_clk_timing(
+            rate=sample_rate,
+            source="/" + master + "/ai/SampleClock",
+            sample_mode=AcquisitionType.CONTINUOUS,
+        )
+        self.task.triggers.start_trigger.cfg_dig_edge_start_trig(
+            "/" + master + "/ai/StartTrigger"
+        )
+
+    def scaling_coefficients(self):
+        return [ch.ai_dev_scaling_coeff for ch in self.task.ai_channels]
+
+    def read(self, data, num_samples):
+        """
+        Read num_samples per channel of this device into its rows of data
+        """
+        if self.row_slice is not None:
+            self.read_samples(
+                data=data[self.row_slice], number_of_samples_per_channel=num_samples
+            )
+            return
+
+        self.scratch.set_num_samples(num_samples)
+        self.read_samples(
+            data=self.scratch.data, number_of_samples_per_channel=num_samples
+        )
+        data[self.rows] = self.scratch.data
+
 
 class SignalReader(QtCore.QThread):
     """
     Captures signals on the input DAQ
-    Creates a new thread to constantly poll the buffer from the DAQ
+    Creates a new thread that either constantly polls the buffer from the DAQ (POLLING_MODE)
+    or sleeps while the DAQmx every N samples event reads the data for it (CALLBACK_MODE)
+
+    Channels can be spread over several devices (dev_name given per channel). The first device is the
+    master, the others share its sample clock and start trigger, and all of them read into the same
+    aligned (channels x samples) chunk
+
+    Every read goes into a Chunk taken from a preallocated ChunkPool, so consumers never see their data
+    overwritten by the next read. Every slot connected to incoming_data must call chunk.release()
+    once it is done with chunk.data
+
+    With adaptive set (POLLING_MODE only) the chunk size is picked by chunk_size, a ChunkSizeController,
+    anywhere up to sample_size without restarting the task
+
+    With raw set, chunks hold the unscaled int16 ADC counts together with the channel scaling coefficients
+    (chunk.scaling) and only the consumers that need volts convert them with chunk.to_volts()
     """
-    
-    # signal that is emitted whenever buffer object has been filled and is ready
+
+    # signal that is emitted with a Chunk whenever a buffer has been filled and is ready
     incoming_data = QtCore.pyqtSignal(object)
+    # signal that is emitted with the error message when reading stops because of an error
+    read_error = QtCore.pyqtSignal(str)
 
-    def __init__(self, sample_rate, sample_size, channels, dev_name="Dev2"):
+    def __init__(
+        self, sample_rate, sample_size, channels, dev_name="Dev2", mode=POLLING_MODE, raw=False
+    ):
         super().__init__()
 
-        self.reader = None
+        # set whenever is_running, is_paused or mode changes to wake up the idle thread
+        self.state_changed = threading.Event()
+
         self.is_running = False
         self.is_paused = False
+        self.mode = mode
         self.input_channels = channels
+        # device name for all channels, or a list with the device of each channel
         self.daq_in_name = dev_name
+        self.devices = []
 
+        self.seq = 0
+        # (channels x coefficients) scaling polynomial of the current task when reading raw samples
+        self.scaling = None
+        # True to read unscaled int16 counts instead of float64 volts, applied by create_task()
+        self.raw = raw
+        self.restart_requested = False
+        # let chunk_size pick the number of samples per read, can be switched while running
+        self.adaptive = False
+        self.chunk_size = ChunkSizeController()
         self.sample_rate = sample_rate
         self.sample_size = sample_size
-        # actual data received from the DAQ
-        self.input = np.empty(shape=(len(CHANNEL_NAMES_IN), self.sample_size))
+        # callable giving the output frequency at a perf_counter time (SignalWriterDAQ.frequency_at), every chunk
+        # is tagged with the frequency at its first sample, None to leave chunk.frequency None
+        self.frequency_source = None
+
+        # per chunk health of the acquisition
+        # backlog_samples: samples left in the DAQ buffer after the read, growing means the reader is behind
+        # read_ms: time spent in read_many_sample, close to 0 in POLLING_MODE also means the reader is behind
+        # emit_interval_ms: time since the previous chunk was emitted
+        # consumer_lag_chunks: chunks emitted that consumers have not released yet
+        # chunk_samples: samples per channel in the chunk
+        self.metrics = MetricsLog(
+            ["seq", "backlog_samples", "read_ms", "emit_interval_ms",
+             "consumer_lag_chunks", "dropped_chunks", "chunk_samples"]
+        )
+        self.last_emit_time = time.perf_counter()
+        self.read_time = 0.0
+
+    @property
+    def is_running(self):
+        return self._is_running
+
+    @is_running.setter
+    def is_running(self, value):
+        self._is_running = value
+        self.state_changed.set()
+
+    @property
+    def is_paused(self):
+        return self._is_paused
+
+    @is_paused.setter
+    def is_paused(self, value):
+        self._is_paused = value
+        self.state_changed.set()
+
+    @property
+    def mode(self):
+        """
+        Acquisition mode, one of ACQUISITION_MODES
+        Takes effect on the next create_task()/restart()
+        """
+        return self._mode
+
+    @mode.setter
+    def mode(self, value):
+        self._mode = value
+        self.state_changed.set()
+
+    def allocate_pool(self):
+        """
+        Create the chunk buffers for the current sample size and sample format
+        Called from create_task() so the buffers always match the task that fills them,
+        chunks still held by consumers belong to the old pool and are simply dropped once released
+        """
+        dtype = np.int16 if self.raw else np.float64
+        self.pool = ChunkPool(
+            READER_POOL_SIZE, len(CHANNEL_NAMES_IN), self.sample_size, dtype
+        )
+        # chunks from the old pool no longer count towards the consumer lag
+        self.pool.last_released_seq = self.seq - 1
+        # data is still drained into here when every pooled buffer is in use
+        self.overflow = Chunk(None, len(CHANNEL_NAMES_IN), self.sample_size, dtype)
+        self.chunk_size.reset(self.sample_rate, self.sample_size)
 
     # called on start()
     def run(self):
         """
         Main thread loop
         Whenver the reader has data available and ready, it will emit the incoming_data signal with the data
+        While paused or in CALLBACK_MODE the thread sleeps until one of the state properties changes
         """
 
         self.is_running = True
         self.create_task()
 
         while self.is_running:
-            if not self.is_paused:
-                try:
-                    self.reader.read_many_sample(
-                        data=self.input, number_of_samples_per_channel=self.sample_size
-                    )
-                    self.incoming_data.emit(self.input)
+            if self.restart_requested:
+                self.restart_requested = False
+                self.is_paused = True
+                self.close_tasks()
+                self.create_task()
+                self.is_paused = False
+                continue
+
+            if self.is_paused or self.mode != POLLING_MODE:
+                self.state_changed.wait()
+                self.state_changed.clear()
+                continue
+
+            try:
+                if self.adaptive:
+                    self.read_adaptive_chunk()
+                else:
+                    self.read_chunk(self.sample_size)
+            except Exception as e:
+                print("Error with read_many_sample")
+                print(e)
+                self.read_error.emit(str(e))
+                break
+
+        self.close_tasks()
+
+    def read_chunk(self, num_samples):
+        """
+        Read num_samples per channel into a pooled chunk and emit it
+
+        :param num_samples: must not be more than the pool's max_samples
+        """
+        chunk = self.pool.acquire()
+        # consumers are falling behind, keep the DAQ buffer drained but drop this chunk
+        if chunk is None:
+            self.overflow.set_num_samples(num_samples)
+            for device in self.devices:
+                device.read(self.overflow.data, num_samples)
+            self.seq += 1
+            return
+
+        chunk.set_num_samples(num_samples)
+        start = time.perf_counter()
+        try:
+            for device in self.devices:
+                device.read(chunk.data, num_samples)
+        except Exception:
+            chunk.release()
+            raise
+        self.read_time = time.perf_counter() - start
+        self.emit_chunk(chunk)
+
+    def read_adaptive_chunk(self):
+        """
+        Read a chunk of the size chunk_size asks for and feed back what it cost
+        """
+        num_samples = self.chunk_size.num_samples
+        cpu_start = time.thread_time()
+        self.read_chunk(num_samples)
+        self.chunk_size.update(
+            num_samples,
+            time.thread_time() - cpu_start,
+            self.pool.release_delay,
+            self.seq - 1 - self.pool.last_released_seq,
+        )
+
+    def on_samples_acquired(self, task_handle, event_type, num_samples, callback_data):
+        """
+        DAQmx every N samples acquired callback used in CALLBACK_MODE
+        Runs on the DAQmx driver thread and reads every whole chunk of sample_size samples (the event interval)
+        in the buffer, one after the other if several have piled up. What is left over is less than a chunk
+        and is read by the next event, so every chunk has the same length
+        """
+        if self.is_paused or not self.is_running:
+            return 0
+
+        try:
+            available = self.task.in_stream.avail_samp_per_chan
+            while available >= self.sample_size:
+                self.read_chunk(self.sample_size)
+                available -= self.sample_size
+        except Exception as e:
+            print("Error with read_many_sample")
+            print(e)
+            self.read_error.emit(str(e))
+            # wakes up run() so the task gets closed
+            self.is_running = False
+
+        return 0
+
+    def emit_chunk(self, chunk):
+        """
+        Stamp the chunk with its sequence number and hand it to every connected consumer
+        """
+        chunk.seq = self.seq
+        chunk.timestamp = time.perf_counter()
+        chunk.scaling = self.scaling
+        chunk.frequency = None if self.frequency_source is None else \
+            self.frequency_source(chunk.timestamp - chunk.num_samples / self.sample_rate)
+        self.seq += 1
+
+        self.metrics.append(
+            chunk.seq,
+            self.task.in_stream.avail_samp_per_chan,
+            self.read_time * 1000,
+            (chunk.timestamp - self.last_emit_time) * 1000,
+            chunk.seq - 1 - self.pool.last_released_seq,
+            self.pool.dropped,
+            chunk.num_samples,
+        )
+        self.last_emit_time = chunk.timestamp
 
-                except Exception as e:
-                    print("Error with read_many_sample")
-                    print(e)
-                    break
+        self.pool.emit(chunk, self, self.incoming_data)
 
-        self.task.close()
+    def get_channel_devices(self):
+        """
+        :return: device name of every input channel
+        """
+        if isinstance(self.daq_in_name, str):
+            return [self.daq_in_name for ch in self.input_channels]
+        return list(self.daq_in_name)
 
     def create_task(self):
         """
-        Create a read task
+        Create a read task for every device, the first device drives the shared clock
         """
         print("reader input channels:", self.input_channels)
+        self.allocate_pool()
+
+        channel_devices = self.get_channel_devices()
+        # devices in order of their first channel, the first one is the master
+        names = list(dict.fromkeys(channel_devices))
+        self.devices = []
         try:
-            self.task = nidaqmx.Task("Reader Task")
+            for i, name in enumerate(names):
+                rows = [row for row, dev in enumerate(channel_devices) if dev == name]
+                task_name = "Reader Task" if i == 0 else "Reader Task " + name
+                self.devices.append(
+                    DeviceTask(
+                        name,
+                        [self.input_channels[row] for row in rows],
+                        rows,
+                        task_name,
+                        self.raw,
+                        self.sample_size,
+                    )
+                )
         except OSError:
             print("DAQ is not connected, task could not be created")
             return
-
-        try:
-            for ch in self.input_channels:
-                channel_name = self.daq_in_name + "/ai" + str(ch)
-                self.task.ai_channels.add_ai_voltage_chan(channel_name)
-                print(channel_name)
         except Exception:
             print("DAQ is not connected, channel could not be added")
             return
 
-        self.task.timing.cfg_samp_clk_timing(
-            rate=self.sample_rate, sample_mode=AcquisitionType.CONTINUOUS
-        )
-        self.task.start()
+        master = self.devices[0]
+        self.task = master.task
+        for device in self.devices:
+            device.configure_timing(
+                self.sample_rate, None if device is master else master.name
+            )
+
+        if self.raw:
+            # pad to the longest polynomial so every channel converts in the same vectorized pass
+            coefficients = [None] * len(channel_devices)
+            for device in self.devices:
+                for row, c in zip(device.rows, device.scaling_coefficients()):
+                    coefficients[row] = c
+            self.scaling = np.zeros((len(coefficients), max(len(c) for c in coefficients)))
+            for i, c in enumerate(coefficients):
+                self.scaling[i, : len(c)] = c
+        else:
+            self.scaling = None
 
-        self.reader = AnalogMultiChannelReader(self.task.in_stream)
+        if self.mode == CALLBACK_MODE:
+            self.task.register_every_n_samples_acquired_into_buffer_event(
+                self.sample_size, self.on_samples_acquired
+            )
+        # the other devices wait for the master's start trigger, so they have to be started first
+        for device in reversed(self.devices):
+            device.task.start()
+
+    def close_tasks(self):
+        for device in self.devices:
+            device.task.close()
+        self.devices = []
 
     def restart(self):
         """
         Deletes the previous task and creates a new task again
+        The reader thread does this itself before its next read, so the task is never closed mid read
+        and the new settings are applied together
         """
-        self.is_paused = True
-        self.task.close()
-        self.create_task()
-        self.is_paused = False
+        self.restart_requested = True
+        self.state_changed.set()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+import json
+import mmap
+import os
+import queue
+import struct
+
+import numpy as np
+from PyQt5 import QtCore
+
+from buffers import ChunkPool
+from config import RECORDER_EXTENT_SIZE, RECORDER_QUEUE_SIZE
+
+"""
+Recording file layout (little endian)
+
+File header (HEADER_SIZE bytes):
+    8 bytes   magic "DAQREC01"
+    uint64    offset of the end of the last complete record
+    uint32    length of the JSON metadata
+    ...       JSON metadata (sample rate, channel map, calibration offsets and gains, ...)
+
+Records (start right after the header, each padded to 8 bytes):
+    uint16    stream (RAW_STREAM or CORRECTED_STREAM)
+    uint16    dtype code (see DTYPES)
+    uint32    number of channels
+    uint32    number of samples per channel
+    int64     sequence number of the chunk
+    float64   timestamp (time.perf_counter() of the producer)
+    ...       (channels x samples) sample data in C order
+
+The file is grown in RECORDER_EXTENT_SIZE steps and trimmed to the last record when recording stops
+"""
+
+MAGIC = b"DAQREC01"
+HEADER_SIZE = 4096
+HEADER_FORMAT = "<8sQI"
+RECORD_FORMAT = "<HHIIqd4x"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_FORMAT)
+
+RAW_STREAM = 0
+CORRECTED_STREAM = 1
+STREAMS = [RAW_STREAM, CORRECTED_STREAM]
+
+DTYPES = [np.dtype(np.float64), np.dtype(np.int16)]
+
+
+class SignalRecorder(QtCore.QThread):
+    """
+    Continuously appends raw and corrected chunks to a memory mapped file on its own thread
+
+    The slots copy the chunk into one of the recorder's own buffers, queue the copy and release the pooled
+    chunk right away, they never wait. Connecting on_raw_data with a direct connection keeps the acquisition
+    thread free of any disk work, and a disk that stalls never holds on to the reader's few buffers. Every
+    stream has RECORDER_QUEUE_SIZE buffers, allocated for the first chunk (and again only when the chunks
+    outgrow them), if the disk can't keep up with those the chunk is dropped and counted.
+    """
+
+    def __init__(self, path, metadata, extent_size=RECORDER_EXTENT_SIZE):
+        """
+        :param path: file to record into, overwritten if it exists
+        :param metadata: dict of JSON serializable values stored in the file header
+        :param extent_size: number of bytes the file grows by whenever it fills up
+        """
+        super().__init__()
+        self.path = path
+        self.metadata = metadata
+        self.extent_size = extent_size
+
+        self.queue = queue.Queue()
+        # buffers the chunks of every stream are copied into while they wait for the disk
+        self.pools = [None] * len(STREAMS)
+        self.is_running = False
+        self.dropped = 0
+        self.records_written = 0
+
+        self.file = None
+        self.map = None
+        self.offset = HEADER_SIZE
+
+    def on_raw_data(self, chunk):
+        """
+        Queue a copy of a pooled chunk from the reader
+        """
+        self.queue_copy(RAW_STREAM, chunk)
+
+    def on_corrected_data(self, chunk):
+        """
+        Queue a copy of a pooled chunk of calibrated data from the CalibrationWindow
+        """
+        self.queue_copy(CORRECTED_STREAM, chunk)
+
+    def queue_copy(self, stream, chunk):
+        """
+        Copy the chunk into a buffer of the stream's pool and release it, the copy is released once written
+        """
+        pool = self.pools[stream]
+        if pool is None or pool.num_channels != chunk.num_channels or pool.max_samples < chunk.num_samples \
+                or pool.chunks[0].data.dtype != chunk.data.dtype:
+            pool = ChunkPool(RECORDER_QUEUE_SIZE, chunk.num_channels, chunk.pool.max_samples, chunk.data.dtype)
+            self.pools[stream] = pool
+        copy = pool.acquire()
+        if copy is None:
+            self.dropped += 1
+            chunk.release()
+            return
+        copy.set_num_samples(chunk.num_samples)
+        np.copyto(copy.data, chunk.data)
+        copy.seq = chunk.seq
+        copy.timestamp = chunk.timestamp
+        chunk.release()
+        self.queue.put_nowait((stream, copy))
+
+    # called on start()
+    def run(self):
+        """
+        Main thread loop
+        Waits for queued chunks and copies each one into the mapped file
+        """
+        self.is_running = True
+        self.open_file()
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            stream, chunk = item
+            self.write_record(stream, chunk.seq, chunk.timestamp, chunk.data)
+            chunk.release()
+
+        self.close_file()
+        print("Recording saved to", self.path, "-", self.records_written, "records,",
+              self.dropped, "dropped")
+
+    def stop(self):
+        """
+        Write out everything that is still queued and close the file
+        Close the gates the slots are opened on (see ConsumerGate) before calling so nothing is queued behind
+        the stop request
+        """
+        self.is_running = False
+        self.queue.put(None)
+        self.wait()
+
+    def open_file(self):
+        """
+        Create the file with its header and map the first extent
+        """
+        self.file = open(self.path, "w+b")
+        self.offset = HEADER_SIZE
+        self.resize(HEADER_SIZE + self.extent_size)
+
+        meta = json.dumps(self.metadata).encode("utf-8")
+        if struct.calcsize(HEADER_FORMAT) + len(meta) > HEADER_SIZE:
+            raise ValueError("Recording metadata does not fit in the file header")
+        struct.pack_into(HEADER_FORMAT, self.map, 0, MAGIC, self.offset, len(meta))
+        start = struct.calcsize(HEADER_FORMAT)
+        self.map[start:start + len(meta)] = meta
+
+    def resize(self, size):
+        """
+        Grow the file to size bytes and remap it
+        """
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def write_record(self, stream, seq, timestamp, data):
+        """
+        Append one record at the current offset, growing the file by whole extents when needed
+
+        :param data: (channels x samples) array
+        """
+        num_channels, num_samples = data.shape
+        dtype = data.dtype
+        size = RECORD_HEADER_SIZE + num_channels * num_samples * dtype.itemsize
+        size += -size % 8
+
+        if self.offset + size > len(self.map):
+            extents = (self.offset + size - len(self.map)) // self.extent_size + 1
+            self.resize(len(self.map) + extents * self.extent_size)
+
+        struct.pack_into(RECORD_FORMAT, self.map, self.offset, stream, DTYPES.index(dtype),
+                         num_channels, num_samples, seq, timestamp)
+        view = np.frombuffer(self.map, dtype=dtype, count=num_channels * num_samples,
+                             offset=self.offset + RECORD_HEADER_SIZE)
+        view = view.reshape(num_channels, num_samples)
+        view[:] = data
+        # the view has to be gone before the map can be resized or closed
+        del view
+
+        self.offset += size
+        struct.pack_into("<Q", self.map, len(MAGIC), self.offset)
+        self.records_written += 1
+
+    def close_file(self):
+        """
+        Trim the unused part of the last extent and close the file
+        """
+        self.map.flush()
+        self.map.close()
+        self.map = None
+        self.file.truncate(self.offset)
+        self.file.close()
+
+
+def read_recording(path):
+    """
+    Read back a file written by SignalRecorder
+
+    :param path: recording file
+    :return: (metadata dict, list of (stream, seq, timestamp, data) records),
+             the data arrays are memory mapped views into the file
+    """
+    contents = np.memmap(path, dtype=np.uint8, mode="r")
+    magic, end, meta_length = struct.unpack_from(HEADER_FORMAT, contents, 0)
+    if magic != MAGIC:
+        raise ValueError(path + " is not a DAQ recording")
+    start = struct.calcsize(HEADER_FORMAT)
+    metadata = json.loads(bytes(contents[start:start + meta_length]).decode("utf-8"))
+
+    records = []
+    offset = HEADER_SIZE
+    while offset < end:
+        stream, dtype_code, num_channels, num_samples, seq, timestamp = struct.unpack_from(
+            RECORD_FORMAT, contents, offset
+        )
+        dtype = DTYPES[dtype_code]
+        count = num_channels * num_samples
+        data_start = offset + RECORD_HEADER_SIZE
+        data = contents[data_start:data_start + count * dtype.itemsize].view(dtype)
+        records.append((stream, seq, timestamp, data.reshape(num_channels, num_samples)))
+        size = RECORD_HEADER_SIZE + count * dtype.itemsize
+        offset += size + (-size % 8)
+
+    return metadata, records
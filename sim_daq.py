@@ -0,0 +1,680 @@
+import threading
+import time
+from enum import Enum
+
+import numpy as np
+
+from config import (
+    CHANNEL_NAMES_IN,
+    CHANNEL_NAMES_OUT,
+    SIM_DELAY,
+    SIM_GAIN,
+    SIM_NOISE,
+    SIM_OFFSET,
+)
+
+"""
+Simulated stand-in for the parts of nidaqmx that reader.py and writer.py use
+Selected with SIMULATED_DAQ in config.py so the real SignalReader/SignalWriterDAQ code paths can run
+without a device:
+
+- Task with ai/ao channel collections, sample clock timing, in/out streams and the every N samples event
+- Digital edge start triggers from another device's ai/StartTrigger, so several simulated devices can
+  share one start time like devices sharing a sample clock
+- AnalogMultiChannelReader / AnalogUnscaledReader / AnalogMultiChannelWriter
+
+Samples are paced by time.perf_counter(), so a read of n samples at rate r takes n / r seconds just like
+the hardware. Every simulated input channel loops back from an output channel through
+gain * output(t - delay) + offset + noise, configurable per channel with system.set_loopback().
+Overruns and underflows happen when the code really falls behind, and can be forced with
+system.inject_overrun() and system.inject_underflow().
+"""
+
+try:
+    from nidaqmx.constants import (
+        AcquisitionType,
+        EveryNSamplesEventType,
+        RegenerationMode,
+        WriteRelativeTo,
+    )
+    from nidaqmx.errors import DaqError
+except ImportError:
+    # same values as nidaqmx.constants so the modules behave identically without nidaqmx installed
+    class AcquisitionType(Enum):
+        CONTINUOUS = 10123
+        FINITE = 10178
+        HW_TIMED_SINGLE_POINT = 12522
+
+    class RegenerationMode(Enum):
+        ALLOW_REGENERATION = 10097
+        DONT_ALLOW_REGENERATION = 10158
+
+    class WriteRelativeTo(Enum):
+        FIRST_SAMPLE = 10424
+        CURRENT_WRITE_POSITION = 10430
+
+    class EveryNSamplesEventType(Enum):
+        ACQUIRED_INTO_BUFFER = 1
+        TRANSFERRED_FROM_BUFFER = 2
+
+    class DaqError(Exception):
+        def __init__(self, message, error_code, task_name=""):
+            super().__init__(message + "\n\nStatus Code: " + str(error_code))
+            self.error_code = error_code
+            self.task_name = task_name
+
+
+# DAQmx error codes raised by the simulation
+SAMPLES_NO_LONGER_AVAILABLE = -200279
+GEN_STOPPED_TO_PREVENT_REGEN_OF_OLD_SAMPLES = -200290
+SAMPLES_NOT_YET_AVAILABLE = -200284
+SAMPLES_CAN_NOT_YET_BE_WRITTEN = -200292
+WRITE_EXCEEDS_BUFFER_SIZE = -200547
+TASK_INVALID = -200088
+
+READ_ALL_AVAILABLE = -1
+
+
+def parse_physical_channel(name):
+    """
+    Split a physical channel name such as "Dev1/ao0" into ("Dev1", "ao", 0)
+    """
+    device, channel = name.strip("/").split("/")
+    kind = channel.rstrip("0123456789")
+    return device, kind, int(channel[len(kind):])
+
+
+def default_input_buffer_size(rate):
+    """
+    Buffer size DAQmx picks for continuous input when none is given
+    """
+    if rate <= 100:
+        return 1000
+    if rate <= 10000:
+        return 10000
+    if rate <= 1000000:
+        return 100000
+    return 1000000
+
+
+class LoopbackChannel:
+    """
+    How a simulated input channel sees the outputs: gain * output(source, t - delay) + offset + noise
+    """
+
+    def __init__(self, source, gain=SIM_GAIN, offset=SIM_OFFSET, noise=SIM_NOISE, delay=SIM_DELAY):
+        """
+        :param source: ao channel number the input is wired to
+        :param gain: V/V from the output to the input
+        :param offset: added to the input in volts
+        :param noise: standard deviation of the gaussian noise in volts
+        :param delay: seconds between a sample leaving the output and reaching the input
+        """
+        self.source = source
+        self.gain = gain
+        self.offset = offset
+        self.noise = noise
+        self.delay = delay
+
+
+class SimulatedSystem:
+    """
+    Shared state of the simulated devices: running output tasks, loopback wiring and pending faults
+    Output and input channels are matched by their channel number only, regardless of device
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.output_tasks = []
+        # value an output holds after its task stops, by ao channel number
+        self.held_values = {}
+        self.loopback = {}
+        # started tasks waiting for the start trigger of another device
+        self.armed_tasks = []
+        self.pending_overrun = False
+        self.rng = np.random.default_rng()
+
+    def get_loopback(self, ai):
+        """
+        Loopback settings of an input channel
+        By default the inputs are spread over the outputs in order, eg. X1, X2 <- X; Y1, Y2 <- Y; Z <- Z
+        """
+        if ai not in self.loopback:
+            source = ai * len(CHANNEL_NAMES_OUT) // len(CHANNEL_NAMES_IN)
+            self.loopback[ai] = LoopbackChannel(min(source, len(CHANNEL_NAMES_OUT) - 1))
+        return self.loopback[ai]
+
+    def set_loopback(self, ai, source=None, gain=None, offset=None, noise=None, delay=None):
+        """
+        Change the wiring of the input channel ai, parameters left as None are unchanged
+        """
+        with self.lock:
+            channel = self.get_loopback(ai)
+            if source is not None:
+                channel.source = source
+            if gain is not None:
+                channel.gain = gain
+            if offset is not None:
+                channel.offset = offset
+            if noise is not None:
+                channel.noise = noise
+            if delay is not None:
+                channel.delay = delay
+
+    def inject_overrun(self):
+        """
+        The next read of any input task fails as if the input buffer had overflowed
+        """
+        self.pending_overrun = True
+
+    def inject_underflow(self):
+        """
+        Every running output task stops generating as if the host had not written in time
+        """
+        with self.lock:
+            for task in self.output_tasks:
+                task.out_stream.underflow()
+
+    def fire_start_trigger(self, device, start_time):
+        """
+        Start every armed task that is triggered by the ai/StartTrigger of device
+        """
+        with self.lock:
+            triggered = [
+                task for task in self.armed_tasks
+                if task.triggers.start_trigger.source_device == device
+            ]
+            for task in triggered:
+                self.armed_tasks.remove(task)
+                task.begin(start_time)
+
+    def output_values(self, ao, times):
+        """
+        Voltage of output channel ao at each of the given perf_counter times
+        """
+        with self.lock:
+            for task in self.output_tasks:
+                row = task.ao_channels.find(ao)
+                if row is not None:
+                    return task.out_stream.values_at(row, times)
+            return np.full(len(times), self.held_values.get(ao, 0.0))
+
+
+system = SimulatedSystem()
+
+
+# simulated inputs are 16 bit over +-10 V
+AI_RAW_SCALING = [0.0, 10.0 / 32768]
+
+
+class Channel:
+    def __init__(self, name):
+        self.name = name
+        self.device, self.kind, self.number = parse_physical_channel(name)
+        self.ai_dev_scaling_coeff = list(AI_RAW_SCALING)
+
+
+class ChannelCollection:
+    def __init__(self, task):
+        self.task = task
+        self.channels = []
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, index):
+        return self.channels[index]
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    @property
+    def channel_names(self):
+        return [ch.name for ch in self.channels]
+
+    def find(self, number):
+        """
+        Row of the channel with the given channel number, None if the task doesn't have it
+        """
+        for i, ch in enumerate(self.channels):
+            if ch.number == number:
+                return i
+        return None
+
+    def add_ai_voltage_chan(self, physical_channel, *args, **kwargs):
+        self.channels.append(Channel(physical_channel))
+        return self.channels[-1]
+
+    def add_ao_voltage_chan(self, physical_channel, *args, **kwargs):
+        self.channels.append(Channel(physical_channel))
+        return self.channels[-1]
+
+
+class Timing:
+    def __init__(self, task):
+        self.task = task
+        self.samp_clk_rate = 1000.0
+        self.samp_clk_src = ""
+        self.samp_quant_samp_per_chan = 1000
+        self.samp_quant_samp_mode = AcquisitionType.FINITE
+
+    def cfg_samp_clk_timing(
+        self, rate, source="", active_edge=None, sample_mode=AcquisitionType.FINITE, samps_per_chan=1000
+    ):
+        self.samp_clk_rate = float(rate)
+        self.samp_clk_src = source
+        self.samp_quant_samp_mode = sample_mode
+        self.samp_quant_samp_per_chan = samps_per_chan
+
+
+class StartTrigger:
+    def __init__(self):
+        # device whose ai/StartTrigger starts the task, None to start on start()
+        self.source_device = None
+
+    def cfg_dig_edge_start_trig(self, trigger_source, trigger_edge=None):
+        # terminals look like /Dev1/ai/StartTrigger
+        self.source_device = trigger_source.strip("/").split("/")[0]
+
+    def disable_start_trig(self):
+        self.source_device = None
+
+
+class Triggers:
+    def __init__(self):
+        self.start_trigger = StartTrigger()
+
+
+class InStream:
+    """
+    Simulated input buffer, samples are acquired by the clock and removed by reads
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.read_position = 0
+        self.overrun = False
+        self._input_buf_size = None
+
+    @property
+    def input_buf_size(self):
+        if self._input_buf_size is None:
+            timing = self.task.timing
+            return max(
+                default_input_buffer_size(timing.samp_clk_rate), timing.samp_quant_samp_per_chan
+            )
+        return self._input_buf_size
+
+    @input_buf_size.setter
+    def input_buf_size(self, value):
+        self._input_buf_size = value
+
+    @property
+    def total_samp_per_chan_acquired(self):
+        return self.task.clocked_samples()
+
+    @property
+    def avail_samp_per_chan(self):
+        available = self.task.clocked_samples() - self.read_position
+        if available > self.input_buf_size:
+            self.overrun = True
+        return min(available, self.input_buf_size)
+
+    def read(self, data, num_samples, timeout, raw=False):
+        """
+        Wait until num_samples are acquired and fill data with the looped back output values
+        With raw set the values are quantized to int16 counts of the channel's scaling
+        """
+        task = self.task
+        if num_samples == READ_ALL_AVAILABLE:
+            num_samples = self.avail_samp_per_chan
+
+        deadline = time.perf_counter() + timeout
+        while task.clocked_samples() < self.read_position + num_samples:
+            if not task.is_started:
+                raise DaqError("The task was stopped while waiting for samples", TASK_INVALID, task.name)
+            missing = self.read_position + num_samples - task.clocked_samples()
+            wait = missing / task.timing.samp_clk_rate
+            if time.perf_counter() + wait > deadline:
+                raise DaqError(
+                    "Some or all of the samples requested have not yet been acquired",
+                    SAMPLES_NOT_YET_AVAILABLE,
+                    task.name,
+                )
+            time.sleep(wait)
+
+        if system.pending_overrun or self.task.clocked_samples() - self.read_position > self.input_buf_size:
+            self.overrun = True
+        if self.overrun:
+            system.pending_overrun = False
+            self.overrun = False
+            # DAQmx continues from the newest samples after the error is reported
+            self.read_position = task.clocked_samples()
+            raise DaqError(
+                "The application is not able to keep up with the hardware acquisition",
+                SAMPLES_NO_LONGER_AVAILABLE,
+                task.name,
+            )
+
+        rate = task.timing.samp_clk_rate
+        times = task.start_time + (self.read_position + np.arange(num_samples)) / rate
+        for row, ch in enumerate(task.ai_channels):
+            loopback = system.get_loopback(ch.number)
+            values = system.output_values(loopback.source, times - loopback.delay)
+            values = values * loopback.gain + loopback.offset
+            if loopback.noise:
+                values += system.rng.normal(0, loopback.noise, num_samples)
+            if raw:
+                offset, lsb = ch.ai_dev_scaling_coeff[:2]
+                values = np.clip(np.round((values - offset) / lsb), -32768, 32767)
+            data[row, :num_samples] = values
+
+        self.read_position += num_samples
+        return num_samples
+
+
+class OutStream:
+    """
+    Simulated output buffer, filled by writes and emptied by the sample clock
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.regen_mode = RegenerationMode.ALLOW_REGENERATION
+        # with FIRST_SAMPLE the next write goes to buffer index offset, ahead of the generation when running
+        self.relative_to = WriteRelativeTo.CURRENT_WRITE_POSITION
+        self.offset = 0
+        self._output_buf_size = None
+        self.buffer = None
+        self.written = 0
+        # sample the generation stopped at after an underflow, None while generating
+        self.stopped_at = None
+
+    @property
+    def output_buf_size(self):
+        if self._output_buf_size is None:
+            return self.task.timing.samp_quant_samp_per_chan
+        return self._output_buf_size
+
+    @output_buf_size.setter
+    def output_buf_size(self, value):
+        self._output_buf_size = value
+        self.buffer = None
+
+    def generated(self):
+        """
+        Number of samples that have left the buffer
+        """
+        clocked = self.task.clocked_samples()
+        if self.regen_mode == RegenerationMode.ALLOW_REGENERATION:
+            return clocked
+        if self.stopped_at is None and clocked > self.written:
+            self.underflow()
+        if self.stopped_at is not None:
+            return self.stopped_at
+        return clocked
+
+    def underflow(self):
+        """
+        Stop generating at the last written sample
+        """
+        if self.stopped_at is None and self.task.is_started:
+            self.stopped_at = min(self.task.clocked_samples(), self.written)
+
+    @property
+    def total_samp_per_chan_generated(self):
+        return self.generated()
+
+    @property
+    def space_avail(self):
+        if not self.task.is_started:
+            return self.output_buf_size - self.written
+        return self.output_buf_size - (self.written - self.generated())
+
+    def write(self, data, timeout):
+        """
+        Copy data into the ring buffer, waiting for space while the task is running
+        """
+        task = self.task
+        num_samples = data.shape[1]
+        with system.lock:
+            if self.buffer is None:
+                self.buffer = np.zeros((len(task.ao_channels), self.output_buf_size))
+
+        if task.is_started:
+            self.generated()
+            if self.stopped_at is not None:
+                raise DaqError(
+                    "Generation was stopped to prevent the regeneration of old samples",
+                    GEN_STOPPED_TO_PREVENT_REGEN_OF_OLD_SAMPLES,
+                    task.name,
+                )
+            deadline = time.perf_counter() + timeout
+            while self.space_avail < num_samples:
+                wait = (num_samples - self.space_avail) / task.timing.samp_clk_rate
+                if time.perf_counter() + wait > deadline:
+                    raise DaqError(
+                        "Some or all of the samples to write could not be written to the buffer yet",
+                        SAMPLES_CAN_NOT_YET_BE_WRITTEN,
+                        task.name,
+                    )
+                time.sleep(wait)
+        elif num_samples > self.space_avail:
+            raise DaqError(
+                "Attempted to write more samples than the buffer can hold",
+                WRITE_EXCEEDS_BUFFER_SIZE,
+                task.name,
+            )
+
+        with system.lock:
+            size = self.buffer.shape[1]
+            if self.relative_to == WriteRelativeTo.FIRST_SAMPLE and task.is_started:
+                # first sample at or after the generation position that lands on buffer index offset
+                generated = self.generated()
+                self.written = generated + (self.offset - generated) % size
+            index = (self.written + np.arange(num_samples)) % size
+            self.buffer[:, index] = data
+            self.written += num_samples
+        return num_samples
+
+    def values_at(self, row, times):
+        """
+        Value on the output of channel row at the given times, holding the first/last value outside of the
+        generated range
+        """
+        task = self.task
+        if self.buffer is None or self.written == 0:
+            return np.zeros(len(times))
+
+        samples = np.floor((times - task.start_time) * task.timing.samp_clk_rate).astype(np.int64)
+        if self.regen_mode == RegenerationMode.ALLOW_REGENERATION:
+            period = min(self.written, self.buffer.shape[1])
+            return self.buffer[row, np.maximum(samples, 0) % period]
+
+        last = self.written - 1 if self.stopped_at is None else self.stopped_at - 1
+        oldest = max(0, self.written - self.buffer.shape[1])
+        samples = np.clip(samples, oldest, max(last, oldest))
+        return self.buffer[row, samples % self.buffer.shape[1]]
+
+
+class Task:
+    """
+    Simulated nidaqmx.Task
+    """
+
+    def __init__(self, new_task_name=""):
+        self.name = new_task_name
+        self.ai_channels = ChannelCollection(self)
+        self.ao_channels = ChannelCollection(self)
+        self.timing = Timing(self)
+        self.triggers = Triggers()
+        self.in_stream = InStream(self)
+        self.out_stream = OutStream(self)
+
+        self.is_started = False
+        self.start_time = 0.0
+        self.stop_time = 0.0
+
+        self.event_threads = []
+        self.events_stopped = threading.Event()
+
+    def clocked_samples(self):
+        """
+        Samples produced by the sample clock since the task was started
+        """
+        if self.start_time is None:
+            # armed and waiting for its start trigger
+            return 0
+        end = time.perf_counter() if self.is_started else self.stop_time
+        clocked = int((end - self.start_time) * self.timing.samp_clk_rate)
+        if self.timing.samp_quant_samp_mode == AcquisitionType.FINITE:
+            clocked = min(clocked, self.timing.samp_quant_samp_per_chan)
+        return max(clocked, 0)
+
+    def register_every_n_samples_acquired_into_buffer_event(self, sample_interval, callback_method):
+        self.event_threads.append(
+            (EveryNSamplesEventType.ACQUIRED_INTO_BUFFER, sample_interval, callback_method)
+        )
+
+    def register_every_n_samples_transferred_from_buffer_event(self, sample_interval, callback_method):
+        self.event_threads.append(
+            (EveryNSamplesEventType.TRANSFERRED_FROM_BUFFER, sample_interval, callback_method)
+        )
+
+    def run_event(self, event_type, sample_interval, callback_method):
+        """
+        Call callback_method every sample_interval samples of the clock, on its own thread like DAQmx does
+        """
+        count = 0
+        while True:
+            count += sample_interval
+            due = self.start_time + count / self.timing.samp_clk_rate
+            if self.events_stopped.wait(max(0.0, due - time.perf_counter())):
+                return
+            callback_method(id(self), event_type.value, sample_interval, None)
+
+    def start(self):
+        self.is_started = True
+        self.in_stream.read_position = 0
+        self.out_stream.stopped_at = None
+        if self.triggers.start_trigger.source_device is not None:
+            self.start_time = None
+            with system.lock:
+                system.armed_tasks.append(self)
+            return
+        self.begin(time.perf_counter())
+        if len(self.ai_channels):
+            system.fire_start_trigger(self.ai_channels[0].device, self.start_time)
+
+    def begin(self, start_time):
+        """
+        The sample clock starts running, either from start() or from the start trigger
+        """
+        self.start_time = start_time
+        if len(self.ao_channels):
+            with system.lock:
+                system.output_tasks.append(self)
+
+        self.events_stopped.clear()
+        for event in self.event_threads:
+            threading.Thread(target=self.run_event, args=event, daemon=True).start()
+
+    def stop(self):
+        if not self.is_started:
+            return
+        self.events_stopped.set()
+        with system.lock:
+            if self in system.armed_tasks:
+                system.armed_tasks.remove(self)
+                self.start_time = time.perf_counter()
+            if self in system.output_tasks:
+                now = np.array([time.perf_counter()])
+                for row, ch in enumerate(self.ao_channels):
+                    system.held_values[ch.number] = self.out_stream.values_at(row, now)[0]
+                system.output_tasks.remove(self)
+            self.stop_time = time.perf_counter()
+            self.is_started = False
+        self.out_stream.written = 0
+
+    def close(self):
+        self.stop()
+        self.event_threads = []
+
+
+class AnalogMultiChannelReader:
+    def __init__(self, task_in_stream):
+        self.in_stream = task_in_stream
+
+    def read_many_sample(self, data, number_of_samples_per_channel=READ_ALL_AVAILABLE, timeout=10.0):
+        return self.in_stream.read(data, number_of_samples_per_channel, timeout)
+
+
+class AnalogUnscaledReader:
+    def __init__(self, task_in_stream):
+        self.in_stream = task_in_stream
+
+    def read_int16(self, data, number_of_samples_per_channel=READ_ALL_AVAILABLE, timeout=10.0):
+        return self.in_stream.read(data, number_of_samples_per_channel, timeout, raw=True)
+
+
+class AnalogMultiChannelWriter:
+    def __init__(self, task_out_stream, auto_start=False):
+        self.out_stream = task_out_stream
+        self.auto_start = auto_start
+
+    def write_many_sample(self, data, timeout=10.0):
+        return self.out_stream.write(data, timeout)
+
+
+if __name__ == "__main__":
+    print("\nRunning throughput/latency demo of SignalReader and SignalWriterDAQ on the simulated DAQ\n")
+    import sys
+
+    import config
+
+    # the reader and writer pick their backend when they are imported
+    config.SIMULATED_DAQ = True
+    import sim_daq
+    from PyQt5 import QtCore
+    from reader import SignalReader
+    from writer import SignalWriterDAQ
+
+    rate, size, seconds = 10000, 1000, 5
+    app = QtCore.QCoreApplication(sys.argv)
+
+    writer = SignalWriterDAQ(
+        voltages=[1, 1, 1],
+        frequencies=[50, 50, 50],
+        shifts=[0, 120, 240],
+        output_states=[True, True, True],
+        sample_rate=rate,
+        sample_size=size,
+        channels=[0, 1, 2],
+        dev_name="Dev1",
+    )
+    writer.create_task()
+    reader = SignalReader(rate, size, channels=list(range(len(CHANNEL_NAMES_IN))), dev_name="Dev2")
+
+    latencies = []
+
+    def on_data(chunk):
+        # time between the last sample of the chunk being clocked in and the consumer receiving it
+        acquired_at = reader.task.start_time + (chunk.seq + 1) * size / rate
+        latencies.append(time.perf_counter() - acquired_at)
+        chunk.release()
+
+    reader.incoming_data.connect(on_data)
+    reader.start()
+    writer.resume()
+    QtCore.QTimer.singleShot(seconds * 1000, app.quit)
+    app.exec_()
+
+    reader.is_running = False
+    reader.wait()
+    writer.end()
+
+    latencies = np.array(latencies[1:]) * 1000
+    print("Chunks received:", len(latencies) + 1, "of", seconds * rate // size)
+    print("Throughput: %.0f samples/s per channel" % ((len(latencies) + 1) * size / seconds))
+    print("Latency: mean %.2f ms, max %.2f ms" % (latencies.mean(), latencies.max()))
+    print("Dropped chunks:", reader.pool.dropped)
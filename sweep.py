@@ -0,0 +1,160 @@
+import numpy as np
+
+from config import SWEEP_TYPES
+
+LINEAR_CHIRP, LOG_CHIRP, STEPPED = SWEEP_TYPES
+
+
+class FrequencySweep:
+    """
+    Frequency sweep source for SignalGeneratorBase/SignalWriterDAQ (see set_source()), every channel sweeps
+    the same frequency with its own amplitude and phase shift
+
+    Linear Chirp: the frequency rises linearly from start to end, f(u) = f0 + (f1 - f0) * u / T
+    Log Chirp: the frequency rises by the same factor every second, f(u) = f0 * (f1 / f0) ** (u / T)
+    Stepped: num_steps frequencies evenly spaced from start to end, each held for T / num_steps
+
+    The phase of every sample is computed in closed form from the time u into the sweep (for the stepped sweep
+    from a precomputed table of the phase at the start of every step), so a whole chunk is a handful of
+    array operations and the wave stays phase continuous across chunks, steps and repeats.
+    fill() sets frequency to the instantaneous frequency at the first sample of the chunk it wrote.
+    """
+
+    def __init__(self, voltages, shifts, start_frequency, end_frequency, duration,
+                 sweep_type=LINEAR_CHIRP, num_steps=10, repeat=False):
+        """
+        :param voltages: RMS voltage of each channel
+        :param shifts: phase shift in degrees of each channel, same convention as the writer's shifts
+        :param start_frequency: frequency in Hz at the start of the sweep
+        :param end_frequency: frequency in Hz at the end of the sweep
+        :param duration: seconds the sweep takes
+        :param sweep_type: one of SWEEP_TYPES
+        :param num_steps: number of frequencies of the stepped sweep
+        :param repeat: start over at the end, otherwise the outputs go to 0 once the sweep is done
+        """
+        if sweep_type == LOG_CHIRP and min(start_frequency, end_frequency) <= 0:
+            raise ValueError("A log chirp needs frequencies above 0 Hz")
+        self.amplitudes = np.array(voltages, dtype=np.float64) * np.sqrt(2)
+        # shifts delay the waves like they do for the oscillators, so they are taken off the phase in turns
+        self.shifts = np.array(shifts, dtype=np.float64) / -360
+        self.start_frequency = start_frequency
+        self.end_frequency = end_frequency
+        self.duration = duration
+        self.sweep_type = sweep_type
+        self.repeat = repeat
+
+        # stepped sweep: frequency of every step and the phase in turns at its start
+        self.step_frequencies = np.linspace(start_frequency, end_frequency, num_steps)
+        self.dwell = duration / num_steps
+        self.step_phases = np.concatenate(([0.0], np.cumsum(self.step_frequencies * self.dwell)[:-1]))
+        # phase in turns that a whole sweep moves on by
+        self.sweep_phase = self.phase_at(np.array([duration]))[0]
+
+        # samples since the start of the first sweep, counted in whole samples so the time of every sample
+        # is exact and the steps change on the sample they are due at however many chunks came before
+        self.position = 0
+        self.finished = False
+        # instantaneous frequency in Hz at the first sample of the last chunk, None once the sweep is done
+        self.frequency = start_frequency
+        self.ramp = np.empty(0)
+
+    @property
+    def num_channels(self):
+        return len(self.amplitudes)
+
+    def step_at(self, u):
+        """
+        :param u: seconds into a sweep, scalar or array
+        :return: index of the step of the stepped sweep at u, a sample landing on a step boundary belongs to the
+                 new step even when u / dwell comes out a rounding error below it
+        """
+        return np.floor(np.round(np.divide(u, self.dwell), 9)).astype(np.int64)
+
+    def phase_at(self, u):
+        """
+        :param u: array of seconds into a sweep, from 0 to duration
+        :return: phase in turns at every u
+        """
+        f0, f1, T = self.start_frequency, self.end_frequency, self.duration
+        if self.sweep_type == STEPPED:
+            step = np.minimum(self.step_at(u), len(self.step_frequencies) - 1)
+            return self.step_phases[step] + self.step_frequencies[step] * (u - step * self.dwell)
+        if self.sweep_type == LOG_CHIRP and f0 != f1:
+            rate = np.log(f1 / f0) / T
+            return f0 * np.expm1(rate * u) / rate
+        return f0 * u + (f1 - f0) * u * u / (2 * T)
+
+    def frequency_at(self, u):
+        """
+        :param u: seconds into a sweep, from 0 to duration
+        :return: instantaneous frequency in Hz at u
+        """
+        f0, f1, T = self.start_frequency, self.end_frequency, self.duration
+        if self.sweep_type == STEPPED:
+            step = min(int(self.step_at(u)), len(self.step_frequencies) - 1)
+            return self.step_frequencies[step]
+        if self.sweep_type == LOG_CHIRP:
+            return f0 * (f1 / f0) ** (u / T)
+        return f0 + (f1 - f0) * u / T
+
+    def fill(self, out, sample_rate):
+        """
+        Write the next chunk of the sweep into out, called from the writer callback
+
+        :param out: (channels x samples) array the chunk is written into
+        :param sample_rate: writer sample rate in samples per second
+        :return: out
+        """
+        n = out.shape[1]
+        if len(self.ramp) != n:
+            self.ramp = np.arange(n, dtype=np.float64)
+        if self.finished:
+            out[:] = 0
+            self.frequency = None
+            return out
+
+        t = (self.position + self.ramp) / sample_rate
+        # completed sweeps and the time into the current one
+        sweeps = np.floor(t / self.duration)
+        if not self.repeat:
+            np.minimum(sweeps, 0, out=sweeps)
+        u = np.minimum(t - sweeps * self.duration, self.duration)
+        self.frequency = self.frequency_at(u[0])
+
+        phase = self.phase_at(u)
+        # whole sweeps only add their fractional turn, so the phase stays small and continuous
+        phase += sweeps * (self.sweep_phase % 1)
+        np.add.outer(self.shifts, phase, out=out)
+        np.mod(out, 1, out=out)
+        out *= 2 * np.pi
+        np.sin(out, out=out)
+        out *= self.amplitudes[:, None]
+
+        if not self.repeat:
+            end = np.searchsorted(t, self.duration, side="right")
+            if end < n:
+                out[:, end:] = 0
+                self.finished = True
+        self.position += n
+        return out
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    print("\nRunning demo for FrequencySweep\n")
+    import time
+
+    rate, size = 10000, 1000
+    out = np.empty((3, size))
+    for sweep_type in SWEEP_TYPES:
+        sweep = FrequencySweep([1, 1, 1], [0, 90, 0], 10, 1000, 2.0, sweep_type, num_steps=5)
+        start = time.perf_counter()
+        frequencies = []
+        for i in range(20):
+            sweep.fill(out, rate)
+            frequencies.append(sweep.frequency)
+        elapsed = time.perf_counter() - start
+        print(sweep_type, "in", round(elapsed * 1000, 1), "ms, chunk frequencies:",
+              [round(f) for f in frequencies[::4]])
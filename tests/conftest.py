@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# the modules are flat at the top of the repo and pick the DAQ backend from config when they are imported
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import config  # noqa: E402
+
+config.DEBUG_MODE = False
+config.SIMULATED_DAQ = True
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    from PyQt5.QtWidgets import QApplication
+
+    return QApplication.instance() or QApplication([])
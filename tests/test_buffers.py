@@ -0,0 +1,117 @@
+import time
+
+import pytest
+from PyQt5 import QtCore
+
+from buffers import ChunkPool, ConsumerGate
+
+
+class Producer(QtCore.QObject):
+    incoming_data = QtCore.pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.pool = ChunkPool(2, 3, 10)
+
+    def produce(self):
+        chunk = self.pool.acquire()
+        chunk.timestamp = time.perf_counter()
+        self.pool.emit(chunk, self, self.incoming_data)
+        return chunk
+
+
+def test_chunk_pool_recycles_after_the_last_release():
+    pool = ChunkPool(2, 3, 10)
+    chunk = pool.acquire()
+    pool.publish(chunk, 2)
+    chunk.release()
+    assert chunk not in pool.free
+    chunk.release()
+    assert chunk in pool.free
+
+
+def test_chunk_pool_raises_on_extra_releases():
+    pool = ChunkPool(2, 3, 10)
+    chunk = pool.acquire()
+    pool.publish(chunk, 1)
+    chunk.release()
+    with pytest.raises(RuntimeError):
+        chunk.release()
+    assert pool.free.count(chunk) == 1
+    assert chunk.refs == 0
+
+
+def test_chunk_pool_recycles_unreceived_chunks_and_drops_when_empty():
+    pool = ChunkPool(1, 3, 10)
+    chunk = pool.acquire()
+    pool.publish(chunk, 0)
+    assert pool.acquire() is chunk
+    assert pool.acquire() is None
+    assert pool.dropped == 1
+
+
+def test_chunk_pool_retain_holds_the_chunk():
+    pool = ChunkPool(1, 3, 10)
+    chunk = pool.acquire()
+    pool.publish(chunk, 1)
+    chunk.retain()
+    chunk.release()
+    assert pool.acquire() is None
+    chunk.release()
+    assert pool.acquire() is chunk
+
+
+def test_emit_without_receivers_recycles_the_chunk():
+    producer = Producer()
+    chunk = producer.produce()
+    assert chunk in producer.pool.free
+
+
+def test_emit_releases_the_pool_lock_before_the_slots_run():
+    producer = Producer()
+    held = []
+
+    def slot(chunk):
+        held.append(producer.pool.lock.locked())
+        chunk.release()
+
+    producer.incoming_data.connect(slot)
+    producer.produce()
+    assert held == [False]
+
+
+def test_closed_gate_releases_every_chunk():
+    producer = Producer()
+    gate = ConsumerGate(producer.incoming_data)
+    assert not gate.is_open
+    for i in range(5):
+        chunk = producer.produce()
+        assert chunk in producer.pool.free
+
+
+def test_open_gate_passes_chunks_produced_after_it_opened():
+    producer = Producer()
+    gate = ConsumerGate(producer.incoming_data)
+    received = []
+
+    def slot(chunk):
+        received.append(chunk.timestamp)
+        chunk.release()
+
+    gate.open(slot)
+    chunk = producer.produce()
+    first = chunk.timestamp
+    assert received == [first]
+    assert chunk in producer.pool.free
+
+    # a chunk from before the gate opened is released without reaching the slot
+    stale = producer.pool.acquire()
+    stale.timestamp = 0.0
+    gate.open(slot)
+    producer.pool.emit(stale, producer, producer.incoming_data)
+    assert received == [first]
+    assert stale in producer.pool.free
+
+    gate.close()
+    producer.produce()
+    assert len(received) == 1
@@ -0,0 +1,100 @@
+import numpy as np
+from PyQt5 import QtCore
+
+from buffers import ChunkPool
+from calibration import CalibrationWindow
+from config import CALIBRATION_SWEEP_LEVELS, CHANNEL_NAMES_IN
+from writer import SignalGeneratorBase
+
+NUM_INPUTS = len(CHANNEL_NAMES_IN)
+
+
+def make_window(offsets=None, gains=None):
+    generator = SignalGeneratorBase([0, 0, 0], [0, 0, 0], [0, 0, 0], [True] * 3, 1000, 100)
+    offsets = np.zeros(NUM_INPUTS) if offsets is None else offsets
+    return CalibrationWindow(None, generator, generator, [0, 1, 2], list(range(NUM_INPUTS)), offsets, gains)
+
+
+def collect(window):
+    corrected = []
+
+    def on_corrected(chunk):
+        corrected.append((chunk.data.copy(), chunk.seq))
+        chunk.release()
+
+    window.corrected_data.connect(on_corrected, QtCore.Qt.DirectConnection)
+    return corrected
+
+
+def test_apply_calibration_scales_raw_counts(qapp):
+    offsets = np.linspace(-0.2, 0.2, NUM_INPUTS)
+    gains = np.linspace(0.9, 1.1, NUM_INPUTS)
+    window = make_window(offsets, gains)
+    corrected = collect(window)
+
+    pool = ChunkPool(1, NUM_INPUTS, 200, np.int16)
+    chunk = pool.acquire()
+    chunk.set_num_samples(150)
+    chunk.data[:] = np.random.default_rng(0).integers(-32768, 32767, (NUM_INPUTS, 150), dtype=np.int16)
+    chunk.scaling = np.zeros((NUM_INPUTS, 3))
+    chunk.scaling[:, 0] = 0.01
+    chunk.scaling[:, 1] = np.linspace(3e-4, 3.2e-4, NUM_INPUTS)
+    chunk.scaling[:, 2] = 1e-10
+    chunk.seq = 7
+    raw = chunk.data.astype(np.float64)
+    volts = chunk.scaling[:, :1] + chunk.scaling[:, 1:2] * raw + chunk.scaling[:, 2:] * raw ** 2
+    pool.publish(chunk, 1)
+
+    window.apply_calibration(chunk)
+
+    # the reader's chunk goes back to its pool right away
+    assert chunk in pool.free
+    assert len(corrected) == 1
+    data, seq = corrected[0]
+    assert seq == 7
+    assert data.shape == (NUM_INPUTS, 150)
+    np.testing.assert_allclose(data, volts * gains[:, None] + offsets[:, None], atol=1e-12)
+
+
+def test_apply_calibration_matches_for_raw_and_volts(qapp):
+    window = make_window(np.full(NUM_INPUTS, 0.1), np.full(NUM_INPUTS, 2.0))
+    corrected = collect(window)
+    scaling = np.zeros((NUM_INPUTS, 2))
+    scaling[:, 1] = 1e-3
+    counts = np.arange(NUM_INPUTS * 100, dtype=np.int16).reshape(NUM_INPUTS, 100)
+
+    raw_pool = ChunkPool(1, NUM_INPUTS, 100, np.int16)
+    chunk = raw_pool.acquire()
+    chunk.data[:] = counts
+    chunk.scaling = scaling
+    raw_pool.publish(chunk, 1)
+    window.apply_calibration(chunk)
+
+    volts_pool = ChunkPool(1, NUM_INPUTS, 100)
+    chunk = volts_pool.acquire()
+    chunk.data[:] = counts * 1e-3
+    volts_pool.publish(chunk, 1)
+    window.apply_calibration(chunk)
+
+    np.testing.assert_allclose(corrected[0][0], corrected[1][0], atol=1e-12)
+    np.testing.assert_allclose(corrected[1][0], counts * 2e-3 + 0.1, atol=1e-12)
+
+
+def test_calibration_fit_recovers_gains_and_offsets(qapp):
+    saved_offsets = np.full(NUM_INPUTS, 0.5)
+    window = make_window(saved_offsets)
+
+    slopes = np.linspace(0.8, 1.2, NUM_INPUTS)
+    intercepts = np.linspace(-0.1, 0.1, NUM_INPUTS)
+    # the last input isn't connected to anything
+    slopes[-1] = 0
+    window.level_means[:] = np.multiply.outer(window.sweep_levels, slopes) + intercepts
+    window.level_counts[:] = 100
+    window.level_m2[:] = 0
+    window.fit_sweep()
+
+    np.testing.assert_allclose(window.gains[:-1], 1 / slopes[:-1])
+    np.testing.assert_allclose(window.offsets[:-1], -intercepts[:-1] / slopes[:-1], atol=1e-12)
+    assert window.gains[-1] == 1
+    assert window.offsets[-1] == 0.5
+    assert window.sweep_levels.shape == (CALIBRATION_SWEEP_LEVELS,)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from delay import measure_delays
+from sweep import FrequencySweep
+
+
+def test_measure_delays_on_synthetic_chirps():
+    rate, period = 10000, 10000
+    sweep = FrequencySweep([1, 1, 1], [0, 0, 0], 10, 2000, period / rate, repeat=True)
+    excitation = sweep.fill(np.empty((3, period)), rate)
+    # Y arrives 1.25 samples after X, Z 3 samples after and through a 1 ms low pass
+    spectra = np.fft.rfft(excitation, axis=1)
+    frequencies = np.fft.rfftfreq(period, 1 / rate)
+    delays = np.array([0, 1.25, 3]) / rate
+    spectra *= np.exp(-2j * np.pi * np.multiply.outer(delays, frequencies))
+    spectra[2] /= 1 + 2j * np.pi * frequencies * 0.001
+    outputs = np.fft.irfft(spectra, period, axis=1)
+    responses = outputs[[0, 0, 1, 1, 2]] + np.random.default_rng(0).normal(0, 0.01, (5, period))
+
+    correction, connected = measure_delays(excitation, responses, [0, 0, 1, 1, 2], rate, (10, 2000))
+
+    assert connected.all()
+    assert correction.reference == 0
+    np.testing.assert_allclose(correction.delays[:4] * rate, [0, 0, 1.25, 1.25], atol=0.05)
+    expected = 360 * 100 * delays + np.degrees(np.arctan(2 * np.pi * 100 * 0.001)) * np.array([0, 0, 1])
+    # the table holds the lag averaged over bands of the chirp, good to a fraction of a degree
+    np.testing.assert_allclose(correction.lags_at([100, 100, 100]), expected, atol=1)
+
+
+def test_measure_delays_rejects_unconnected_inputs():
+    excitation = FrequencySweep([1, 1, 1], [0, 0, 0], 10, 200, 1).fill(np.empty((3, 1000)), 1000)
+    responses = np.random.default_rng(0).normal(0, 0.01, (5, 1000))
+    with pytest.raises(ValueError):
+        measure_delays(excitation, responses, [0, 0, 1, 1, 2], 1000, (10, 200))
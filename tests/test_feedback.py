@@ -0,0 +1,69 @@
+import time
+
+import numpy as np
+
+from buffers import ChunkPool
+from feedback import FeedbackController
+from writer import SignalGeneratorBase
+
+
+def make_controller():
+    writer = SignalGeneratorBase([1, 1, 1], [250] * 3, [0, 0, 0], [True] * 3, 10000, 200)
+    writer.is_running = True
+    controller = FeedbackController(writer, 10000, [0, 1, 2])
+    controller.enable(True)
+    controller.settled_at = 0.0
+    return writer, controller
+
+
+def make_chunk(pool, num_samples, amplitude):
+    chunk = pool.acquire()
+    chunk.set_num_samples(num_samples)
+    t = np.arange(num_samples) / 10000
+    chunk.data[:] = amplitude * np.sin(2 * np.pi * 250 * t)
+    chunk.timestamp = time.perf_counter()
+    pool.publish(chunk, 1)
+    return chunk
+
+
+def test_feedback_skips_short_chunks():
+    writer, controller = make_controller()
+    pool = ChunkPool(1, 3, 200)
+    chunk = make_chunk(pool, 1, 1.0)
+    controller.on_new_data(chunk)
+    assert chunk in pool.free
+    assert controller.updates == 0
+    assert (writer.voltage_trims == 1).all()
+
+
+def test_feedback_trims_a_low_output():
+    writer, controller = make_controller()
+    pool = ChunkPool(1, 3, 200)
+    # every input measures 80% of the set 1 V RMS
+    controller.on_new_data(make_chunk(pool, 200, 0.8 * np.sqrt(2)))
+    assert controller.updates == 1
+    assert np.isfinite(writer.voltage_trims).all()
+    assert (writer.voltage_trims > 1).all()
+
+
+def count_params_changed(writer):
+    calls = []
+    writer.params_changed = lambda: calls.append(1)
+    return calls
+
+
+def test_feedback_only_signals_trims_that_moved():
+    writer, controller = make_controller()
+    calls = count_params_changed(writer)
+    pool = ChunkPool(1, 3, 200)
+    # on target, the trims don't move
+    controller.on_new_data(make_chunk(pool, 200, np.sqrt(2)))
+    controller.settled_at = 0.0
+    controller.on_new_data(make_chunk(pool, 200, 1.0001 * np.sqrt(2)))
+    assert controller.updates == 2
+    assert calls == []
+
+    controller.settled_at = 0.0
+    controller.on_new_data(make_chunk(pool, 200, 0.8 * np.sqrt(2)))
+    assert calls == [1]
+    np.testing.assert_array_equal(controller.signalled_voltage_trims, writer.voltage_trims)
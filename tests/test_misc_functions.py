@@ -0,0 +1,36 @@
+import numpy as np
+
+from misc_functions import OscillatorBank, WavetableCache
+
+PARAMS = ([1, 0.5, 0.2], [50, 20, 0], [0, 90, 0], [True, True, True], 10000)
+
+
+def test_oscillator_bank_is_continuous_across_chunks():
+    whole = OscillatorBank(3).generate_waves(*PARAMS, 1500, np.empty((3, 1500)))
+    bank = OscillatorBank(3)
+    chunks = [bank.generate_waves(*PARAMS, 500, np.empty((3, 500))) for i in range(3)]
+    np.testing.assert_allclose(np.hstack(chunks), whole, atol=1e-9)
+
+
+def test_oscillator_bank_cached_output_matches_synthesized():
+    cached = OscillatorBank(3, WavetableCache())
+    synthesized = OscillatorBank(3)
+    for i in range(10):
+        expected = synthesized.generate_waves(*PARAMS, 700, np.empty((3, 700)))
+        np.testing.assert_allclose(cached.generate_waves(*PARAMS, 700, np.empty((3, 700))), expected, atol=1e-9)
+    assert cached.plan is not None
+
+
+def test_oscillator_bank_set_phases_drops_the_plan():
+    bank = OscillatorBank(3, WavetableCache())
+    for i in range(3):
+        bank.generate_waves(*PARAMS, 700, np.empty((3, 700)))
+    bank.set_phases([0.25, 0.5, 0])
+    reference = OscillatorBank(3)
+    reference.generate_waves(*PARAMS, 700, np.empty((3, 700)))
+    reference.set_phases([0.25, 0.5, 0])
+    np.testing.assert_allclose(
+        bank.generate_waves(*PARAMS, 700, np.empty((3, 700))),
+        reference.generate_waves(*PARAMS, 700, np.empty((3, 700))),
+        atol=1e-9,
+    )
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from playback import WaveformPlayback
+
+
+def play(playback, chunks, sample_rate, sample_size):
+    out = np.empty((playback.num_channels, sample_size))
+    played = [playback.fill(out, sample_rate).copy() for i in range(chunks)]
+    playback.close()
+    return np.hstack(played)
+
+
+@pytest.fixture
+def save(tmp_path):
+    def save(waveform):
+        path = str(tmp_path / "waveform.npy")
+        np.save(path, waveform)
+        return path
+    return save
+
+
+def test_playback_resamples_to_the_writer_rate(save):
+    # a ramp is reproduced exactly by linear interpolation
+    path = save(np.vstack([np.arange(10000.0), -np.arange(10000.0)]))
+    out = play(WaveformPlayback(path, file_rate=1000), 10, 2500, 250)
+    expected = np.arange(2500) * 0.4
+    np.testing.assert_allclose(out[0], expected, atol=1e-9)
+    np.testing.assert_allclose(out[1], -expected, atol=1e-9)
+
+
+def test_playback_downsamples_a_sine(save):
+    t = np.arange(20000) / 10000
+    path = save(np.sin(2 * np.pi * 5 * t)[np.newaxis])
+    out = play(WaveformPlayback(path, file_rate=10000), 4, 1000, 250)
+    np.testing.assert_allclose(out[0], np.sin(2 * np.pi * 5 * np.arange(1000) / 1000), atol=1e-9)
+
+
+def test_playback_loops_over_the_file(save):
+    waveform = np.vstack([np.arange(300.0), np.arange(300.0) * 2])
+    out = play(WaveformPlayback(save(waveform), file_rate=1000, loop=True), 5, 1000, 200)
+    np.testing.assert_array_equal(out, np.tile(waveform, 4)[:, :1000])
+
+
+def test_playback_goes_to_zero_after_the_end(save):
+    waveform = np.ones((1, 300))
+    playback = WaveformPlayback(save(waveform), file_rate=1000, loop=False)
+    out = play(playback, 3, 1000, 200)
+    np.testing.assert_array_equal(out[0, :300], 1)
+    np.testing.assert_array_equal(out[0, 300:], 0)
+    assert playback.finished
+    assert playback.starved == 0
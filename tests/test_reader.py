@@ -0,0 +1,134 @@
+import time
+
+import numpy as np
+import pytest
+from PyQt5 import QtCore
+
+import sim_daq
+from config import ADAPTIVE_HYSTERESIS, ADAPTIVE_MIN_SAMPLES, ADAPTIVE_STEP_SAMPLES, READER_POOL_SIZE
+from reader import CALLBACK_MODE, ChunkSizeController, SignalReader
+from writer import SignalWriterDAQ
+
+
+def wait_for(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def run_reader(reader, seconds, first_delay=0.0):
+    sizes = []
+
+    def on_data(chunk):
+        sizes.append(chunk.num_samples)
+        chunk.release()
+        if len(sizes) == 1:
+            time.sleep(first_delay)
+
+    reader.incoming_data.connect(on_data, QtCore.Qt.DirectConnection)
+    reader.start()
+    time.sleep(seconds)
+    reader.is_running = False
+    reader.wait()
+    return sizes
+
+
+def test_callback_mode_reads_whole_chunks(qapp):
+    reader = SignalReader(1000, 100, [0, 1, 2, 3, 4], mode=CALLBACK_MODE)
+    # the slow first consumer holds up the next event until half a chunk more than it is for has come in,
+    # that leftover waits for the event after instead of going out as a short chunk
+    sizes = run_reader(reader, 1.5, first_delay=0.15)
+    assert set(sizes) == {100}
+    assert 13 <= len(sizes) <= 15
+
+
+@pytest.fixture
+def wiring():
+    yield sim_daq.system
+    # back to the default wiring for the other tests
+    sim_daq.system.loopback.clear()
+
+
+def test_devices_start_on_the_master_trigger_with_aligned_rows(qapp, wiring):
+    for ai in range(5):
+        wiring.set_loopback(ai, source=0, gain=1.0, offset=0.0, noise=0.0, delay=0.0)
+    writer = SignalWriterDAQ([1, 0, 0], [37, 0, 0], [0, 0, 0], [True] * 3, 10000, 500, [0, 1, 2])
+    writer.create_task()
+    # Dev2 is the master, its rows aren't next to each other so it also goes through its scratch buffer
+    reader = SignalReader(1000, 100, [0, 1, 2, 3, 4], dev_name=["Dev2", "Dev3", "Dev2", "Dev3", "Dev3"])
+    chunks = []
+
+    def on_data(chunk):
+        chunks.append(chunk.data.copy())
+        chunk.release()
+
+    reader.incoming_data.connect(on_data, QtCore.Qt.DirectConnection)
+    writer.resume()
+    reader.start()
+    try:
+        # a slave started after the master would miss the trigger and never deliver a chunk
+        assert wait_for(lambda: len(chunks) >= 5, 3)
+        master, slave = reader.devices
+        assert master.name == "Dev2" and slave.name == "Dev3"
+        assert master.task.triggers.start_trigger.source_device is None
+        assert slave.task.triggers.start_trigger.source_device == "Dev2"
+        assert slave.task.start_time == master.task.start_time
+    finally:
+        reader.is_running = False
+        reader.wait()
+        writer.end()
+    for data in chunks[1:]:
+        assert data[0].std() > 0.1
+        for row in range(1, 5):
+            np.testing.assert_allclose(data[row], data[0], atol=1e-9)
+
+
+def settle(controller, updates, *args):
+    for i in range(updates):
+        size = controller.update(controller.num_samples, *args)
+    return size
+
+
+def test_chunk_size_starts_from_the_largest_chunk():
+    controller = ChunkSizeController()
+    controller.reset(10000, 2000)
+    assert controller.num_samples == 2000
+
+
+def test_chunk_size_meets_the_latency_target():
+    controller = ChunkSizeController(target_latency=0.05, cpu_budget=0.1)
+    controller.reset(10000, 2000)
+    size = settle(controller, 50, 0.0, 0.01, 0)
+    # (0.05 - 0.01) s at 10 kHz, within the hysteresis
+    assert abs(size - 400) <= ADAPTIVE_HYSTERESIS * size
+    assert size % ADAPTIVE_STEP_SAMPLES == 0
+
+
+def test_chunk_size_is_clipped_to_its_range():
+    controller = ChunkSizeController(target_latency=0.001)
+    controller.reset(10000, 2000)
+    assert settle(controller, 50, 0.0, 0.0, 0) == ADAPTIVE_MIN_SAMPLES
+    # consumers taking 5 s per chunk want far more than the largest chunk
+    assert settle(controller, 50, 0.0, 5.0, 0) == 2000
+
+
+def test_chunk_size_keeps_up_before_latency():
+    controller = ChunkSizeController(target_latency=0.05, cpu_budget=0.1)
+    controller.reset(10000, 5000)
+    # 10 ms of reader CPU per chunk needs 1000 samples to stay within 10 % of the thread's time
+    assert abs(settle(controller, 50, 0.01, 0.0, 0) - 1000) <= 200
+    controller.reset(10000, 5000)
+    settle(controller, 50, 0.0, 0.0, 0)
+    small = controller.num_samples
+    # consumers sitting on the pool double the chunk
+    assert controller.update(small, 0.0, 0.0, READER_POOL_SIZE - 1) == 2 * small
+
+
+def test_chunk_size_ignores_small_changes():
+    controller = ChunkSizeController(target_latency=0.05)
+    controller.reset(10000, 2000)
+    size = settle(controller, 50, 0.0, 0.0, 0)
+    assert size == 500
+    # 0.004 s of consumer delay moves the target to 460, within the hysteresis
+    assert settle(controller, 50, 0.0, 0.004, 0) == 500
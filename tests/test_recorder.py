@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+
+from buffers import ChunkPool
+from config import RECORDER_QUEUE_SIZE
+from recorder import CORRECTED_STREAM, HEADER_SIZE, RAW_STREAM, SignalRecorder, read_recording
+
+
+def make_chunk(pool, seq, value):
+    chunk = pool.acquire()
+    chunk.set_num_samples(100)
+    chunk.data[:] = value
+    chunk.seq = seq
+    chunk.timestamp = seq * 0.1
+    pool.publish(chunk, 1)
+    return chunk
+
+
+def test_recording_reads_back_with_its_header(tmp_path):
+    path = str(tmp_path / "test.daq")
+    recorder = SignalRecorder(path, {"sample_rate": 1000, "channels": ["X1", "X2"]}, extent_size=4096)
+    raw = ChunkPool(2, 2, 100, np.int16)
+    corrected = ChunkPool(2, 2, 100)
+    recorder.start()
+    for seq in range(20):
+        recorder.on_raw_data(make_chunk(raw, seq, seq))
+        recorder.on_corrected_data(make_chunk(corrected, seq, seq / 10))
+    recorder.stop()
+
+    metadata, records = read_recording(path)
+    assert metadata == {"sample_rate": 1000, "channels": ["X1", "X2"]}
+    assert recorder.dropped == 0
+    assert len(records) == 40
+    raw_records = [r for r in records if r[0] == RAW_STREAM]
+    corrected_records = [r for r in records if r[0] == CORRECTED_STREAM]
+    for seq, (stream, record_seq, timestamp, data) in enumerate(raw_records):
+        assert record_seq == seq
+        assert timestamp == seq * 0.1
+        assert data.dtype == np.int16
+        assert (data == seq).all()
+    for seq, (stream, record_seq, timestamp, data) in enumerate(corrected_records):
+        assert data.dtype == np.float64
+        assert (data == seq / 10).all()
+
+
+def test_recording_grows_by_extents_and_is_trimmed(tmp_path):
+    path = str(tmp_path / "test.daq")
+    recorder = SignalRecorder(path, {}, extent_size=4096)
+    pool = ChunkPool(1, 2, 100)
+    recorder.start()
+    # every record is bigger than a quarter extent, so the file has to grow a few times
+    for seq in range(10):
+        recorder.on_raw_data(make_chunk(pool, seq, seq))
+    recorder.stop()
+
+    size = os.path.getsize(path)
+    assert size == recorder.offset
+    assert size > HEADER_SIZE + 4096
+    assert len(read_recording(path)[1]) == 10
+
+
+def test_stalled_disk_drops_without_holding_the_readers_chunks(tmp_path):
+    recorder = SignalRecorder(str(tmp_path / "test.daq"), {})
+    # the writing thread isn't started, so nothing leaves the recorder's buffers
+    pool = ChunkPool(1, 2, 100)
+    for seq in range(RECORDER_QUEUE_SIZE + 3):
+        chunk = make_chunk(pool, seq, seq)
+        recorder.on_raw_data(chunk)
+        assert chunk in pool.free
+    assert pool.dropped == 0
+    assert recorder.dropped == 3
+    assert recorder.queue.qsize() == RECORDER_QUEUE_SIZE
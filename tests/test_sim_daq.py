@@ -0,0 +1,79 @@
+import time
+
+import pytest
+from PyQt5 import QtCore
+
+import sim_daq
+from config import SIM_GAIN, SIM_NOISE, SIM_OFFSET
+from reader import SignalReader
+from writer import SignalWriterDAQ
+
+
+def wait_for(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def loopback():
+    yield sim_daq.system
+    sim_daq.system.set_loopback(0, source=0, gain=SIM_GAIN, offset=SIM_OFFSET, noise=SIM_NOISE, delay=0.0)
+
+
+def test_inputs_loop_back_from_the_outputs(qapp, loopback):
+    loopback.set_loopback(0, gain=2.0, offset=0.5, noise=0.0)
+    writer = SignalWriterDAQ([1, 0, 0], [0, 0, 0], [0, 0, 0], [True, False, False], 1000, 100, [0, 1, 2])
+    writer.create_task()
+    reader = SignalReader(1000, 100, [0, 1, 2, 3, 4])
+    means = []
+
+    def on_data(chunk):
+        means.append(chunk.data[0].mean())
+        chunk.release()
+
+    reader.incoming_data.connect(on_data, QtCore.Qt.DirectConnection)
+    writer.resume()
+    reader.start()
+    try:
+        assert wait_for(lambda: len(means) >= 8, 3)
+    finally:
+        reader.is_running = False
+        reader.wait()
+        writer.end()
+    # 1 V DC out, through a gain of 2 and a 0.5 V offset
+    assert means[-1] == pytest.approx(2.5)
+
+
+def test_injected_overrun_stops_the_reader_with_an_error(qapp):
+    reader = SignalReader(1000, 100, [0, 1, 2, 3, 4])
+    errors = []
+    reader.read_error.connect(errors.append, QtCore.Qt.DirectConnection)
+    reader.start()
+    time.sleep(0.3)
+    sim_daq.system.inject_overrun()
+    assert reader.wait(2000)
+    assert len(errors) == 1
+    assert "keep up" in errors[0]
+
+
+def test_injected_underflow_stops_the_generation(qapp):
+    writer = SignalWriterDAQ([1, 1, 1], [50, 50, 50], [0, 0, 0], [True] * 3, 1000, 100, [0, 1, 2])
+    writer.create_task()
+    # the write thread would restart the task, only the device is looked at here
+    writer.stop_updates()
+    writer.task.start()
+    try:
+        time.sleep(0.1)
+        sim_daq.system.inject_underflow()
+        stream = writer.task.out_stream
+        stopped_at = stream.stopped_at
+        assert stopped_at is not None
+        time.sleep(0.1)
+        assert stream.total_samp_per_chan_generated == stopped_at
+        with pytest.raises(sim_daq.DaqError) as error:
+            writer.writer.write_many_sample(writer.output_waveform)
+        assert error.value.error_code == sim_daq.GEN_STOPPED_TO_PREVENT_REGEN_OF_OLD_SAMPLES
+    finally:
+        writer.end()
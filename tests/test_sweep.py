@@ -0,0 +1,31 @@
+import numpy as np
+
+from misc_functions import OscillatorBank
+from sweep import STEPPED, FrequencySweep
+
+
+def test_sweep_shifts_match_the_oscillators():
+    voltages, shifts, rate = [1, 0.5, 0.2], [0, -90, 45], 10000
+    sweep = FrequencySweep(voltages, shifts, 40, 40, 10)
+    bank = OscillatorBank(3)
+    for i in range(3):
+        expected = bank.generate_waves(voltages, [40] * 3, shifts, [True] * 3, rate, 500, np.empty((3, 500)))
+        np.testing.assert_allclose(sweep.fill(np.empty((3, 500)), rate), expected, atol=1e-9)
+
+
+def test_stepped_sweep_tags_the_chunk_a_step_starts_on():
+    # 0.1 s steps aren't exact in floating point, the steps must still change on the sample they are due at
+    sweep = FrequencySweep([1, 1, 1], [0, 0, 0], 10, 30, 0.3, STEPPED, num_steps=3)
+    out = np.empty((3, 50))
+    frequencies = []
+    for i in range(6):
+        sweep.fill(out, 1000)
+        frequencies.append(sweep.frequency)
+    assert frequencies == [10, 10, 20, 20, 30, 30]
+
+
+def test_sweep_phase_is_continuous_across_chunks():
+    whole = FrequencySweep([1, 1, 1], [0, 30, 60], 10, 200, 1).fill(np.empty((3, 1000)), 1000)
+    sweep = FrequencySweep([1, 1, 1], [0, 30, 60], 10, 200, 1)
+    chunks = [sweep.fill(np.empty((3, 125)), 1000) for i in range(8)]
+    np.testing.assert_allclose(np.hstack(chunks), whole, atol=1e-9)
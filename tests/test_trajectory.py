@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from trajectory import FieldTrajectory, GridScan, Precession, Spiral, make_path
+
+
+class DirectControl:
+    """
+    Stands in for a magnetic control, every coil gets one of the path's values as its voltage
+    """
+
+    num_channels = 3
+
+    def __init__(self, frequency):
+        self.frequency = frequency
+
+    def coil_signals(self, phi, theta, amplitude):
+        voltages = np.stack((phi, theta, amplitude))
+        return voltages, np.zeros_like(voltages)
+
+
+def test_grid_scan_snakes_over_the_grid():
+    scan = GridScan([0, 45], [0, 90, 180], 2.0, dwell=1.0)
+    phi, theta, amplitude = scan(np.arange(7) + 0.5)
+    np.testing.assert_array_equal(phi, [0, 0, 0, 45, 45, 45, 0])
+    np.testing.assert_array_equal(theta, [0, 90, 180, 180, 90, 0, 0])
+    np.testing.assert_array_equal(amplitude, 2.0)
+
+
+def test_grid_scan_moves_over_the_transition():
+    scan = GridScan([0], [0, 90], 1.0, dwell=1.0, transition=0.5)
+    phi, theta, amplitude = scan(np.array([0.0, 1.0, 1.25, 1.5, 1.75]))
+    np.testing.assert_allclose(theta, [0, 0, 45, 90, 90])
+
+
+def test_spiral_goes_back_and_forth_between_the_elevations():
+    spiral = Spiral(10, 70, turns=2, duration=2, amplitude=1.0)
+    phi, theta, amplitude = spiral(np.array([0.0, 1.0, 2.0, 3.0, 4.0]))
+    np.testing.assert_allclose(phi, [10, 40, 70, 40, 10])
+    np.testing.assert_allclose(theta, [0, 360, 720, 1080, 1440])
+
+
+def test_precession_keeps_the_cone_angle():
+    precession = Precession(30, 60, cone_angle=20, rate=0.5, amplitude=1.0)
+    phi, theta, amplitude = precession(np.linspace(0, 2, 50))
+    phi, theta = np.radians(phi), np.radians(theta)
+    directions = np.stack((np.cos(phi) * np.cos(theta), np.cos(phi) * np.sin(theta), np.sin(phi)))
+    np.testing.assert_allclose(np.degrees(np.arccos(precession.axis @ directions)), 20, atol=1e-9)
+
+
+def test_make_path_rejects_unknown_paths():
+    with pytest.raises(ValueError):
+        make_path("Figure Eight", 1.0)
+
+
+def test_trajectory_follows_the_path_sample_by_sample():
+    path = Spiral(0, 60, turns=1, duration=1, amplitude=1.5)
+    trajectory = FieldTrajectory(DirectControl(0), path)
+    chunks = [trajectory.fill(np.empty((3, 100)), 1000).copy() for i in range(5)]
+    phi, theta, amplitude = path(np.arange(500) / 1000)
+    np.testing.assert_allclose(np.hstack(chunks), np.stack((phi, theta, amplitude)), atol=1e-9)
+
+
+def test_trajectory_carrier_is_continuous_across_chunks():
+    path = GridScan([0], [0], 1.0, dwell=1.0)
+    whole = FieldTrajectory(DirectControl(37), path).fill(np.empty((3, 1000)), 10000)
+    trajectory = FieldTrajectory(DirectControl(37), path)
+    chunks = [trajectory.fill(np.empty((3, 250)), 10000).copy() for i in range(4)]
+    np.testing.assert_allclose(np.hstack(chunks), whole, atol=1e-9)
+    # the amplitude channel is the RMS voltage of a 37 Hz sine
+    np.testing.assert_allclose(whole[2], np.sqrt(2) * np.sin(2 * np.pi * 37 * np.arange(1000) / 10000), atol=1e-9)
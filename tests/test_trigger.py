@@ -0,0 +1,62 @@
+import numpy as np
+
+from trigger import ABOVE_LEVEL, RISING_EDGE, TriggerEngine
+
+
+def run(engine, data, chunk_size):
+    captures = []
+    engine.captured.connect(lambda capture, pre: captures.append((capture.copy(), pre)))
+    for i in range(0, data.shape[1], chunk_size):
+        engine.process(data[:, i:i + chunk_size])
+    return captures
+
+
+def test_rising_edge_capture_spans_chunks():
+    # a ramp on the second channel gives every sample's index
+    data = np.vstack([np.zeros(1000), np.arange(1000.0)])
+    data[0, 430:] = 1
+    engine = TriggerEngine(channel=0, mode=RISING_EDGE, level=0.5, pre_samples=100, post_samples=150)
+    engine.arm()
+    captures = run(engine, data, 64)
+    assert len(captures) == 1
+    capture, pre = captures[0]
+    assert pre == 100
+    np.testing.assert_array_equal(capture[1], np.arange(330, 580))
+    assert not engine.is_armed
+
+
+def test_no_trigger_before_the_ring_is_full():
+    data = np.vstack([np.zeros(600), np.arange(600.0)])
+    data[0, 10:20] = 1
+    data[0, 300:] = 1
+    engine = TriggerEngine(channel=0, mode=RISING_EDGE, level=0.5, pre_samples=100, post_samples=50)
+    engine.arm()
+    captures = run(engine, data, 64)
+    # the edge at 10 has only 10 samples before it
+    assert len(captures) == 1
+    capture, pre = captures[0]
+    assert capture[1, pre] == 300
+    assert not np.isnan(capture).any()
+
+
+def test_level_trigger_waits_for_the_pre_trigger_samples():
+    data = np.vstack([np.ones(400), np.arange(400.0)])
+    engine = TriggerEngine(channel=0, mode=ABOVE_LEVEL, level=0.5, pre_samples=100, post_samples=50)
+    engine.arm()
+    captures = run(engine, data, 30)
+    capture, pre = captures[0]
+    np.testing.assert_array_equal(capture[1], np.arange(150))
+
+
+def test_forced_trigger_rearms():
+    data = np.vstack([np.zeros(500), np.arange(500.0)])
+    engine = TriggerEngine(pre_samples=50, post_samples=50, rearm=True)
+    engine.arm()
+    engine.process(data[:, :100])
+    captures = []
+    engine.captured.connect(lambda capture, pre: captures.append(capture.copy()))
+    engine.force()
+    engine.process(data[:, 100:200])
+    assert len(captures) == 1
+    np.testing.assert_array_equal(captures[0][1], np.arange(50, 150))
+    assert engine.is_armed
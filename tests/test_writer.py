@@ -0,0 +1,161 @@
+import time
+
+import numpy as np
+import pytest
+
+import sim_daq
+from writer import CoilCoupling, FillLevelController, SignalWriterDAQ
+
+
+def wait_for(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def make_writer(voltages=(1, 0.5, 0.2), frequencies=(50, 20, 0), sample_rate=1000, sample_size=100):
+    writer = SignalWriterDAQ(
+        list(voltages), list(frequencies), [0, 90, 0], [True] * 3, sample_rate, sample_size, [0, 1, 2]
+    )
+    writer.create_task()
+    return writer
+
+
+# --- FillLevelController --- #
+
+def test_fill_level_starts_with_a_chunk_of_headroom():
+    controller = FillLevelController(target_latency=0)
+    controller.reset(1000, 100, 1000)
+    assert controller.target >= 2 * 100
+
+
+def test_fill_level_keeps_the_learned_timing_on_resume():
+    controller = FillLevelController(target_latency=0)
+    controller.reset(1000, 100, 1000)
+    controller.update(0.05, 0.01)
+    target = controller.target
+    controller.reset(1000, 100, 1000)
+    assert controller.target == target
+
+
+def test_fill_level_adds_a_chunk_for_every_underflow():
+    controller = FillLevelController(target_latency=0)
+    controller.reset(1000, 100, 1000)
+    target = controller.target
+    controller.on_underflow()
+    assert controller.target == target + 100
+
+
+def test_writer_resumes_without_underflowing(qapp):
+    writer = make_writer()
+    try:
+        for i in range(2):
+            writer.resume()
+            time.sleep(1)
+            writer.pause()
+            assert writer.underflows == 0
+    finally:
+        writer.end()
+
+
+@pytest.mark.parametrize("ramp_time", [0.0, 0.05])
+def test_writer_outputs_hold_zero_after_pause(qapp, ramp_time):
+    writer = make_writer(frequencies=(50, 20, 0))
+    writer.oscillators.ramp_time = ramp_time
+    try:
+        writer.resume()
+        time.sleep(0.5)
+        writer.pause()
+        now = np.array([time.perf_counter()])
+        for ao in range(3):
+            assert sim_daq.system.held_values[ao] == 0
+            assert sim_daq.system.output_values(ao, now)[0] == 0
+    finally:
+        writer.end()
+
+
+def test_writer_restarts_after_an_underflow_reported_on_write(qapp):
+    writer = make_writer()
+    writer.resume()
+    try:
+        time.sleep(0.3)
+        # the generation stops with samples still queued, the next write fails with the regeneration error
+        sim_daq.system.inject_underflow()
+        assert wait_for(lambda: writer.underflows == 1, 2)
+        time.sleep(0.5)
+        assert writer.updating
+        assert writer.underflows == 1
+        assert writer.task.out_stream.stopped_at is None
+    finally:
+        writer.pause()
+        writer.end()
+
+
+def test_writer_leaves_static_output_in_phase(qapp):
+    writer = SignalWriterDAQ([1, 0.5, 0.2], [37, 20, 0], [0, 90, 0], [True] * 3, 10000, 500, [0, 1, 2])
+    writer.static_output = True
+    writer.create_task()
+    try:
+        writer.resume()
+        deadline = time.perf_counter() + 5
+        while not writer.is_static and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        assert writer.is_static
+        loop = writer.task.out_stream.buffer.copy()
+
+        # every streamed chunk continues the looping buffer where the device is when it plays it
+        chunks = []
+        callback = writer.callback
+
+        def record():
+            callback()
+            chunks.append((writer.samples_written - writer.sample_size, writer.output_waveform.copy()))
+
+        writer.callback = record
+        writer.params_changed()
+        time.sleep(0.3)
+        assert chunks
+        for start, data in chunks[:4]:
+            index = (start + np.arange(data.shape[1])) % loop.shape[1]
+            np.testing.assert_allclose(data, loop[:, index], atol=1e-9)
+    finally:
+        writer.end()
+
+
+# --- CoilCoupling --- #
+
+def phasors(amplitudes, shifts):
+    return amplitudes * np.exp(-1j * np.radians(shifts))
+
+
+def test_coupling_drives_produce_the_target_fields():
+    cross = [[0, 0.1, -0.05], [0.08, 0, 0.02], [0.03, -0.04, 0]]
+    coupling = CoilCoupling(gains=(1.2, 0.9, 2.0), cross=cross, lags=(5, -3, 12))
+    targets = np.array([[1.0, -0.5], [0.25, 0.0], [-2.0, 0.75]])
+    shifts = np.array([[0, 30], [90, 0], [45, -60]])
+    amplitudes, drive_shifts = coupling.drive(targets, shifts)
+    # every coil's field lags its drive
+    drives = phasors(amplitudes, drive_shifts + coupling.lags[:, None])
+    np.testing.assert_allclose(coupling.matrix @ drives, phasors(targets, shifts), atol=1e-12)
+    # the sign goes on the amplitude, the shift stays near the target's
+    assert np.all(np.abs(drive_shifts - shifts) <= 90 + 1e-9)
+
+
+def test_uncoupled_coils_get_their_gain_times_the_field():
+    coupling = CoilCoupling(gains=(1, 1, 2))
+    amplitudes, shifts = coupling.drive(np.array([0.5, -1.0, 1.0]), 0)
+    np.testing.assert_allclose(amplitudes, [0.5, -1.0, 2.0])
+    np.testing.assert_allclose(shifts, 0, atol=1e-12)
+
+
+def test_singular_or_zero_gain_coupling_keeps_the_previous_inverse():
+    coupling = CoilCoupling(gains=(1, 1, 1), cross=[[0, 0.1, 0], [0, 0, 0], [0, 0, 0]])
+    matrix, drive_matrix = coupling.matrix.copy(), coupling.drive_matrix.copy()
+    # coils 0 and 1 make the exact same field
+    coupling.cross = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 0]], dtype=np.float64)
+    coupling.update()
+    coupling.gains = np.array([1.0, 0.0, 1.0])
+    coupling.update()
+    np.testing.assert_array_equal(coupling.matrix, matrix)
+    np.testing.assert_array_equal(coupling.drive_matrix, drive_matrix)
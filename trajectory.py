@@ -0,0 +1,199 @@
+import numpy as np
+
+from config import TRAJECTORY_PATHS
+
+GRID_SCAN, SPIRAL, PRECESSION = TRAJECTORY_PATHS
+
+"""
+Time parameterized field paths for MagneticAlignment and MagneticRotation
+
+A path is called with an array of times in seconds and returns the elevation (phi) and azimuth (theta)
+in degrees and the amplitude at every one of them, all as arrays shaped like the times. FieldTrajectory
+plays a path through a magnetic control on the writer, a whole chunk at a time.
+"""
+
+
+class GridScan:
+    """
+    Raster scan over a grid of field directions
+    Every direction is held for dwell seconds, the field moves on to the next one over the first transition
+    seconds of its dwell. Every other row is scanned backwards so the field only takes small steps, and the
+    scan starts over once the last direction has been held.
+    """
+
+    def __init__(self, elevations, azimuths, amplitude, dwell, transition=0.0):
+        """
+        :param elevations: elevations in degrees, one row of the scan each
+        :param azimuths: azimuths in degrees scanned along every row
+        :param amplitude: field amplitude
+        :param dwell: seconds spent at every direction
+        :param transition: seconds the move to the next direction takes, 0 to step
+        """
+        phi, theta = np.meshgrid(elevations, azimuths, indexing="ij")
+        theta[1::2] = theta[1::2, ::-1]
+        self.points = np.stack((phi.ravel(), theta.ravel()))
+        self.amplitude = amplitude
+        self.dwell = dwell
+        self.transition = min(transition, dwell)
+        self.duration = dwell * self.points.shape[1]
+
+    def __call__(self, t):
+        num_points = self.points.shape[1]
+        index = (t // self.dwell).astype(np.int64)
+        current = self.points[:, index % num_points]
+        # the very first direction is not moved to from anywhere
+        previous = self.points[:, np.maximum(index - 1, 0) % num_points]
+        if self.transition > 0:
+            blend = np.clip((t - index * self.dwell) / self.transition, 0, 1)
+            current = previous + (current - previous) * blend
+        return current[0], current[1], np.full(t.shape, float(self.amplitude))
+
+
+class Spiral:
+    """
+    The azimuth turns at a constant rate while the elevation moves from start to end and back again,
+    so the field direction spirals over the band between the two elevations
+    """
+
+    def __init__(self, elevation_start, elevation_end, turns, duration, amplitude):
+        """
+        :param elevation_start: elevation in degrees at the start
+        :param elevation_end: elevation in degrees reached after duration seconds
+        :param turns: azimuth turns on the way from start to end
+        :param duration: seconds from the start elevation to the end elevation
+        :param amplitude: field amplitude
+        """
+        self.elevation_start = elevation_start
+        self.elevation_end = elevation_end
+        self.turns = turns
+        self.duration = duration
+        self.amplitude = amplitude
+
+    def __call__(self, t):
+        u = t / self.duration
+        # triangle wave from 0 to 1 and back, so the elevation doesn't jump when the spiral starts over
+        progress = 1 - np.abs(u % 2 - 1)
+        phi = self.elevation_start + (self.elevation_end - self.elevation_start) * progress
+        theta = 360 * self.turns * u
+        return phi, theta, np.full(t.shape, float(self.amplitude))
+
+
+class Precession:
+    """
+    The field direction circles around an axis at a constant angle (the cone angle), like a precessing spin
+    """
+
+    def __init__(self, axis_elevation, axis_azimuth, cone_angle, rate, amplitude):
+        """
+        :param axis_elevation: elevation of the axis in degrees
+        :param axis_azimuth: azimuth of the axis in degrees
+        :param cone_angle: angle between the field and the axis in degrees
+        :param rate: turns around the axis per second
+        :param amplitude: field amplitude
+        """
+        phi, theta = np.radians(axis_elevation), np.radians(axis_azimuth)
+        # the axis and two directions at right angles to it
+        self.axis = np.array([np.cos(phi) * np.cos(theta), np.cos(phi) * np.sin(theta), np.sin(phi)])
+        self.up = np.array([-np.sin(phi) * np.cos(theta), -np.sin(phi) * np.sin(theta), np.cos(phi)])
+        self.side = np.cross(self.axis, self.up)
+        self.cone_angle = np.radians(cone_angle)
+        self.rate = rate
+        self.amplitude = amplitude
+
+    def __call__(self, t):
+        angle = 2 * np.pi * self.rate * t
+        direction = np.cos(self.cone_angle) * self.axis[:, None] + np.sin(self.cone_angle) * (
+            np.multiply.outer(self.up, np.cos(angle)) + np.multiply.outer(self.side, np.sin(angle))
+        )
+        phi = np.degrees(np.arcsin(np.clip(direction[2], -1, 1)))
+        theta = np.degrees(np.arctan2(direction[1], direction[0]))
+        return phi, theta, np.full(t.shape, float(self.amplitude))
+
+
+class FieldTrajectory:
+    """
+    Writer source (see SignalGeneratorBase.set_source()) that moves the field of a MagneticAlignment or
+    MagneticRotation along a path
+    The path and the control's coil_signals() are evaluated for every sample of a chunk at once, so the
+    field moves smoothly within a chunk at the full output rate. The carrier at the control's frequency
+    stays phase continuous from chunk to chunk, at 0 Hz the coils get the DC levels like the oscillators do.
+    """
+
+    def __init__(self, control, path):
+        """
+        :param control: MagneticAlignment or MagneticRotation providing coil_signals() and the frequency
+        :param path: callable returning (elevations, azimuths, amplitudes) for an array of times
+        """
+        self.control = control
+        self.path = path
+        self.num_channels = control.num_channels
+        # seconds since the start of the path and carrier phase in turns at the next sample
+        self.time = 0.0
+        self.phase = 0.0
+        # only sweeps tag their chunks with a frequency
+        self.frequency = None
+        self.ramp = np.empty(0)
+
+    def fill(self, out, sample_rate):
+        """
+        Write the next chunk of the trajectory into out, called from the writer callback
+
+        :param out: (channels x samples) array the chunk is written into
+        :param sample_rate: writer sample rate in samples per second
+        :return: out
+        """
+        n = out.shape[1]
+        if len(self.ramp) != n:
+            self.ramp = np.arange(n, dtype=np.float64)
+
+        phi, theta, amplitude = self.path(self.time + self.ramp / sample_rate)
+        voltages, shifts = self.control.coil_signals(phi, theta, amplitude)
+
+        step = self.control.frequency / sample_rate
+        if step == 0:
+            np.copyto(out, voltages)
+        else:
+            np.subtract(self.phase + step * self.ramp, shifts / 360, out=out)
+            out *= 2 * np.pi
+            np.sin(out, out=out)
+            # RMS to amplitude
+            out *= voltages
+            out *= np.sqrt(2)
+            self.phase = (self.phase + step * n) % 1
+        self.time += n / sample_rate
+        return out
+
+    def close(self):
+        pass
+
+
+def make_path(name, amplitude, **settings):
+    """
+    Build one of the TRAJECTORY_PATHS from the Field Trajectory settings
+
+    :param name: one of TRAJECTORY_PATHS
+    :param amplitude: field amplitude
+    :param settings: the keyword arguments of the path's class
+    """
+    if name == GRID_SCAN:
+        return GridScan(amplitude=amplitude, **settings)
+    if name == SPIRAL:
+        return Spiral(amplitude=amplitude, **settings)
+    if name == PRECESSION:
+        return Precession(amplitude=amplitude, **settings)
+    raise ValueError("Unknown trajectory path " + str(name))
+
+
+if __name__ == "__main__":
+    print("\nRunning demo for the trajectory paths\n")
+
+    t = np.linspace(0, 4, 9)
+    for path in (
+        GridScan([0, 45], [0, 90, 180], 1.0, dwell=0.5, transition=0.1),
+        Spiral(0, 60, turns=2, duration=2, amplitude=1.0),
+        Precession(90, 0, cone_angle=30, rate=0.25, amplitude=1.0),
+    ):
+        phi, theta, amplitude = path(t)
+        print(type(path).__name__)
+        print("  elevation", phi.round(1))
+        print("  azimuth  ", theta.round(1))
@@ -0,0 +1,279 @@
+import time
+
+import numpy as np
+from PyQt5 import QtCore
+
+from config import CHANNEL_NAMES_IN, TRIGGER_MODES
+
+(
+    RISING_EDGE,
+    FALLING_EDGE,
+    ABOVE_LEVEL,
+    BELOW_LEVEL,
+    ENTER_WINDOW,
+    LEAVE_WINDOW,
+    INSIDE_WINDOW,
+    OUTSIDE_WINDOW,
+) = TRIGGER_MODES
+
+EDGE_MODES = (RISING_EDGE, FALLING_EDGE, ENTER_WINDOW, LEAVE_WINDOW)
+
+
+class TriggerEngine(QtCore.QObject):
+    """
+    Captures the samples around a trigger event out of the continuous stream without interrupting it
+
+    Every chunk is pushed through a preallocated ring holding the last pre_samples samples of every channel.
+    While armed the trigger condition is evaluated on the whole chunk at once, and on the first hit the
+    ring and the chunk are copied into the capture buffer, which then fills up with post_samples more
+    samples from the following chunks. force() triggers on the first sample of the next chunk, eg. when
+    the signal output is started. Nothing triggers before pre_samples samples have come in, so every
+    capture is complete from its first sample.
+
+    captured: emitted with (capture, pre_samples) once a capture is complete, capture is the
+              (channels x (pre_samples + post_samples)) capture buffer, the trigger sample is at pre_samples.
+              The buffer is reused by the next capture, copy it to keep it around.
+    """
+
+    captured = QtCore.pyqtSignal(object, int)
+
+    def __init__(self, channel=0, mode=RISING_EDGE, level=0.0, window=(-1.0, 1.0),
+                 pre_samples=1000, post_samples=1000, rearm=False):
+        """
+        :param channel: index into CHANNEL_NAMES_IN of the channel the condition is evaluated on
+        :param mode: one of TRIGGER_MODES
+        :param level: threshold in volts of the edge and level modes
+        :param window: (low, high) bounds in volts of the window modes
+        :param pre_samples: samples per channel kept from before the trigger
+        :param post_samples: samples per channel captured from the trigger sample on
+        :param rearm: arm again after every capture instead of capturing once
+        """
+        super().__init__()
+        self.channel = channel
+        self.mode = mode
+        self.level = level
+        self.window = window
+        self.rearm = rearm
+
+        self.is_armed = False
+        self.forced = False
+        # samples still missing from the capture in progress, 0 when not capturing
+        self.remaining = 0
+        self.capture_length = 0
+        self.timestamp = 0.0
+
+        self.ring = None
+        self.capture = None
+        self.state = np.empty(0, dtype=bool)
+        self.hits = np.empty(0, dtype=bool)
+        # condition at the last sample evaluated, None when there is no sample before the next chunk
+        self.previous_state = None
+        self.set_spans(pre_samples, post_samples)
+
+    def set_spans(self, pre_samples, post_samples):
+        """
+        Change the captured spans, the buffers are reallocated on the next chunk
+        """
+        self.pre_samples = pre_samples
+        self.post_samples = post_samples
+        self.ring = None
+        self.remaining = 0
+
+    def allocate(self, num_channels):
+        """
+        Preallocate the pre-trigger ring and the capture buffer
+        """
+        self.ring = np.zeros((num_channels, self.pre_samples))
+        # next column of the ring to be written, the oldest sample is there once the ring is full
+        self.head = 0
+        # samples written to the ring so far, up to pre_samples
+        self.filled = 0
+        self.capture = np.empty((num_channels, self.pre_samples + self.post_samples))
+
+    def arm(self):
+        self.is_armed = True
+        self.previous_state = None
+
+    def disarm(self):
+        self.is_armed = False
+        self.forced = False
+        self.remaining = 0
+
+    def force(self):
+        """
+        Trigger on the first sample of the next chunk if armed
+        """
+        if self.is_armed:
+            self.forced = True
+
+    def on_new_data(self, chunk):
+        """
+        Run one corrected chunk from the CalibrationWindow through the trigger
+        """
+        self.process(chunk.data)
+        chunk.release()
+
+    def process(self, data):
+        """
+        Run one chunk of data through the trigger
+
+        :param data: (channels x samples) array in volts
+        """
+        num_samples = data.shape[1]
+        if self.ring is None or self.ring.shape[0] != len(data):
+            self.allocate(len(data))
+
+        start = 0
+        if self.remaining > 0:
+            start = self.continue_capture(data, 0)
+        # first sample with pre_samples samples before it, from the ring and the chunk
+        earliest = self.pre_samples - self.filled
+        # with rearm set the rest of the chunk can hold further triggers
+        while self.is_armed and self.remaining == 0 and start < num_samples:
+            index = self.find_trigger(data[self.channel], start, earliest)
+            if index is None:
+                break
+            self.start_capture(data, index)
+            start = self.continue_capture(data, index)
+
+        self.push(data, num_samples)
+
+    def find_trigger(self, x, start, earliest=0):
+        """
+        Evaluate the trigger condition on the samples of the trigger channel from start on
+
+        :param earliest: index of the first sample that is allowed to trigger
+        :return: index of the first sample that triggers, None if there is none
+        """
+        if self.forced:
+            if max(start, earliest) >= len(x):
+                return None
+            self.forced = False
+            return max(start, earliest)
+        x = x[start:]
+        num_samples = len(x)
+
+        if len(self.state) < num_samples:
+            self.state = np.empty(num_samples, dtype=bool)
+            self.hits = np.empty(num_samples, dtype=bool)
+        state = self.state[:num_samples]
+        hits = self.hits[:num_samples]
+
+        low, high = self.window
+        if self.mode in (RISING_EDGE, ABOVE_LEVEL):
+            np.greater_equal(x, self.level, out=state)
+        elif self.mode in (FALLING_EDGE, BELOW_LEVEL):
+            np.less(x, self.level, out=state)
+        else:
+            np.greater_equal(x, low, out=state)
+            np.less_equal(x, high, out=hits)
+            np.logical_and(state, hits, out=state)
+            if self.mode in (LEAVE_WINDOW, OUTSIDE_WINDOW):
+                np.logical_not(state, out=state)
+
+        if self.mode in EDGE_MODES:
+            # the condition became true since the sample before, carried over from the previous chunk
+            hits[0] = self.previous_state is not None and state[0] and not self.previous_state
+            np.greater(state[1:], state[:-1], out=hits[1:])
+        else:
+            hits = state
+        self.previous_state = state[-1]
+        if earliest > start:
+            hits[: earliest - start] = False
+
+        index = int(np.argmax(hits))
+        if not hits[index]:
+            return None
+        return start + index
+
+    def start_capture(self, data, index):
+        """
+        Copy the pre-trigger samples, from the ring and the chunk, into the capture buffer
+        """
+        self.timestamp = time.time()
+        from_chunk = min(index, self.pre_samples)
+        from_ring = self.pre_samples - from_chunk
+        if from_ring:
+            self.read_ring(self.capture[:, :from_ring])
+        self.capture[:, from_ring:self.pre_samples] = data[:, index - from_chunk:index]
+        self.capture_length = self.pre_samples
+        self.remaining = self.post_samples
+
+    def continue_capture(self, data, start):
+        """
+        Copy post-trigger samples from start on, emits the capture once it is complete
+
+        :return: index of the first sample of data that was not captured
+        """
+        stop = min(data.shape[1], start + self.remaining)
+        end = self.capture_length + stop - start
+        self.capture[:, self.capture_length:end] = data[:, start:stop]
+        self.capture_length = end
+        self.remaining -= stop - start
+
+        if self.remaining == 0:
+            if not self.rearm:
+                self.is_armed = False
+            self.previous_state = None
+            self.captured.emit(self.capture, self.pre_samples)
+        return stop
+
+    def push(self, data, num_samples):
+        """
+        Write the chunk into the pre-trigger ring, only its last pre_samples samples are kept
+        """
+        size = self.pre_samples
+        if size == 0:
+            return
+        self.filled = min(size, self.filled + num_samples)
+        if num_samples >= size:
+            self.ring[:] = data[:, num_samples - size:num_samples]
+            self.head = 0
+            return
+        first = min(num_samples, size - self.head)
+        self.ring[:, self.head:self.head + first] = data[:, :first]
+        self.ring[:, : num_samples - first] = data[:, first:num_samples]
+        self.head = (self.head + num_samples) % size
+
+    def read_ring(self, out):
+        """
+        Copy the newest out.shape[1] samples of the ring into out, oldest first
+        """
+        count = out.shape[1]
+        begin = (self.head - count) % self.pre_samples
+        first = min(count, self.pre_samples - begin)
+        out[:, :first] = self.ring[:, begin:begin + first]
+        out[:, first:] = self.ring[:, : count - first]
+
+    def save_capture(self, path, sample_rate):
+        """
+        Save the last complete capture as a .npz file
+
+        :param sample_rate: samples per second of the captured data
+        """
+        np.savez(
+            path,
+            data=self.capture,
+            pre_samples=self.pre_samples,
+            sample_rate=sample_rate,
+            channel_names=CHANNEL_NAMES_IN,
+            trigger_channel=CHANNEL_NAMES_IN[self.channel],
+            mode=self.mode,
+            level=self.level,
+            window=self.window,
+            timestamp=self.timestamp,
+        )
+        print("Saved capture to", path)
+
+
+if __name__ == "__main__":
+    print("\nRunning demo for TriggerEngine\n")
+    t = np.arange(5000) / 1000
+    signal = np.vstack([np.sin(2 * np.pi * 3 * t), np.cos(2 * np.pi * 3 * t)])
+    engine = TriggerEngine(channel=0, mode=RISING_EDGE, level=0.5, pre_samples=100, post_samples=300)
+    engine.captured.connect(
+        lambda capture, pre: print("Captured", capture.shape, "trigger value", capture[0, pre])
+    )
+    engine.arm()
+    for i in range(0, 5000, 128):
+        engine.process(signal[:, i:i + 128])
@@ -1,13 +1,103 @@
 from ast import Raise
-import nidaqmx
+import threading
+import time
+
 import numpy as np
-from nidaqmx.constants import AcquisitionType, RegenerationMode
-from nidaqmx.stream_writers import AnalogMultiChannelWriter
 from PyQt5 import QtCore
 
 # --- From DAQ Control --- #
-from config import CHANNEL_NAMES_OUT
-from misc_functions import WaveGenerator
+from buffers import ChunkPool
+from config import (
+    CHANNEL_NAMES_OUT,
+    READER_POOL_SIZE,
+    SIMULATED_DAQ,
+    STATIC_SETTLE_CHUNKS,
+    WRITER_BUFFER_CHUNKS,
+    WRITER_FILL_BINS,
+    WRITER_JITTER_WINDOW,
+    WRITER_MARGIN_DECAY,
+    WRITER_SAFETY_FACTOR,
+)
+
+if SIMULATED_DAQ:
+    import sim_daq as nidaqmx
+    from sim_daq import (
+        GEN_STOPPED_TO_PREVENT_REGEN_OF_OLD_SAMPLES,
+        AcquisitionType,
+        AnalogMultiChannelWriter,
+        RegenerationMode,
+        WriteRelativeTo,
+    )
+else:
+    import nidaqmx
+    from nidaqmx.constants import AcquisitionType, RegenerationMode, WriteRelativeTo
+    from nidaqmx.error_codes import DAQmxErrors
+    from nidaqmx.stream_writers import AnalogMultiChannelWriter
+
+    GEN_STOPPED_TO_PREVENT_REGEN_OF_OLD_SAMPLES = DAQmxErrors.GEN_STOPPED_TO_PREVENT_REGEN_OF_OLD_SAMPLES
+from metrics import Histogram, MetricsLog
+from misc_functions import OscillatorBank, WavetableCache
+
+
+class FillLevelController:
+    """
+    Picks how many samples the write thread of the SignalWriterDAQ keeps queued on the output device
+
+    A parameter change reaches the outputs once the samples queued before it have been generated, so the
+    queue should be no longer than target_latency. It must never run dry either: the queue drops to a chunk
+    below the target before the next write, and the write can come late by however long the thread takes to
+    wake up and write, so the smallest safe target is
+        n_safe = sample_size + WRITER_SAFETY_FACTOR * (wake_late + write_time) * sample_rate + margin
+    with the worst wake_late + write_time of the last WRITER_JITTER_WINDOW writes, but never less than a chunk
+    of lateness: the write is only due once a whole chunk is missing, so with no headroom the queue would be
+    empty by the time it comes (eg. right after resuming, before any write was timed). Every underflow adds a
+    chunk to margin which is only given back slowly. Not underflowing wins over latency: the target is
+    max(target_latency * sample_rate, n_safe) clipped to the buffer size
+    """
+
+    def __init__(self, target_latency=0.1):
+        """
+        :param target_latency: seconds from a parameter change to the outputs
+        """
+        self.target_latency = target_latency
+        self.count = 0
+        self.reset(1000, 1000, 4000)
+
+    def reset(self, sample_rate, sample_size, buffer_length):
+        """
+        Start over for a new sample rate, chunk size or buffer, the timing learned so far is kept otherwise
+        """
+        if self.count and (sample_rate, sample_size, buffer_length) == \
+                (self.sample_rate, self.sample_size, self.buffer_length):
+            return
+        self.sample_rate = sample_rate
+        self.sample_size = sample_size
+        self.buffer_length = buffer_length
+        self.delays = np.zeros(WRITER_JITTER_WINDOW)
+        self.count = 0
+        self.margin = 0.0
+
+    @property
+    def target(self):
+        """
+        Samples to keep queued on the device
+        """
+        n_latency = self.target_latency * self.sample_rate
+        lateness = max(WRITER_SAFETY_FACTOR * self.delays.max() * self.sample_rate, self.sample_size)
+        n_safe = self.sample_size + lateness + self.margin
+        return int(min(max(n_latency, n_safe), self.buffer_length))
+
+    def update(self, wake_late, write_time):
+        """
+        :param wake_late: seconds the write thread woke up after the write was due
+        :param write_time: seconds spent generating and writing the chunk
+        """
+        self.delays[self.count % len(self.delays)] = wake_late + write_time
+        self.count += 1
+        self.margin *= 1 - WRITER_MARGIN_DECAY
+
+    def on_underflow(self):
+        self.margin += self.sample_size
 
 
 class SignalGeneratorBase(QtCore.QObject):
@@ -19,7 +109,11 @@ class SignalGeneratorBase(QtCore.QObject):
 
     Is also inherited by SignalWriterDAQ which allows the generated waveform to be sent to the actual hardware
 
-    incoming_data: pyqtSignal that is emitted with the output waveform periodically
+    incoming_data: pyqtSignal that is emitted with a Chunk holding a copy of the output waveform periodically,
+    slots connected to it must call chunk.release() like they would for SignalReader
+
+    The outputs are the sine/DC waves of the oscillator bank, or an arbitrary waveform when a source
+    (eg. WaveformPlayback) is set with set_source()
     """
 
     # uses generated waveform as simulated input data
@@ -37,14 +131,26 @@ class SignalGeneratorBase(QtCore.QObject):
         super().__init__()
 
         self.is_running = False
+        self.seq = 0
 
         self.num_channels = len(CHANNEL_NAMES_OUT)
-        self.wave_gen = [WaveGenerator() for i in range(self.num_channels)]
+        self.oscillators = OscillatorBank(self.num_channels, WavetableCache())
+        # arbitrary waveform played instead of the oscillators, see set_source()
+        self.source = None
 
         self.voltages = voltages
         self.frequencies = frequencies
         self.shifts = shifts
         self.output_states = output_states
+        # corrections of the FeedbackController, the oscillators get the voltages scaled by voltage_trims
+        # and shift_trims added to the shifts
+        self.voltage_trims = np.ones(self.num_channels)
+        self.shift_trims = np.zeros(self.num_channels)
+        self.trimmed_voltages = np.empty(self.num_channels)
+        self.trimmed_shifts = np.empty(self.num_channels)
+        # DelayCorrection whose lags are taken off the shifts so the outputs come out with the set phases,
+        # None to play the shifts as they are
+        self.phase_correction = None
 
         # TODO: change ability to dynamically change sample rate/size in UI settings
         self.sample_rate = sample_rate  # resolution (signals/second)
@@ -72,13 +178,37 @@ class SignalGeneratorBase(QtCore.QObject):
         self._sample_size = value
         self.output_waveform = np.empty(
             shape=(self.num_channels, self.sample_size))
+        # simulated input chunks, recycled the same way as the SignalReader's
+        self.pool = ChunkPool(READER_POOL_SIZE, self.num_channels, self.sample_size)
 
     def realign_channel_phases(self):
         """
         Makes sure all waveforms start at the same place so phase shifts work as intended for multi-channel processes
         """
-        for i in range(self.num_channels):
-            self.wave_gen[i].reset_counter()
+        self.oscillators.reset_phases()
+
+    def params_changed(self):
+        """
+        Called after the voltages, frequencies, shifts or output states were changed from the UI
+        Nothing to do when the waves are computed on every callback anyway
+        """
+        pass
+
+    def set_source(self, source):
+        """
+        Play an arbitrary waveform instead of the sine waves
+
+        :param source: object with num_channels, frequency and fill(out, sample_rate) (eg. WaveformPlayback
+                       or FrequencySweep), None to go back to the sine waves
+        """
+        if source is not None and source.num_channels != self.num_channels:
+            raise ValueError(
+                "Waveform has " + str(source.num_channels) + " channels, the writer has " + str(self.num_channels)
+            )
+        old_source = self.source
+        self.source = source
+        if old_source is not None:
+            old_source.close()
 
     def on_offsets_received(self, data):
         """
@@ -86,24 +216,49 @@ class SignalGeneratorBase(QtCore.QObject):
         """
         self.offsets = data
 
+    def output_latency(self):
+        """
+        Seconds until a parameter change is fully on the outputs: the chunk already generated plus the ramp
+        """
+        return self.sample_size / self.sample_rate + self.oscillators.ramp_time
+
     def callback(self):
         """
         callback for the Debug sig_gen to create simulated signal and send directly to data reader
         """
-        for i in range(self.num_channels):
-            if self.output_states[i]:
-                self.output_waveform[i] = self.wave_gen[i].generate_wave(
-                    self.voltages[i],
-                    self.frequencies[i],
-                    self.shifts[i],
-                    self.sample_rate,
-                    self.sample_size,
-                )
-            else:
-                self.output_waveform[i] = np.zeros(self.sample_size)
+        if self.source is None:
+            np.multiply(self.voltages, self.voltage_trims, out=self.trimmed_voltages)
+            np.add(self.shifts, self.shift_trims, out=self.trimmed_shifts)
+            if self.phase_correction is not None:
+                self.trimmed_shifts -= self.phase_correction.lags_at(self.frequencies)
+            # every channel in one pass, straight into the preallocated output_waveform
+            self.oscillators.generate_waves(
+                self.trimmed_voltages,
+                self.frequencies,
+                self.trimmed_shifts,
+                self.output_states,
+                self.sample_rate,
+                self.sample_size,
+                out=self.output_waveform,
+            )
+        else:
+            self.source.fill(self.output_waveform, self.sample_rate)
+            # channels that are off keep following the source so they stay in step with the others
+            self.output_waveform[np.logical_not(self.output_states)] = 0
 
         # use as debug simulated input signal
-        self.incoming_data.emit(self.output_waveform)
+        # copy into a pooled chunk so consumers don't see the next callback overwrite it
+        consumers = self.receivers(self.incoming_data)
+        if consumers:
+            chunk = self.pool.acquire()
+            if chunk is None:
+                return
+            np.copyto(chunk.data, self.output_waveform)
+            chunk.frequency = None if self.source is None else self.source.frequency
+            chunk.seq = self.seq
+            chunk.timestamp = time.perf_counter()
+            self.seq += 1
+            self.pool.emit(chunk, self, self.incoming_data)
 
     def resume(self):
         """
@@ -116,7 +271,7 @@ class SignalGeneratorBase(QtCore.QObject):
         # samples / (samples / sec) = sec * 1000 ms / sec = time to output all samples in the buffer
         self.signal_time = 1000 * (self.sample_size / self.sample_rate)
         self.callback()  # clear buffer with new data to make sure it's not empty
-        self.timer.start(self.signal_time)
+        self.start_updates()
 
     def pause(self):
         """
@@ -127,17 +282,43 @@ class SignalGeneratorBase(QtCore.QObject):
         self.output_states = [False for x in range(self.num_channels)]
         # clear the buffer with new data
         self.callback()
+        # the outputs ramp down when ramping is on, let them get all the way to 0
+        while self.source is None and self.oscillators.ramping:
+            self.callback()
         self.callback()
+        self.stop_updates()
+
+    def start_updates(self):
+        """
+        Start calling callback() once every chunk duration
+        """
+        self.timer.start(int(self.signal_time))
+
+    def stop_updates(self):
+        """
+        Stop the periodic callback() calls
+        """
         self.timer.stop()
 
     def end(self):
         self.is_running = False
-        self.timer.stop()
+        self.stop_updates()
+        if self.source is not None:
+            self.source.close()
 
 
 class SignalWriterDAQ(SignalGeneratorBase):
     """
     Signal writer object for writing signals to the actual NI DAQ hardware when they are plugged in
+
+    The chunks are written from a thread of its own that follows the device buffer instead of a GUI timer,
+    so the output keeps going while the UI is busy (see run()). How much is kept queued on the device is
+    picked by fill_level, a FillLevelController. Methods called from the GUI thread take the lock so they
+    never run in the middle of a write.
+
+    With static_output set, an output that stays unchanged for STATIC_SETTLE_CHUNKS callbacks is handed over
+    to the device: a whole number of periods is written once with regeneration allowed and the device loops
+    it without any further writes, until params_changed() switches back to streaming
     """
 
     def __init__(
@@ -174,6 +355,41 @@ class SignalWriterDAQ(SignalGeneratorBase):
         self.output_channels = channels
         self.daq_out_name = dev_name
 
+        self.static_output = False
+        self.is_static = False
+        self.static_refused = False
+        self.task_running = False
+        # samples written since the task was started, to know how far ahead of the generation the writes are
+        self.samples_written = 0
+        # perf_counter time the task was last started from output sample 0, None while it is stopped, and the
+        # first row of frequency_log written for that start
+        self.started_at = None
+        self.started_row = 0
+
+        self.lock = threading.RLock()
+        # set by the every N samples transferred event and whenever the state changes to wake up run()
+        self.state_changed = threading.Event()
+        self.fill_level = FillLevelController()
+        self.updating = False
+        self.thread_running = False
+        self.thread = None
+        # perf_counter time the next write is due at
+        self.write_due = 0.0
+
+        # per write health of the output
+        # queued_samples: samples left on the device when the write started, 0 is an underflow
+        # target_samples: queue length fill_level is aiming for
+        # write_ms: time spent generating and writing the chunk
+        # wake_late_ms: time the write thread woke up after the write was due
+        self.metrics = MetricsLog(
+            ["writes", "queued_samples", "target_samples", "write_ms", "wake_late_ms", "underflows"]
+        )
+        self.writes = 0
+        self.underflows = 0
+        # frequency of every chunk written while sweeping, by its first sample since the task was started
+        self.frequency_log = MetricsLog(["output_sample", "frequency_hz"])
+        self.fill_histogram = Histogram(0, 1, WRITER_FILL_BINS)
+
     def create_task(self):
         """
         Create the NI task for writing to DAQ
@@ -194,10 +410,8 @@ class SignalWriterDAQ(SignalGeneratorBase):
             channel_name = self.daq_out_name + "/ao" + str(ch)
             self.task.ao_channels.add_ao_voltage_chan(channel_name)
 
-        # signals_in_buffer configures the buffer on the device to be bigger than
-        # the sample_size so that there won't be a chance of it over-filling the buffer
-        signals_in_buffer = 4
-        buffer_length = self.sample_size * signals_in_buffer
+        # the buffer only caps how far ahead the writes can be, fill_level decides how much of it is used
+        buffer_length = self.sample_size * WRITER_BUFFER_CHUNKS
         self.task.timing.cfg_samp_clk_timing(
             rate=self.sample_rate,
             samps_per_chan=buffer_length,
@@ -205,9 +419,11 @@ class SignalWriterDAQ(SignalGeneratorBase):
             sample_mode=AcquisitionType.CONTINUOUS,
         )
 
-        self.task.out_stream.regen_mode = RegenerationMode.DONT_ALLOW_REGENERATION
-        # apparently the samps_per_chan doesn't do much for buffer size
-        self.task.out_stream.output_buf_size = buffer_length
+        self.buffer_length = buffer_length
+        self.configure_streaming()
+        self.fill_level.reset(self.sample_rate, self.sample_size, buffer_length)
+        # queued samples at every write over the whole buffer
+        self.fill_histogram = Histogram(0, buffer_length, WRITER_FILL_BINS)
 
         # debug messages
         print("Regeneration mode is set to: " +
@@ -217,30 +433,367 @@ class SignalWriterDAQ(SignalGeneratorBase):
               " -- Frequency is: ", self.frequencies)
 
         self.writer = AnalogMultiChannelWriter(self.task.out_stream)
+        self.task.register_every_n_samples_transferred_from_buffer_event(
+            self.sample_size, self.on_samples_transferred
+        )
 
         # fill the buffer
         self.callback()
         self.callback()
 
+        self.thread_running = True
+        self.thread = threading.Thread(target=self.run, name="Writer Thread", daemon=True)
+        self.thread.start()
+
+    def configure_streaming(self):
+        """
+        Buffer of a few chunks that every callback writes new samples into, old samples are never repeated
+        Only possible while the task is stopped
+        """
+        self.task.out_stream.regen_mode = RegenerationMode.DONT_ALLOW_REGENERATION
+        # apparently the samps_per_chan doesn't do much for buffer size
+        self.task.out_stream.output_buf_size = self.buffer_length
+
+    def run(self):
+        """
+        Write thread loop
+        Keeps fill_level.target samples queued on the device by writing a new chunk whenever one has been
+        generated, so what was consumed is replaced right away and the pace is set by the sample clock.
+        The thread sleeps until the next chunk is due, or until the every N samples transferred event wakes
+        it up first, and idles while paused or while the device loops a static output.
+        """
+        while self.thread_running:
+            timeout = None
+            with self.lock:
+                if self.updating and not self.is_static:
+                    now = time.perf_counter()
+                    queued = self.samples_written - self.task.out_stream.total_samp_per_chan_generated
+                    if queued <= 0 and self.task_running:
+                        self.restart_streaming()
+                        continue
+                    target = self.fill_level.target
+                    missing = target - queued
+                    if missing >= self.sample_size:
+                        wake_late = max(0.0, now - self.write_due)
+                        try:
+                            self.callback()
+                        except Exception as e:
+                            # the device stopped on an underflow that it only reports now, with samples still queued
+                            if getattr(e, "error_code", None) == GEN_STOPPED_TO_PREVENT_REGEN_OF_OLD_SAMPLES and \
+                                    self.task_running:
+                                self.restart_streaming()
+                                continue
+                            print("Error with write_many_sample")
+                            print(e)
+                            self.updating = False
+                            continue
+                        write_time = time.perf_counter() - now
+                        self.log_write(queued, target, write_time, wake_late)
+                        self.write_due = time.perf_counter()
+                        continue
+                    timeout = (self.sample_size - missing) / self.sample_rate
+                    self.write_due = now + timeout
+            self.state_changed.wait(timeout)
+            self.state_changed.clear()
+
+    def log_write(self, queued, target, write_time, wake_late):
+        """
+        Feed the timing of a write to fill_level and log it
+        """
+        self.fill_level.update(wake_late, write_time)
+        self.fill_histogram.add(queued)
+        self.writes += 1
+        self.metrics.append(
+            self.writes, queued, target, write_time * 1000, wake_late * 1000, self.underflows
+        )
+
+    def restart_streaming(self):
+        """
+        The device ran out of samples: restart the task with the queue filled up to a target that now
+        allows for one more chunk of lateness
+        """
+        self.underflows += 1
+        self.fill_level.on_underflow()
+        print("Output underflow, restarting the output task")
+
+        self.task.stop()
+        self.samples_written = 0
+        self.started_row = self.frequency_log.count
+        self.configure_streaming()
+        # not static while refilling, the task is restarted here
+        self.task_running = False
+        while self.samples_written + self.sample_size <= self.fill_level.target:
+            self.callback()
+        self.task.start()
+        self.mark_started()
+        self.task_running = True
+        self.write_due = time.perf_counter()
+
+    def on_samples_transferred(self, task_handle, event_type, num_samples, callback_data):
+        """
+        DAQmx every N samples transferred from buffer callback, runs on the DAQmx driver thread
+        """
+        self.state_changed.set()
+        return 0
+
+    def start_updates(self):
+        self.fill_level.reset(self.sample_rate, self.sample_size, self.buffer_length)
+        self.write_due = time.perf_counter()
+        self.updating = True
+        self.state_changed.set()
+
+    def stop_updates(self):
+        # once the lock is ours the write thread is not in the middle of a callback
+        with self.lock:
+            self.updating = False
+
     def callback(self):
+        if self.is_static:
+            return
         super().callback()
         self.writer.write_many_sample(self.output_waveform)
+        if self.source is not None and self.source.frequency is not None:
+            self.frequency_log.append(self.samples_written, self.source.frequency)
+        self.samples_written += self.sample_size
+
+        if self.oscillators.steady_chunks < STATIC_SETTLE_CHUNKS:
+            self.static_refused = False
+        elif self.static_output and self.source is None and self.task_running and not self.static_refused:
+            self.enter_static()
+
+    def enter_static(self):
+        """
+        Hand the steady output over to the device
+        The task is restarted with regeneration allowed and a buffer holding a whole number of periods of every
+        channel, starting at the phase the streamed output had reached. The outputs only hold their value
+        for as long as the restart takes and the device loops the buffer from then on.
+        """
+        period = self.oscillators.common_period()
+        if period is None:
+            print("Output doesn't repeat within a cacheable period, keeps streaming")
+            # not again until the parameters change
+            self.static_refused = True
+            return
+        length = period * -(-self.buffer_length // period)
+
+        self.task.stop()
+
+        # continue from the phase of the first sample that was not generated before the stop
+        generated = self.task.out_stream.total_samp_per_chan_generated
+        steps = self.oscillators.steps.copy()
+        phases = (self.oscillators.phases - (self.samples_written - generated) * steps) % 1
+        static_waveform = self.oscillators.render(phases, np.empty((self.num_channels, length)))
+
+        self.task.out_stream.regen_mode = RegenerationMode.ALLOW_REGENERATION
+        self.task.out_stream.output_buf_size = length
+        self.writer.write_many_sample(static_waveform)
+        self.task.start()
+        # the device counts its samples from this start now
+        self.started_row = self.frequency_log.count
+        self.mark_started()
+
+        self.static_phases = phases
+        self.static_steps = steps
+        self.static_length = length
+        self.is_static = True
+        print("Static output: the device loops", length, "samples")
+
+    def leave_static(self):
+        """
+        Go back to streaming without stopping the device
+        The next chunks are written into the looping buffer from one chunk ahead of the generation on,
+        continuing from the phase the device will be at there, and every callback streams on after them
+        """
+        generated = self.task.out_stream.total_samp_per_chan_generated
+        position = (generated + self.sample_size) % self.static_length
+        self.oscillators.set_phases((self.static_phases + position * self.static_steps) % 1)
+        self.samples_written = generated + self.sample_size
+        self.is_static = False
+
+        self.task.out_stream.relative_to = WriteRelativeTo.FIRST_SAMPLE
+        self.task.out_stream.offset = position
+        self.callback()
+        self.task.out_stream.relative_to = WriteRelativeTo.CURRENT_WRITE_POSITION
+        self.task.out_stream.offset = 0
+        # with regeneration still allowed a late write would replay old samples, so get as far ahead as streaming
+        while not self.is_static and self.samples_written + self.sample_size - generated <= self.fill_level.target:
+            self.callback()
+        self.write_due = time.perf_counter()
+        self.state_changed.set()
+        print("Static output stopped, streaming")
+
+    def mark_started(self):
+        """
+        Called right after the task was started from output sample 0, frequency_at() counts the samples from here
+        """
+        self.started_at = time.perf_counter()
+
+    def frequency_at(self, timestamp):
+        """
+        Frequency of the sweep at the output sample generated at a perf_counter time, from frequency_log
+        The input and output tasks aren't started together, the sample is found from the time the output
+        task started, which is good to the time it takes to start it
+
+        :param timestamp: perf_counter time, eg. of the first sample of an input chunk
+        :return: frequency in Hz at the first sample of the written chunk holding that sample, None when no
+                 sweep chunk was written for it
+        """
+        started_at = self.started_at
+        log = self.frequency_log
+        if started_at is None or timestamp < started_at:
+            return None
+        sample = (timestamp - started_at) * self.sample_rate
+        # the newest chunks are the ones being generated, search back from them
+        for i in range(log.count - 1, max(log.count - len(log.rows), self.started_row) - 1, -1):
+            output_sample, frequency = log.rows[i % len(log.rows), 1:]
+            if output_sample <= sample:
+                return frequency if sample < output_sample + self.sample_size else None
+        return None
+
+    def output_latency(self):
+        """
+        Seconds until a parameter change is fully on the outputs: the samples kept queued plus the ramp
+        """
+        return self.fill_level.target / self.sample_rate + self.oscillators.ramp_time
+
+    def params_changed(self):
+        with self.lock:
+            if self.is_static:
+                self.leave_static()
+
+    def set_source(self, source):
+        with self.lock:
+            if self.is_static:
+                self.leave_static()
+            super().set_source(source)
+
+    def realign_channel_phases(self):
+        with self.lock:
+            if self.is_static:
+                self.leave_static()
+            super().realign_channel_phases()
 
     def resume(self):
-        self.callback()  # extra callback to fill DAQ buffer
-        super().resume()  # start timer
-        self.task.start()  # start task
+        with self.lock:
+            self.callback()  # extra callback to fill DAQ buffer
+            super().resume()  # wake up the write thread
+            self.task.start()  # start task
+            self.mark_started()
+            self.task_running = True
 
-    # TODO: bug with this not setting output to 0 when DAQ is hooked up
     def pause(self):
-        super().pause()
-        self.task.stop()
+        with self.lock:
+            if self.is_static:
+                self.leave_static()
+            super().pause()
+            if self.task_running:
+                self.wait_for_generated(self.samples_written - self.sample_size + 1)
+            self.task.stop()
+            self.started_at = None
+            # stopping a task that never started keeps what was written queued, the count goes on from there
+            if self.task_running:
+                self.samples_written = 0
+                self.started_row = self.frequency_log.count
+            self.task_running = False
+            # back to streaming buffers in case the output was static
+            self.configure_streaming()
+
+    def wait_for_generated(self, count):
+        """
+        Block until the device has generated count samples per channel, eg. so the outputs hold the last
+        chunk written instead of whatever was playing when the task is stopped
+        Gives up once the queued samples should have been generated twice over
+        """
+        queued = count - self.task.out_stream.total_samp_per_chan_generated
+        deadline = time.perf_counter() + 2 * max(queued, 0) / self.sample_rate + 0.1
+        while self.task.out_stream.total_samp_per_chan_generated < count:
+            if time.perf_counter() > deadline:
+                print("Output did not reach sample", count, "before the task was stopped")
+                return
+            time.sleep(0.25 * self.sample_size / self.sample_rate)
 
     def end(self):
         super().end()
+        self.thread_running = False
+        self.state_changed.set()
+        if self.thread is not None:
+            self.thread.join()
         self.task.close()
 
 
+class CoilCoupling:
+    """
+    Linear model of the coil set used to turn target fields into coil drives
+
+    matrix[r, c] is the field along axis r per volt on coil c, so field = matrix @ drive, and every coil's
+    field lags its drive by lags[c] degrees. The diagonal comes from the per coil gains (volts per unit field
+    on the coil's own axis, the old kx, ky, kz) and the off diagonal terms from cross, given as the fraction
+    of coil c's own axis field that also shows up on axis r.
+    The inverse including the phase lead that cancels the lags is computed once whenever the coefficients
+    change, turning any block of target fields into drives is then a single complex matrix multiply.
+    """
+
+    def __init__(self, gains=(1, 1, 2), cross=None, lags=None):
+        """
+        :param gains: volts per unit field of every coil along its own axis
+        :param cross: (3 x 3) fraction of coil c's field seen on axis r, the diagonal is ignored
+        :param lags: phase lag of every coil's field behind its drive in degrees
+        """
+        self.gains = np.array(gains, dtype=np.float64)
+        self.cross = np.zeros((3, 3)) if cross is None else np.array(cross, dtype=np.float64)
+        self.lags = np.zeros(3) if lags is None else np.array(lags, dtype=np.float64)
+        self.matrix = np.eye(3)
+        # drive = drive_matrix @ field, cached inverse of the coupling including the lag compensation
+        self.drive_matrix = np.eye(3, dtype=np.complex128)
+        self.update()
+
+    def update(self):
+        """
+        Rebuild the coupling matrix from the gains, cross terms and lags and cache its inverse
+        Call after changing any of them, keeps the previous inverse if the new matrix is singular
+        """
+        if np.any(self.gains == 0):
+            print("Coil gains must not be 0, keeping the previous coupling")
+            return
+        own_field = 1 / self.gains
+        matrix = self.cross * own_field
+        np.fill_diagonal(matrix, own_field)
+        try:
+            inverse = np.linalg.inv(matrix)
+        except np.linalg.LinAlgError:
+            print("Coil coupling matrix is singular, keeping the previous coupling")
+            return
+        self.matrix = matrix
+        # lead every coil's drive by its lag so that the fields come out with the requested phases
+        self.drive_matrix = np.exp(1j * np.radians(self.lags))[:, None] * inverse
+
+    def drive(self, amplitudes, shifts):
+        """
+        Coil drives for a block of target fields
+
+        Every axis of the target field is a sine with the given amplitude and phase shift (in degrees, same
+        convention as the writer's shifts). The drives are returned the same way, with the shift kept within
+        90 degrees of the axis' target shift and the sign put on the amplitude, so that fields in phase with
+        the target stay signed amplitudes without shift (needed for DC output and for ramping through 0).
+
+        :param amplitudes: (3,) + shape array of target amplitudes
+        :param shifts: target shifts in degrees, broadcastable to amplitudes
+        :return: (amplitudes, shifts) of the coil drives, both (3,) + shape
+        """
+        amplitudes = np.asarray(amplitudes, dtype=np.float64)
+        shifts = np.broadcast_to(np.radians(shifts), amplitudes.shape)
+        fields = (amplitudes * np.exp(-1j * shifts)).reshape(3, -1)
+
+        drives = (self.drive_matrix @ fields).reshape(amplitudes.shape)
+
+        # phase of every drive relative to its axis' target, folded into +-90 degrees with the sign
+        relative = np.angle(drives * np.exp(1j * shifts))
+        turns = np.round(relative / np.pi)
+        relative -= turns * np.pi
+        drive_amplitudes = np.abs(drives) * (1 - 2 * np.abs(turns))
+        return drive_amplitudes, np.degrees(shifts - relative)
+
+
 class MagneticControlBase(QtCore.QObject):
     """
     Parent class to Magnetic Rotation and Alignment
@@ -261,9 +814,8 @@ class MagneticControlBase(QtCore.QObject):
         self.theta = theta
         self.amplitude = amplitude
         self.frequency = frequency
-        self.kx = kx
-        self.ky = ky
-        self.kz = kz
+        # field to coil drive transform, kx, ky, kz are the volts per unit field of every coil on its own axis
+        self.coupling = CoilCoupling(gains=(kx, ky, kz))
 
         # assume len(CHANNEL_NAMES_OUT) is 3
         self.voltages = [0, 0, 0]
@@ -271,11 +823,28 @@ class MagneticControlBase(QtCore.QObject):
         if self.num_channels != 3:
             Raise("Not enough write channels for 3D Magnetic Field Control!")
 
+    def coil_signals(self, phi, theta, amplitude):
+        """
+        RMS voltage and phase shift of every coil for the given field, works on whole arrays of fields at once
+        (eg. every sample of a chunk of a FieldTrajectory)
+        Subclasses describe the target field along every axis and pass it through self.coupling.drive()
+
+        :param phi: elevation in degrees, scalar or array
+        :param theta: azimuth in degrees, shaped like phi
+        :param amplitude: field amplitude, shaped like phi
+        :return: (voltages, shifts), each (channels,) + phi.shape, shifts in degrees
+        """
+        raise NotImplementedError
+
     def update_params(self):
         """
         Updates the SignalGeneratorBase object with the stored voltage and frequency values
         Calls self.frequency which will call the frequency setter function
         """
+        voltages, shifts = self.coil_signals(self.phi, self.theta, self.amplitude)
+        for ch in range(self.num_channels):
+            self.voltages[ch] = float(voltages[ch])
+            self.writer.shifts[ch] = float(shifts[ch])
         self.writer.voltages = self.voltages
         self.frequency = self._frequency
 
@@ -338,28 +907,17 @@ class MagneticAlignment(MagneticControlBase):
             writer, state, phi, theta, amplitude, frequency, kx=kx, ky=ky, kz=kz
         )
 
-    def update_params(self):
-        """
+    def coil_signals(self, phi, theta, amplitude):
+        phi, theta = np.radians(phi), np.radians(theta)
+        # target field along every axis ( / sqrt(2) to convert to RMS)
+        fields = np.stack((
+            amplitude * np.cos(phi) * np.cos(theta),
+            amplitude * np.cos(phi) * np.sin(theta),
+            amplitude * np.sin(phi),
+        )) / np.sqrt(2)
 
-        """
-        # get voltages ( / sqrt(2) to convert to RMS)
-        self.voltages[0] = (
-            self.kx * self.amplitude *
-            cos(self.phi) * cos(self.theta) / np.sqrt(2)
-        )
-        self.voltages[1] = (
-            self.ky * self.amplitude *
-            cos(self.phi) * sin(self.theta) / np.sqrt(2)
-        )
-        self.voltages[2] = self.kz * \
-            self.amplitude * sin(self.phi) / np.sqrt(2)
-
-        # Reset phase shifts so that the signals are aligned
-        self.writer.shifts[0] = 0
-        self.writer.shifts[1] = 0
-        self.writer.shifts[2] = 0
-
-        super().update_params()
+        # no phase shifts so that the field components are aligned
+        return self.coupling.drive(fields, 0)
 
 
 class MagneticRotation(MagneticControlBase):
@@ -373,21 +931,19 @@ class MagneticRotation(MagneticControlBase):
             writer, state, phi, theta, amplitude, frequency, kx=kx, ky=ky, kz=kz
         )
 
-    def update_params(self):
-        # get voltages ( / sqrt(2) to convert to RMS)
-        self.voltages[0] = self.kx * \
-            self.amplitude * cos(self.phi) / np.sqrt(2)
-        self.voltages[1] = self.ky * \
-            self.amplitude * cos(self.phi) / np.sqrt(2)
-        self.voltages[2] = self.kz * \
-            self.amplitude * sin(self.phi) / np.sqrt(2)
+    def coil_signals(self, phi, theta, amplitude):
+        phi = np.radians(phi)
+        # target field along every axis ( / sqrt(2) to convert to RMS)
+        fields = np.stack((
+            amplitude * np.cos(phi),
+            amplitude * np.cos(phi),
+            amplitude * np.sin(phi),
+        )) / np.sqrt(2)
 
         # Phase shifts based on the rotation equation
-        self.writer.shifts[0] = 0
-        self.writer.shifts[1] = self.writer.shifts[0] - 90
-        self.writer.shifts[2] = self.theta
-
-        super().update_params()
+        theta = np.asarray(theta, dtype=np.float64)
+        shifts = np.stack((np.zeros_like(theta), np.full_like(theta, -90), theta))
+        return self.coupling.drive(fields, shifts)
 
 
 if __name__ == "__main__":